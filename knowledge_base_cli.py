@@ -0,0 +1,473 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+智能知识库命令行工具
+不启动 Streamlit 界面，直接建立索引、问答、总结和查看向量数据库状态，适合定时任务和批处理脚本
+
+Copyright (c) 2026 吕滢
+
+Licensed under the MIT License (Non-Commercial) or Apache License 2.0 (Non-Commercial)
+See LICENSE-MIT-NC or LICENSE-APACHE-NC for details.
+
+This software is for NON-COMMERCIAL USE ONLY.
+For commercial use, please contact the copyright holder.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from typing import Any, Dict
+
+# 退出码
+EXIT_OK = 0
+EXIT_ERROR = 1  # 执行失败（模型加载、API 调用、写入数据库等）
+EXIT_USAGE = 2  # 参数错误、文件夹不存在或没有可用文档（与 argparse 的参数错误一致）
+EXIT_NOT_INDEXED = 3  # 文件夹尚未建立向量数据库
+EXIT_BUSY = 4  # 同一向量数据库正在被其他进程构建
+EXIT_NO_API_KEY = 5  # 没有可用的 DeepSeek API 密钥
+EXIT_API_ERROR = 6  # DeepSeek API 调用失败（超时、限流、服务器错误等）
+
+
+class CliError(Exception):
+    """带退出码的命令行错误"""
+
+    def __init__(self, message: str, exit_code: int = EXIT_ERROR, **details):
+        super().__init__(message)
+        self.exit_code = exit_code
+        self.details = details
+
+
+def resolve_api_key(kb, api_key: str = None) -> str:
+    """按 命令行参数 > 环境变量 DEEPSEEK_API_KEY > 本地配置文件 的顺序获取 API 密钥"""
+    api_key = api_key or os.environ.get("DEEPSEEK_API_KEY") or kb.load_api_key()
+    if not api_key:
+        raise CliError("没有可用的 DeepSeek API 密钥，请使用 --api-key 或环境变量 DEEPSEEK_API_KEY 提供",
+                       EXIT_NO_API_KEY)
+    return api_key
+
+
+def load_folder(kb, folder: str, workers: int = 1) -> Dict[str, Any]:
+    if not os.path.isdir(folder):
+        raise CliError(f"文件夹不存在: {folder}", EXIT_USAGE)
+    docs = kb.process_folder(folder, max_workers=workers)
+    if not docs:
+        raise CliError(f"文件夹中没有支持的文件: {folder}", EXIT_USAGE)
+    return docs
+
+
+def check_llm_result(answer, **details):
+    """DeepSeek 调用失败时（返回内容为错误提示）以退出码 6 结束"""
+    if not getattr(answer, "ok", True):
+        raise CliError(str(answer), EXIT_API_ERROR, usage=answer.metrics(), **details)
+    return answer
+
+
+def read_signature(db_path: str) -> Dict[str, Any]:
+    try:
+        with open(os.path.join(db_path, ".docs_signature.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def describe_db(kb, db_path: str) -> Dict[str, Any]:
+    """汇总一个向量数据库目录的签名信息和磁盘占用"""
+    signature = read_signature(db_path)
+    size = kb.compute_directory_size(db_path)
+    return {
+        "db_path": db_path,
+        "folder_path": signature.get("folder_path"),
+        "build_status": signature.get("build_status", "complete" if signature else None),
+        "file_count": signature.get("file_count"),
+        "chunk_count": signature.get("chunk_count"),
+        "embedding_model": signature.get("embedding_model"),
+        "vector_backend": kb.detect_vector_backend(db_path),
+        "created_at": signature.get("created_at"),
+        "dedup": signature.get("dedup"),
+        "compact_vectors": kb.read_compact_vectors_meta(db_path),
+        "size_mb": round(size / (1024 * 1024), 2)
+    }
+
+
+def cmd_index(kb, args) -> Dict[str, Any]:
+    """建立或增量更新文件夹的向量数据库"""
+    started = time.time()
+    db_path = kb.get_vector_db_path(args.folder)
+    active_job = kb.get_active_index_job(args.folder)
+    if active_job:
+        raise CliError("该文件夹的向量数据库正在后台构建", EXIT_BUSY, job_id=active_job.get("job_id"))
+
+    docs = load_folder(kb, args.folder, args.workers)
+    if not args.force and not kb.check_docs_changed(docs, args.folder):
+        result = describe_db(kb, db_path)
+        result.update(status="unchanged", elapsed_seconds=round(time.time() - started, 2))
+        return result
+
+    if args.force:
+        # 与界面的"重新加载"一致：丢弃检查点，旧数据库在新数据库构建完成后才被替换
+        with kb.vector_db_lock(db_path):
+            kb._remove_db_dir(kb._vector_db_build_path(db_path))
+
+    def progress_callback(progress, message):
+        if not args.quiet:
+            print(f"[{progress:3d}%] {message}", file=sys.stderr)
+
+    try:
+        vectorstore = kb.create_local_vector_store(docs, progress_callback=progress_callback, folder_path=args.folder)
+    except kb.VectorDBLockTimeout as e:
+        raise CliError(str(e), EXIT_BUSY)
+    if vectorstore is None:
+        raise CliError("向量数据库功能不可用（缺少依赖包）")
+
+    result = describe_db(kb, db_path)
+    result.update(status="built", elapsed_seconds=round(time.time() - started, 2))
+    return result
+
+
+def cmd_query(kb, args) -> Dict[str, Any]:
+    """基于文件夹的向量数据库回答问题"""
+    started = time.time()
+    if not os.path.isdir(args.folder):
+        raise CliError(f"文件夹不存在: {args.folder}", EXIT_USAGE)
+
+    vectorstore, error_detail = kb.load_existing_vector_store(folder_path=args.folder)
+    if vectorstore is None and args.require_index:
+        message = error_detail.get("message") if error_detail else "请先执行 index 命令"
+        raise CliError(f"文件夹尚未建立可用的向量数据库: {message}", EXIT_NOT_INDEXED)
+
+    similar_docs = kb.search_similar_documents(vectorstore, args.question, k=args.k) if vectorstore else []
+    sources = [{"source": source, "content": content} for content, source in similar_docs]
+    result = {"question": args.question, "indexed": vectorstore is not None, "sources": sources}
+
+    if not args.retrieve_only:
+        api_key = resolve_api_key(kb, args.api_key)
+        # 没有检索结果时与界面一致，使用全部文档内容作为上下文
+        docs = {} if similar_docs else load_folder(kb, args.folder)
+        answer = kb.answer_with_deepseek(args.question, vectorstore, docs, api_key,
+                                         enable_web_search=args.web, similar_docs=similar_docs)
+        result["answer"] = check_llm_result(answer, sources=sources)
+        result["usage"] = answer.metrics()
+
+    result["elapsed_seconds"] = round(time.time() - started, 2)
+    return result
+
+
+def cmd_batch(kb, args) -> Dict[str, Any]:
+    """从问题文件批量问答，结果逐条写入 CSV（或导出为 Markdown）"""
+    started = time.time()
+    if not os.path.isfile(args.questions):
+        raise CliError(f"问题文件不存在: {args.questions}", EXIT_USAGE)
+    with open(args.questions, 'rb') as f:
+        try:
+            questions = kb.read_question_file(args.questions, f.read())
+        except ValueError as e:
+            raise CliError(str(e), EXIT_USAGE)
+    if not questions:
+        raise CliError(f"问题文件中没有问题: {args.questions}", EXIT_USAGE)
+
+    api_key = resolve_api_key(kb, args.api_key)
+    docs = load_folder(kb, args.folder, args.workers)
+    vectorstore, error_detail = kb.load_existing_vector_store(folder_path=args.folder)
+    if vectorstore is None and args.require_index:
+        message = error_detail.get("message") if error_detail else "请先执行 index 命令"
+        raise CliError(f"文件夹尚未建立可用的向量数据库: {message}", EXIT_NOT_INDEXED)
+
+    output = args.output or os.path.join(kb.BATCH_QA_DIR, f"批量问答_{time.strftime('%Y%m%d_%H%M%S')}.csv")
+    markdown = output.lower().endswith(".md")
+
+    def progress_callback(completed, total, row):
+        if not args.quiet:
+            print(f"[{completed}/{total}] 问题 {row['index']} 耗时 {row['latency_seconds']} 秒", file=sys.stderr)
+
+    results = kb.batch_answer_questions(
+        questions, vectorstore, docs, api_key,
+        k=args.k,
+        max_workers=args.concurrency,
+        requests_per_minute=args.rpm,
+        enable_web_search=args.web,
+        output_path=None if markdown else output,
+        progress_callback=progress_callback
+    )
+    if markdown:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(kb.batch_results_to_markdown(results))
+
+    latencies = [row["latency_seconds"] for row in results]
+    return {
+        "folder": args.folder,
+        "indexed": vectorstore is not None,
+        "count": len(results),
+        "failed": sum(1 for row in results if row["status"] != "ok"),
+        "output": output,
+        "avg_latency_seconds": round(sum(latencies) / len(latencies), 2),
+        "max_latency_seconds": max(latencies),
+        "elapsed_seconds": round(time.time() - started, 2)
+    }
+
+
+def cmd_summarize(kb, args) -> Dict[str, Any]:
+    """生成文件夹（或指定文件）的总结报告"""
+    started = time.time()
+    docs = load_folder(kb, args.folder, args.workers)
+    if args.files:
+        missing = [name for name in args.files if name not in docs]
+        if missing:
+            raise CliError(f"文件不存在或格式不支持: {', '.join(missing)}", EXIT_USAGE)
+
+    api_key = resolve_api_key(kb, args.api_key)
+    summary = check_llm_result(kb.generate_summary_deepseek(docs, api_key, specific_files=args.files,
+                                                            template_id=args.template))
+    return {
+        "folder": args.folder,
+        "files": args.files or sorted(docs),
+        "template": args.template,
+        "summary": summary,
+        "usage": summary.metrics(),
+        "elapsed_seconds": round(time.time() - started, 2)
+    }
+
+
+def cmd_stats(kb, args) -> Dict[str, Any]:
+    """查看向量数据库状态（不指定文件夹时列出所有向量数据库）"""
+    if args.folder:
+        db_path = kb.get_vector_db_path(args.folder)
+        if not os.path.exists(db_path):
+            raise CliError(f"文件夹尚未建立向量数据库: {args.folder}", EXIT_NOT_INDEXED, db_path=db_path)
+        result = describe_db(kb, db_path)
+        result["integrity"] = kb.inspect_vector_db(db_path)
+        active_job = kb.get_active_index_job(args.folder)
+        result["active_job"] = active_job.get("job_id") if active_job else None
+        return result
+
+    # 列表来自数据库清单，只重新统计缺少或过期的磁盘占用
+    kb.load_vector_db_inventory()
+    kb.refresh_vector_db_sizes(blocking=True)
+    entries = kb.load_vector_db_inventory(reconcile=False)
+    databases = [{
+        "db_path": entry.get("db_path"),
+        "folder_path": entry.get("folder_path"),
+        "build_status": entry.get("build_status"),
+        "file_count": entry.get("file_count"),
+        "chunk_count": entry.get("chunk_count"),
+        "embedding_model": entry.get("embedding_model"),
+        "embedding_dimension": entry.get("embedding_dimension"),
+        "vector_backend": entry.get("vector_backend"),
+        "created_at": entry.get("created_at"),
+        "last_used_at": (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_used_at"]))
+                         if entry.get("last_used_at") else None),
+        "size_mb": round((entry.get("size_bytes") or 0) / (1024 * 1024), 2)
+    } for entry in sorted(entries, key=lambda entry: entry["name"]) if entry.get("kind") == "database"]
+    summary = kb.summarize_vector_db_inventory(entries)
+    return {
+        "count": len(databases),
+        "total_size_mb": round(sum(db["size_mb"] for db in databases), 2),
+        "leftover_count": summary["leftover_count"],
+        "leftover_size_mb": round(summary["leftover_size_bytes"] / (1024 * 1024), 2),
+        "databases": databases
+    }
+
+
+def cmd_compact(kb, args) -> Dict[str, Any]:
+    """为已有的向量数据库生成紧凑向量（int8/float16），输出相对 float32 的召回率"""
+    started = time.time()
+    db_path = kb.get_vector_db_path(args.folder)
+    vectorstore, error_detail = kb.load_existing_vector_store(folder_path=args.folder)
+    if vectorstore is None:
+        message = error_detail.get("message") if error_detail else "请先运行 index 命令"
+        raise CliError(f"文件夹尚未建立可用的向量数据库: {message}", EXIT_NOT_INDEXED, db_path=db_path)
+    try:
+        with kb.vector_db_lock(db_path):
+            kb.release_compact_vector_index(db_path)
+            meta = kb.build_compact_vectors(vectorstore, db_path, dtype=args.dtype)
+    except kb.VectorDBLockTimeout as e:
+        raise CliError(str(e), EXIT_BUSY)
+    if meta is None:
+        raise CliError("向量数据库中没有文本块", EXIT_ERROR, db_path=db_path)
+    result = {"db_path": db_path, **meta, "elapsed_seconds": round(time.time() - started, 2)}
+    if not kb.load_compact_vectors_config()["enabled"]:
+        result["note"] = '配置项 compact_vectors.enabled 为 false，检索仍使用 Chroma'
+    return result
+
+
+def cmd_gc(kb, args) -> Dict[str, Any]:
+    """按磁盘配额清理向量数据库（删除残留目录和最久未使用的数据库）"""
+    result = kb.collect_vector_db_garbage(quota_mb=args.quota_mb, dry_run=args.dry_run)
+    if result.get("busy"):
+        raise CliError("其他进程正在清理向量数据库", EXIT_BUSY)
+    return result
+
+
+def cmd_metrics(kb, args) -> Dict[str, Any]:
+    """汇总 DeepSeek API 的调用次数、token 用量和耗时"""
+    return {"hours": args.hours, **kb.summarize_llm_metrics(args.hours)}
+
+
+def cmd_history(kb, args) -> Dict[str, Any]:
+    """分页查看、搜索或导出界面中保存的对话历史"""
+    folder = kb.chat_history_folder_key(args.folder)
+    user = args.user or kb.current_chat_user()
+    if args.export:
+        count = kb.export_chat_history(args.export, user, folder)
+        return {"folder": args.folder, "user": user, "count": count, "output": args.export}
+    if args.search:
+        turns = kb.search_chat_history(user, folder, args.search, limit=args.limit)
+    else:
+        turns = kb.load_chat_history_page(user, folder, before_id=args.before, limit=args.limit)
+    return {
+        "folder": args.folder,
+        "user": user,
+        "total": kb.count_chat_turns(user, folder),
+        "turns": turns,
+        # 分页查看时下一页的 --before 参数
+        "next_before": turns[-1]["id"] if turns and not args.search and len(turns) == args.limit else None
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description='智能知识库命令行工具（输出 JSON，日志输出到标准错误）',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+示例:
+  # 建立或增量更新索引（文档未变化时直接跳过）
+  python knowledge_base_cli.py index ./docs --workers 4
+
+  # 问答
+  python knowledge_base_cli.py query ./docs "项目的主要风险有哪些？"
+
+  # 批量问答（结果写入 CSV，扩展名为 .md 时导出 Markdown）
+  python knowledge_base_cli.py batch ./docs questions.xlsx -o answers.csv --concurrency 4 --rpm 60
+
+  # 生成总结报告
+  python knowledge_base_cli.py summarize ./docs --files 需求.docx 计划.xlsx
+
+  # 查看所有向量数据库
+  python knowledge_base_cli.py stats
+
+  # 生成 int8 紧凑向量并查看相对 float32 的召回率
+  python knowledge_base_cli.py compact ./docs --dtype int8
+
+  # 按磁盘配额清理最久未使用的向量数据库（--dry-run 只列出将被删除的目录）
+  python knowledge_base_cli.py gc --quota-mb 1024 --dry-run
+
+  # 最近 24 小时的 API 用量和耗时
+  python knowledge_base_cli.py metrics --hours 24
+
+  # 搜索或导出界面中的对话历史
+  python knowledge_base_cli.py history ./docs --search "风险管理"
+  python knowledge_base_cli.py history ./docs --export history.md
+
+退出码:
+  0 成功  1 执行失败  2 参数错误或没有可用文档  3 尚未建立索引  4 正在被其他进程构建  5 缺少 API 密钥
+  6 DeepSeek API 调用失败
+        """
+    )
+    parser.add_argument('--workdir', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help='数据目录（chroma_db、配置文件所在目录，默认与界面相同）')
+    parser.add_argument('--pretty', action='store_true', help='格式化输出 JSON')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出进度信息')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='建立或增量更新文件夹的向量数据库')
+    index_parser.add_argument('folder', help='文档文件夹')
+    index_parser.add_argument('--workers', type=int, default=4, help='并行读取文件的线程数（默认: 4）')
+    index_parser.add_argument('--force', action='store_true', help='忽略文档签名和检查点，强制重新构建')
+    index_parser.set_defaults(handler=cmd_index)
+
+    query_parser = subparsers.add_parser('query', help='基于文件夹的文档回答问题')
+    query_parser.add_argument('folder', help='文档文件夹')
+    query_parser.add_argument('question', help='问题')
+    query_parser.add_argument('-k', type=int, default=4, help='检索的文本块数量（默认: 4）')
+    query_parser.add_argument('--web', action='store_true', help='同时使用联网搜索')
+    query_parser.add_argument('--retrieve-only', action='store_true', help='只输出检索结果，不调用 DeepSeek')
+    query_parser.add_argument('--require-index', action='store_true',
+                              help='没有向量数据库时返回退出码 3（默认使用全部文档内容回答）')
+    query_parser.add_argument('--api-key', type=str, help='DeepSeek API 密钥')
+    query_parser.set_defaults(handler=cmd_query)
+
+    batch_parser = subparsers.add_parser('batch', help='从问题文件批量问答（CSV/XLSX/TXT）')
+    batch_parser.add_argument('folder', help='文档文件夹')
+    batch_parser.add_argument('questions', help='问题文件（CSV/XLSX 的"问题"列或第一列，TXT 每行一个问题）')
+    batch_parser.add_argument('-o', '--output', type=str, help='结果文件（.csv 或 .md，默认写入 saved_qa 目录）')
+    batch_parser.add_argument('-k', type=int, default=4, help='每个问题检索的文本块数量（默认: 4）')
+    batch_parser.add_argument('--concurrency', type=int, default=4, help='并发调用 API 的线程数（默认: 4）')
+    batch_parser.add_argument('--rpm', type=float, default=60, help='每分钟最多发出的 API 请求数，0 表示不限制（默认: 60）')
+    batch_parser.add_argument('--workers', type=int, default=4, help='并行读取文件的线程数（默认: 4）')
+    batch_parser.add_argument('--web', action='store_true', help='同时使用联网搜索')
+    batch_parser.add_argument('--require-index', action='store_true',
+                              help='没有向量数据库时返回退出码 3（默认使用全部文档内容回答）')
+    batch_parser.add_argument('--api-key', type=str, help='DeepSeek API 密钥')
+    batch_parser.set_defaults(handler=cmd_batch)
+
+    summarize_parser = subparsers.add_parser('summarize', help='生成总结报告')
+    summarize_parser.add_argument('folder', help='文档文件夹')
+    summarize_parser.add_argument('--files', nargs='+', help='只总结指定文件（文件名）')
+    summarize_parser.add_argument('--template', type=str, default='default', help='总结模版ID（默认: default）')
+    summarize_parser.add_argument('--workers', type=int, default=4, help='并行读取文件的线程数（默认: 4）')
+    summarize_parser.add_argument('--api-key', type=str, help='DeepSeek API 密钥')
+    summarize_parser.set_defaults(handler=cmd_summarize)
+
+    stats_parser = subparsers.add_parser('stats', help='查看向量数据库状态')
+    stats_parser.add_argument('folder', nargs='?', help='文档文件夹（不指定时列出所有向量数据库）')
+    stats_parser.set_defaults(handler=cmd_stats)
+
+    compact_parser = subparsers.add_parser('compact', help='生成紧凑向量（int8/float16）并报告召回率')
+    compact_parser.add_argument('folder', help='文档文件夹')
+    compact_parser.add_argument('--dtype', choices=['int8', 'float16'], help='量化类型（默认使用配置项 compact_vectors.dtype）')
+    compact_parser.set_defaults(handler=cmd_compact)
+
+    gc_parser = subparsers.add_parser('gc', help='按磁盘配额清理向量数据库')
+    gc_parser.add_argument('--quota-mb', type=float, help='磁盘配额，MB（默认使用配置项 vector_db_gc.quota_mb，0 表示只清理残留目录）')
+    gc_parser.add_argument('--dry-run', action='store_true', help='只列出将被删除的目录，不删除')
+    gc_parser.set_defaults(handler=cmd_gc)
+
+    metrics_parser = subparsers.add_parser('metrics', help='查看 DeepSeek API 用量和耗时统计')
+    metrics_parser.add_argument('--hours', type=float, help='只统计最近若干小时（默认: 全部）')
+    metrics_parser.set_defaults(handler=cmd_metrics)
+
+    history_parser = subparsers.add_parser('history', help='查看、搜索或导出对话历史')
+    history_parser.add_argument('folder', nargs='?', help='文档文件夹（不指定时为上传文件的对话）')
+    history_parser.add_argument('--search', type=str, help='全文搜索关键词（多个关键词用空格分隔）')
+    history_parser.add_argument('--export', type=str, help='导出为 Markdown 文件')
+    history_parser.add_argument('--limit', type=int, default=20, help='每页条数（默认: 20）')
+    history_parser.add_argument('--before', type=int, help='只返回ID小于该值的记录（上一页结果中的 next_before）')
+    history_parser.add_argument('--user', type=str, help='用户标识（默认: local）')
+    history_parser.set_defaults(handler=cmd_history)
+
+    return parser
+
+
+def main():
+    """命令行入口"""
+    args = build_parser().parse_args()
+    if getattr(args, 'folder', None):
+        args.folder = os.path.abspath(args.folder)  # 切换数据目录前先转换为绝对路径
+    for name in ('questions', 'output', 'export'):
+        if getattr(args, name, None):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    stdout = sys.stdout
+    exit_code = EXIT_OK
+    try:
+        os.chdir(args.workdir)
+        # 知识库模块的日志输出到标准错误，标准输出只保留 JSON 结果
+        with contextlib.redirect_stdout(sys.stderr):
+            import knowledge_base_deepseek as kb
+            result = {"ok": True, **args.handler(kb, args)}
+    except CliError as e:
+        exit_code = e.exit_code
+        result = {"ok": False, "error": str(e), "exit_code": exit_code, **e.details}
+    except Exception as e:
+        exit_code = EXIT_ERROR
+        result = {"ok": False, "error": str(e), "error_type": type(e).__name__, "exit_code": exit_code}
+
+    json.dump(result, stdout, ensure_ascii=False, indent=2 if args.pretty else None)
+    stdout.write("\n")
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,10 +22,279 @@ import json
 from datetime import datetime
 import base64
 import hashlib
+import threading
+
+# 延迟加载与启动性能模块
+# langchain、chromadb、torch、pandas 等重量级依赖只在用到时导入，首次渲染完成后在后台线程中预热
+STARTUP_PROFILE_FILE = os.path.join(".", ".startup_profile.json")
+STARTUP_IMPORT_BUDGET_MS = 1500  # 应用模块自身（首次渲染前）的导入时间预算
+PREWARM_MODULES = [
+    ("langchain_text_splitters", "langchain.text_splitter"),
+    ("langchain_chroma", "langchain_community.vectorstores"),
+    ("langchain_huggingface", "langchain_community.embeddings"),
+    ("pandas",),
+    ("docx",),
+    ("pypdf",),
+]
+
+_startup_profile_lock = threading.Lock()
+
+def import_first(*module_names: str):
+    """按顺序导入第一个可用的模块（兼容新旧版本的包名），并记录导入耗时
+
+    Raises:
+        ImportError: 所有候选模块都无法导入
+    """
+    import importlib
+    import sys
+    import time
+    
+    last_error = None
+    for module_name in module_names:
+        if module_name in sys.modules:
+            return sys.modules[module_name]
+        started = time.perf_counter()
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError as e:
+            last_error = e
+            continue
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= 50:
+            # 只记录明显的耗时，避免频繁写文件
+            update_startup_profile("lazy_imports", {module_name: round(elapsed_ms, 1)})
+        return module
+    raise last_error or ImportError(f"无法导入: {', '.join(module_names)}")
+
+def get_chroma_class():
+    return import_first("langchain_chroma", "langchain_community.vectorstores").Chroma
+
+def get_huggingface_embeddings_class():
+    return import_first("langchain_huggingface", "langchain_community.embeddings").HuggingFaceEmbeddings
+
+def get_text_splitter_class():
+    return import_first("langchain_text_splitters", "langchain.text_splitter",
+                        "langchain_core.text_splitter").RecursiveCharacterTextSplitter
+
+def get_langchain_document_class():
+    return import_first("langchain.schema", "langchain_core.documents").Document
+
+def update_startup_profile(section: str, data: Dict[str, Any]):
+    """把一组计时数据合并写入启动性能记录文件（.startup_profile.json）"""
+    with _startup_profile_lock:
+        try:
+            profile = {}
+            if os.path.exists(STARTUP_PROFILE_FILE):
+                with open(STARTUP_PROFILE_FILE, 'r', encoding='utf-8') as f:
+                    profile = json.load(f)
+            profile.setdefault(section, {}).update(data)
+            profile["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            _write_json_atomic(STARTUP_PROFILE_FILE, profile)
+        except Exception:
+            pass  # 性能记录失败不影响主流程
+
+def load_prewarm_config() -> bool:
+    """从本地配置文件加载是否在后台预热依赖，默认为 True"""
+    try:
+        return bool(read_config_file().get("prewarm_modules", True))
+    except Exception:
+        pass
+    return True
+
+@st.cache_resource(show_spinner=False)
+def start_background_prewarm(_first_render_ms: float = None):
+    """首次渲染完成后在后台线程中导入重量级依赖（每个进程只执行一次）
+
+    导入结果缓存在 sys.modules 中，用户第一次点击时不必再等待导入。
+    嵌入模型只有在已有向量数据库时才预加载。
+
+    Args:
+        _first_render_ms: 进程第一次渲染页面的耗时，记录到启动性能文件（不参与缓存键）
+    """
+    import time
+    
+    if _first_render_ms is not None:
+        update_startup_profile("app", {"first_render_ms": round(_first_render_ms, 1)})
+    if not load_prewarm_config():
+        return None
+    
+    def prewarm():
+        timings = {}
+        started = time.perf_counter()
+        for candidates in PREWARM_MODULES:
+            if candidates[0] == "langchain_chroma" and load_vector_backend_config() != "chroma":
+                continue  # NumPy 索引不需要 chromadb
+            module_started = time.perf_counter()
+            try:
+                import_first(*candidates)
+                timings[candidates[0]] = round((time.perf_counter() - module_started) * 1000, 1)
+            except Exception:
+                timings[candidates[0]] = None  # 未安装的可选依赖
+        if os.path.exists("./chroma_db"):
+            model_started = time.perf_counter()
+            try:
+                get_shared_embeddings(load_embedding_model_config())
+                timings["embedding_model"] = round((time.perf_counter() - model_started) * 1000, 1)
+            except Exception:
+                timings["embedding_model"] = None
+        update_startup_profile("prewarm", {
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "modules": timings
+        })
+        print(f"[INFO] 后台预热完成，用时 {time.perf_counter() - started:.1f} 秒")
+    
+    thread = threading.Thread(target=prewarm, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+def parse_importtime(stderr: str) -> List[Dict[str, Any]]:
+    """解析 python -X importtime 的输出
+
+    Returns:
+        每个被导入模块的 {"module", "self_ms", "cumulative_ms", "depth"}，depth 为 0 表示顶层导入
+    """
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cumulative_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # 表头行
+        name = parts[2].rstrip()
+        # 顶层模块名前有一个空格，每深一层多两个空格
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append({
+            "module": name.strip(),
+            "self_ms": self_us / 1000,
+            "cumulative_ms": cumulative_us / 1000,
+            "depth": depth
+        })
+    return entries
+
+def profile_imports(top_n: int = 20) -> Dict[str, Any]:
+    """用 -X importtime 测量应用模块和各重量级依赖的冷启动导入时间，写入启动性能记录
+
+    每个模块在独立的子进程中测量，避免已缓存的模块影响结果。
+
+    Returns:
+        报告字典，app_import_ms 超过 STARTUP_IMPORT_BUDGET_MS 时 over_budget 为 True
+    """
+    import subprocess
+    import sys
+    
+    def measure(module_name: str) -> Tuple[Optional[float], List[Dict[str, Any]]]:
+        """返回模块的累计导入耗时和它直接导入的模块（导入失败时耗时为 None）"""
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        if result.returncode != 0:
+            return None, []
+        # importtime 先输出子模块再输出父模块，遇到目标模块时之前累积的第一层即为它的直接导入
+        children = []
+        for entry in parse_importtime(result.stderr):
+            if entry["depth"] == 1:
+                children.append(entry)
+            elif entry["depth"] == 0:
+                if entry["module"] == module_name:
+                    return entry["cumulative_ms"], children
+                children = []
+        return None, []
+    
+    app_module = os.path.splitext(os.path.basename(__file__))[0]
+    app_import_ms, app_children = measure(app_module)
+    if app_import_ms is None:
+        raise RuntimeError(f"无法导入应用模块: {app_module}")
+    
+    dependencies = {}
+    for candidates in PREWARM_MODULES:
+        elapsed, _ = measure(candidates[0])
+        dependencies[candidates[0]] = round(elapsed, 1) if elapsed is not None else None
+    
+    slowest = sorted(app_children, key=lambda e: e["cumulative_ms"], reverse=True)
+    report = {
+        "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "budget_ms": STARTUP_IMPORT_BUDGET_MS,
+        "app_import_ms": round(app_import_ms, 1),
+        "over_budget": app_import_ms > STARTUP_IMPORT_BUDGET_MS,
+        "app_slowest_imports": [{"module": e["module"], "cumulative_ms": round(e["cumulative_ms"], 1)}
+                                for e in slowest[:top_n]],
+        "dependency_import_ms": dependencies
+    }
+    
+    # 与上一次报告比较，导入时间明显增加时给出提示
+    try:
+        with open(STARTUP_PROFILE_FILE, 'r', encoding='utf-8') as f:
+            previous = json.load(f).get("importtime", {})
+        if previous.get("app_import_ms"):
+            report["previous_app_import_ms"] = previous["app_import_ms"]
+            report["regression"] = app_import_ms > previous["app_import_ms"] * 1.2 + 50
+    except Exception:
+        pass
+    
+    update_startup_profile("importtime", report)
+    return report
+
+def print_import_profile(report: Dict[str, Any]):
+    print(f"应用模块导入耗时: {report['app_import_ms']:.1f} ms（预算 {report['budget_ms']} ms）")
+    if report.get("previous_app_import_ms") is not None:
+        print(f"上一次: {report['previous_app_import_ms']:.1f} ms")
+    print("最慢的直接导入:")
+    for item in report["app_slowest_imports"]:
+        print(f"  {item['cumulative_ms']:>10.1f} ms  {item['module']}")
+    print("重量级依赖（延迟导入，首次渲染后在后台预热）:")
+    for module_name, elapsed in report["dependency_import_ms"].items():
+        print(f"  {elapsed:>10.1f} ms  {module_name}" if elapsed is not None else f"  {'未安装':>10}     {module_name}")
+    if report["over_budget"]:
+        print(f"[WARN] 应用模块导入耗时超出预算 {report['budget_ms']} ms")
+    if report.get("regression"):
+        print("[WARN] 导入耗时比上一次明显增加")
+    print(f"报告已写入: {STARTUP_PROFILE_FILE}")
 
 # API Key 管理模块
 CONFIG_FILE = os.path.join(".", ".deepseek_config.json")
 
+@st.cache_resource(show_spinner=False)
+def get_json_file_cache() -> Dict[str, Any]:
+    """进程级的 JSON 文件解析缓存（Streamlit 重跑脚本时保持不变）
+
+    entries: 路径 -> ((修改时间, 大小), 解析结果)
+    """
+    return {"entries": {}, "lock": threading.Lock()}
+
+def read_json_file_cached(path: str, default: Any = None) -> Any:
+    """读取 JSON 文件，修改时间和大小未变化时直接使用上次解析的结果
+
+    界面每次交互都会重跑脚本，配置文件和模版文件借此避免反复读取和解析。
+    返回的是副本，调用方可以修改；文件不存在时返回 default 的副本，解析失败时抛出异常。
+    """
+    import copy
+    
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return copy.deepcopy(default)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cache = get_json_file_cache()
+    with cache["lock"]:
+        cached = cache["entries"].get(path)
+    if cached is not None and cached[0] == version:
+        return copy.deepcopy(cached[1])
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    with cache["lock"]:
+        cache["entries"][path] = (version, data)
+    return copy.deepcopy(data)
+
+def read_config_file() -> Dict[str, Any]:
+    """读取本地配置文件（只读场景使用；不存在时为空字典）"""
+    return read_json_file_cached(CONFIG_FILE, {})
+
 # Prompt 模版管理模块
 PROMPT_TEMPLATES_DIR = os.path.join(".", "prompt_templates")
 SUMMARY_TEMPLATES_FILE = os.path.join(PROMPT_TEMPLATES_DIR, "summary_templates.json")
@@ -276,13 +545,12 @@ def load_templates(template_type: str) -> Dict[str, Dict[str, Any]]:
     
     try:
         if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                templates = json.load(f)
-                # 合并默认模版（如果用户模版中没有）
-                for key, default_template in default_templates.items():
-                    if key not in templates:
-                        templates[key] = default_template
-                return templates
+            templates = read_json_file_cached(file_path, {})
+            # 合并默认模版（如果用户模版中没有）
+            for key, default_template in default_templates.items():
+                if key not in templates:
+                    templates[key] = default_template
+            return templates
         else:
             # 如果文件不存在，创建默认模版文件
             save_templates(template_type, default_templates)
@@ -427,12 +695,9 @@ def save_api_key(api_key: str, show_error: bool = True) -> bool:
 def load_api_key() -> Optional[str]:
     """从本地配置文件加载 API key"""
     try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                api_key = decode_api_key(config.get("api_key", ""))
-                if api_key:
-                    return api_key
+        api_key = decode_api_key(read_config_file().get("api_key", ""))
+        if api_key:
+            return api_key
     except Exception as e:
         # 静默失败，如果文件损坏或不存在，返回 None
         pass
@@ -445,11 +710,7 @@ def load_embedding_model_config() -> str:
         模型名称，默认为 "BAAI/bge-small-zh-v1.5"
     """
     try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                model_name = config.get("embedding_model", "BAAI/bge-small-zh-v1.5")
-                return model_name
+        return read_config_file().get("embedding_model", "BAAI/bge-small-zh-v1.5")
     except Exception:
         pass
     return "BAAI/bge-small-zh-v1.5"
@@ -494,10 +755,7 @@ def load_web_search_config() -> bool:
         是否启用联网搜索，默认为 False
     """
     try:
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                config = json.load(f)
-                return config.get("enable_web_search", False)
+        return read_config_file().get("enable_web_search", False)
     except Exception:
         pass
     return False
@@ -697,9 +955,15 @@ def read_json_file(file_path):
     except Exception as e:
         return f"JSON读取失败: {str(e)}"
 
-def process_folder(folder_path: str) -> Dict[str, Any]:
-    """处理文件夹中的所有文件"""
+def process_folder(folder_path: str, max_workers: int = 1) -> Dict[str, Any]:
+    """处理文件夹中的所有文件
+
+    Args:
+        folder_path: 文件夹路径
+        max_workers: 并行读取文件的线程数（PDF、Word 等解析较慢的文件较多时可以调大）
+    """
     all_docs = {}
+    tasks = []
     
     # 支持的文件类型
     file_patterns = {
@@ -721,22 +985,35 @@ def process_folder(folder_path: str) -> Dict[str, Any]:
             # Excel 临时文件以 ~$ 开头，Word 临时文件也可能以 ~$ 开头
             if file_name.startswith('~$') or file_name.startswith('.'):
                 continue
-            
-            try:
-                content = reader_func(file_path)
-                all_docs[file_name] = {
-                    'path': file_path,
-                    'content': content,
-                    'type': file_type,
-                    'size': os.path.getsize(file_path)
-                }
-            except Exception as e:
-                all_docs[file_name] = {
-                    'path': file_path,
-                    'content': f"读取失败: {str(e)}",
-                    'type': 'error',
-                    'size': 0
-                }
+            tasks.append((file_name, file_path, file_type, reader_func))
+    
+    def read_one(task):
+        file_name, file_path, file_type, reader_func = task
+        try:
+            return file_name, {
+                'path': file_path,
+                'content': reader_func(file_path),
+                'type': file_type,
+                'size': os.path.getsize(file_path)
+            }
+        except Exception as e:
+            return file_name, {
+                'path': file_path,
+                'content': f"读取失败: {str(e)}",
+                'type': 'error',
+                'size': 0
+            }
+    
+    if max_workers > 1 and len(tasks) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read_one, tasks))
+    else:
+        results = [read_one(task) for task in tasks]
+    
+    # 按文件类型和文件名的扫描顺序写入，结果与顺序读取一致
+    for file_name, data in results:
+        all_docs[file_name] = data
     
     return all_docs
 
@@ -813,6 +1090,132 @@ def get_model_path(model_name: str = "BAAI/bge-small-zh-v1.5") -> str:
     # 如果都不存在，返回原始模型名称（会触发下载）
     return model_name
 
+@st.cache_resource(show_spinner=False)
+def get_shared_embeddings(model_name: str):
+    """加载嵌入模型（同一进程内所有会话共用一个模型实例）
+
+    Args:
+        model_name: 嵌入模型名称（HuggingFace 模型名或本地路径）
+    """
+    HuggingFaceEmbeddings = get_huggingface_embeddings_class()
+    return HuggingFaceEmbeddings(
+        model_name=get_model_path(model_name),
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True}
+    )
+
+class LazyEmbeddings:
+    """延迟加载的嵌入模型
+
+    打开向量数据库时不需要嵌入模型，第一次真正检索（生成查询向量）时才加载，
+    加载已有数据库因此不必等待模型初始化。
+    """
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    @property
+    def model(self):
+        return get_shared_embeddings(self.model_name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+    def __getattr__(self, name):
+        # 其他属性和方法（如异步接口）交给实际的模型
+        if name.startswith("__") or name == "model_name":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+def inspect_vector_db(db_path: str) -> Dict[str, Any]:
+    """根据元数据快速检查向量数据库是否可用（不加载嵌入模型和索引）
+
+    依次检查文档签名（构建状态、嵌入模型）和 chroma.sqlite3 中集合记录的维度、文本块数量
+    （NumPy 索引则检查 numpy_index.json 记录的维度、行数与向量文件大小）。
+    SQLite 以只读方式打开，通常只需几毫秒。
+
+    Returns:
+        {"status": "ok" | "stale" | "corrupted" | "unknown", "reason": 说明, "count": 文本块数量, "dimension": 向量维度}
+        "corrupted" 表示文件无法读取或彼此矛盾，可以删除；"stale" 表示文件完好但与当前设置不匹配
+        （嵌入模型已变化、构建未完成、集合为空），不能加载但也不应删除，重新构建时原子替换；
+        无法根据元数据判断（如 chromadb 版本的表结构不同）时返回 "unknown"，由调用者回退到查询验证
+    """
+    import sqlite3
+    from urllib.request import pathname2url
+    
+    result = {"status": "unknown", "reason": "", "count": None, "dimension": None}
+    backend = detect_vector_backend(db_path)
+    sqlite_file = os.path.join(db_path, "chroma.sqlite3")
+    if backend is None:
+        result.update(status="corrupted", reason="缺少 chroma.sqlite3 或 numpy_index.json")
+        return result
+    
+    signature = {}
+    signature_file = os.path.join(db_path, ".docs_signature.json")
+    if os.path.exists(signature_file):
+        try:
+            with open(signature_file, 'r', encoding='utf-8') as f:
+                signature = json.load(f)
+        except Exception:
+            signature = {}
+    if signature.get("build_status", "complete") != "complete":
+        result.update(status="stale", reason="数据库未构建完成")
+        return result
+    embedding_model = load_embedding_model_config()
+    if signature.get("embedding_model") and signature["embedding_model"] != embedding_model:
+        result.update(status="stale", reason=f"嵌入模型已变化（数据库: {signature['embedding_model']}，当前: {embedding_model}）")
+        return result
+    
+    if backend == "numpy":
+        try:
+            info = NumpyVectorStore(db_path).inspect()
+        except Exception as e:
+            result.update(status="corrupted", reason=f"NumPy 索引文件损坏: {str(e)}")
+            return result
+        if not info["complete"]:
+            result.update(status="corrupted", reason="向量文件不完整")
+            return result
+        count, dimension = info["count"], info["dimension"]
+    else:
+        try:
+            conn = sqlite3.connect(f"file:{pathname2url(os.path.abspath(sqlite_file))}?mode=ro", uri=True)
+            try:
+                rows = conn.execute("SELECT id, dimension FROM collections").fetchall()
+                if len(rows) != 1:
+                    result["reason"] = f"集合数量为 {len(rows)}"
+                    return result
+                collection_id, dimension = rows[0]
+                count = conn.execute(
+                    "SELECT COUNT(*) FROM embeddings e JOIN segments s ON e.segment_id = s.id WHERE s.collection = ?",
+                    (collection_id,)
+                ).fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError as e:
+            error_msg = str(e).lower()
+            if "malformed" in error_msg or "not a database" in error_msg or "encrypted" in error_msg:
+                result.update(status="corrupted", reason=f"SQLite 文件损坏: {str(e)}")
+            else:
+                # 表结构与预期不同（其他版本的 chromadb），无法据此判断
+                result["reason"] = f"无法读取集合元数据: {str(e)}"
+            return result
+    
+    result.update(count=count, dimension=dimension)
+    expected_dimension = signature.get("embedding_dimension") or get_embedding_model_dimension(embedding_model)
+    if dimension is not None and dimension != expected_dimension:
+        # 与签名自身记录的维度矛盾说明文件有问题；签名没有记录时是与当前模型不匹配
+        status = "corrupted" if signature.get("embedding_dimension") else "stale"
+        result.update(status=status, reason=f"向量维度不匹配（数据库: {dimension}，当前模型: {expected_dimension}）")
+    elif count == 0:
+        result.update(status="stale", reason="集合中没有文本块")
+    elif "chunk_count" in signature and count != signature["chunk_count"]:
+        result["reason"] = f"文本块数量与签名不一致（数据库: {count}，签名: {signature['chunk_count']}）"
+    else:
+        result.update(status="ok", reason="元数据校验通过")
+    return result
+
 def check_db_corrupted(db_path: str) -> bool:
     """检测向量数据库是否损坏（特别是 schema 兼容性问题）
     
@@ -825,158 +1228,222 @@ def check_db_corrupted(db_path: str) -> bool:
     if not os.path.exists(db_path):
         return False
     
-    try:
-        # 尝试加载数据库来检测是否损坏
-        try:
-            from langchain_huggingface import HuggingFaceEmbeddings
-        except ImportError:
-            from langchain_community.embeddings import HuggingFaceEmbeddings
-        
-        try:
-            from langchain_chroma import Chroma
-        except ImportError:
-            from langchain_community.vectorstores import Chroma
+    integrity = inspect_vector_db(db_path)
+    if integrity["status"] == "corrupted":
+        print(f"⚠️ 检测到数据库损坏: {integrity['reason']}")
+        return True
+    return False
+
+# 向量数据库目录锁模块（跨进程的单写者保证）
+VECTOR_DB_LOCK_STALE_SECONDS = 120  # 锁文件超过该时间未刷新视为残留（持有进程已退出）
+VECTOR_DB_LOCK_TIMEOUT = 30  # 等待其他进程释放锁的最长时间
+
+class VectorDBLockTimeout(TimeoutError):
+    """等待向量数据库目录锁超时"""
+
+# 锁文件路径 -> {"owner": 持有线程, "count": 持有计数, "stop": 停止刷新事件}
+# 只在持有锁的线程内可重入；同一进程的其他线程（如另一个 Streamlit 会话）与其他进程一样需要等待锁文件释放
+_held_vector_db_locks = {}
+_held_vector_db_locks_guard = threading.Lock()
+
+def _vector_db_lock_file(db_path: str) -> str:
+    # 锁文件放在数据库目录旁边，目录被整体替换时锁不受影响；临时构建目录与正式目录共用一把锁
+    db_path = os.path.normpath(db_path)
+    if db_path.endswith("_building"):
+        db_path = db_path[:-len("_building")]
+    return db_path + ".lock"
+
+class vector_db_lock:
+    """向量数据库目录的跨进程写锁（上下文管理器）
+
+    所有删除、重建、替换数据库目录的操作都应在持有锁时进行。
+    锁文件以 O_EXCL 方式创建；持有期间后台线程定期刷新锁文件的修改时间，
+    超过 VECTOR_DB_LOCK_STALE_SECONDS 未刷新的锁视为残留并被接管。
+    同一线程内可以重入；同一进程的其他线程与其他进程一样，需要等待锁释放。
+
+    Args:
+        db_path: 向量数据库目录
+        timeout: 等待锁的最长时间（秒），0 表示不等待
+    """
+    def __init__(self, db_path: str, timeout: float = VECTOR_DB_LOCK_TIMEOUT):
+        self.lock_file = _vector_db_lock_file(db_path)
+        self.timeout = timeout
+
+    def __enter__(self):
+        import time
+        
+        with _held_vector_db_locks_guard:
+            held = _held_vector_db_locks.get(self.lock_file)
+            if held and held["owner"] == threading.get_ident():
+                held["count"] += 1
+                return self
+        
+        os.makedirs(os.path.dirname(self.lock_file) or ".", exist_ok=True)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({"pid": os.getpid(), "acquired_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, f)
+                break
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(self.lock_file)
+                except OSError:
+                    continue  # 锁刚被释放，立即重试
+                if age > VECTOR_DB_LOCK_STALE_SECONDS:
+                    print(f"[WARN] 接管残留的数据库锁（{age:.0f} 秒未刷新）: {self.lock_file}")
+                    try:
+                        os.remove(self.lock_file)
+                    except OSError:
+                        pass
+                    continue
+                if time.time() >= deadline:
+                    raise VectorDBLockTimeout(f"向量数据库正在被其他进程或会话修改，请稍后重试: {self.lock_file}")
+                time.sleep(0.2)
         
-        # 初始化嵌入模型
-        embedding_model = load_embedding_model_config()
-        model_path = get_model_path(embedding_model)
-        embeddings = HuggingFaceEmbeddings(
-            model_name=model_path,
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
-        )
+        stop_refresh = threading.Event()
         
-        # 尝试加载向量数据库
-        vectorstore = Chroma(
-            persist_directory=db_path,
-            embedding_function=embeddings
-        )
+        def refresh():
+            while not stop_refresh.wait(VECTOR_DB_LOCK_STALE_SECONDS / 4):
+                try:
+                    os.utime(self.lock_file, None)
+                except OSError:
+                    pass
         
-        # 尝试访问数据库（如果 schema 错误会在这里失败）
-        _ = len(vectorstore)
-        return False  # 数据库正常
-    except Exception as e:
-        error_msg = str(e).lower()
-        # 只检测真正表示数据库损坏的关键错误信息
-        # 避免过于宽泛的匹配，防止误判正常错误
-        is_corrupted = (
-            # Schema 相关错误（版本兼容性问题）
-            "no such column" in error_msg or
-            "collections.topic" in error_msg or
-            ("schema" in error_msg and ("mismatch" in error_msg or "invalid" in error_msg or "version" in error_msg)) or
-            # HNSW 索引损坏（明确的错误信息）
-            ("hnsw" in error_msg and ("corrupt" in error_msg or "invalid" in error_msg or "damaged" in error_msg)) or
-            # 索引文件损坏（明确的错误信息）
-            ("index" in error_msg and ("corrupt" in error_msg or "invalid" in error_msg or "damaged" in error_msg or "missing" in error_msg)) or
-            # SQLite 数据库文件损坏（明确的错误信息）
-            ("sqlite" in error_msg and ("corrupt" in error_msg or "database disk image is malformed" in error_msg or "file is encrypted" in error_msg)) or
-            # 段文件损坏
-            ("segment" in error_msg and ("corrupt" in error_msg or "invalid" in error_msg or "damaged" in error_msg))
-        )
-        if is_corrupted:
-            print(f"⚠️ 检测到数据库损坏: {str(e)}")
-        else:
-            # 记录非损坏性错误（用于调试）
-            print(f"ℹ️ 数据库加载时出现非损坏性错误（将忽略）: {str(e)}")
-        return is_corrupted
+        threading.Thread(target=refresh, daemon=True).start()
+        with _held_vector_db_locks_guard:
+            _held_vector_db_locks[self.lock_file] = {"owner": threading.get_ident(), "count": 1, "stop": stop_refresh}
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _held_vector_db_locks_guard:
+            held = _held_vector_db_locks[self.lock_file]
+            held["count"] -= 1
+            if held["count"] > 0:
+                return False
+            del _held_vector_db_locks[self.lock_file]
+        held["stop"].set()
+        try:
+            os.remove(self.lock_file)
+        except OSError:
+            pass
+        return False
+
+def _remove_db_dir(db_path: str) -> bool:
+    """删除数据库目录（调用者需持有锁）
+
+    先把目录重命名为 _deleted_<时间戳>，原路径立即可用；
+    如果重命名后的目录因文件被占用无法立即删除，会被留给垃圾回收处理。
+    """
+    import shutil
+    import time
+    
+    if not os.path.exists(db_path):
+        return True
+    trash_path = f"{os.path.normpath(db_path)}_deleted_{int(time.time() * 1000)}"
+    try:
+        os.rename(db_path, trash_path)
+    except OSError:
+        # 无法重命名（通常是 Windows 上文件被占用），直接尝试删除
+        try:
+            shutil.rmtree(db_path)
+            return True
+        except Exception as e:
+            print(f"[ERROR] 无法清理数据库目录（可能被其他进程占用）: {str(e)}")
+            print(f"   请手动删除目录: {db_path}")
+            return False
+    shutil.rmtree(trash_path, ignore_errors=True)
+    if os.path.exists(trash_path):
+        print(f"[WARN] 旧数据库目录暂时无法删除，已重命名为: {trash_path}")
+    return True
+
+def _vector_db_build_path(db_path: str) -> str:
+    """数据库的临时构建目录（与正式目录同级，保证可以原子重命名）"""
+    return os.path.normpath(db_path) + "_building"
+
+def _open_chroma(chroma_cls, persist_directory: str, embeddings):
+    try:
+        return chroma_cls(persist_directory=persist_directory, embedding_function=embeddings)
+    except TypeError:
+        # 兼容使用 embedding 参数名的旧版本
+        return chroma_cls(persist_directory=persist_directory, embedding=embeddings)
+
+def _release_vector_store(vectorstore):
+    """释放 chromadb 在当前进程中持有的数据库文件句柄
+
+    Windows 上被打开的数据库目录无法重命名，替换目录前需要先释放。
+    向量数据库只在独立的构建进程中创建，清理 chromadb 的进程级缓存不会影响界面进程。
+    """
+    import gc
+    
+    if isinstance(vectorstore, NumpyVectorStore):
+        vectorstore.close()
+    try:
+        vectorstore._client.clear_system_cache()
+    except Exception:
+        pass
+    gc.collect()
+
+def swap_in_vector_db(build_path: str, db_path: str):
+    """用构建完成的目录替换正式数据库目录（调用者需持有锁）
+
+    正式目录先被重命名让出路径，新目录再重命名到正式路径，两步都是同一文件系统内的原子操作；
+    第二步失败时恢复旧目录，构建目录保留以便下次直接复用。
+    """
+    import shutil
+    import time
+    
+    old_path = None
+    if os.path.exists(db_path):
+        old_path = f"{os.path.normpath(db_path)}_old_{int(time.time() * 1000)}"
+        try:
+            os.rename(db_path, old_path)
+        except OSError as e:
+            raise Exception(f"无法替换向量数据库目录（可能被其他程序占用）: {db_path}\n\n"
+                            f"错误信息: {str(e)}\n\n"
+                            f"新数据库已构建完成并保留在 {build_path}，关闭占用该目录的程序后再次构建时会直接复用") from e
+    try:
+        os.rename(build_path, db_path)
+    except OSError as e:
+        if old_path:
+            os.rename(old_path, db_path)
+        raise Exception(f"无法切换到新的向量数据库: {str(e)}\n\n"
+                        f"新数据库已构建完成并保留在 {build_path}，再次构建时会直接复用") from e
+    if old_path:
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(old_path):
+            print(f"[WARN] 旧数据库目录暂时无法删除，已保留为: {old_path}")
 
 def cleanup_corrupted_db(db_path: str, force: bool = True):
     """彻底清理损坏的向量数据库目录
     
     Args:
         db_path: 向量数据库路径
-        force: 是否强制清理（包括多次尝试和延迟）
+        force: 是否等待其他进程释放数据库锁（False 时如果锁被占用立即放弃）
     
     Returns:
         bool: 是否成功清理
     """
-    import shutil
-    import time
-    
     if not os.path.exists(db_path):
         return True
     
-    if force:
-        # 强制清理模式：多次尝试，确保彻底删除（Windows上需要更长时间）
-        import platform
-        is_windows = platform.system() == 'Windows'
-        max_attempts = 8 if is_windows else 5  # Windows上增加重试次数
-        wait_time = 2.0 if is_windows else 0.5  # Windows上增加等待时间
-        
-        for attempt in range(max_attempts):
-            try:
-                # 先尝试正常删除
-                if os.path.exists(db_path):
-                    shutil.rmtree(db_path, ignore_errors=False)
-                
-                # 等待一下，确保文件系统更新（Windows需要更长时间）
-                time.sleep(wait_time)
-                
-                # 验证是否删除成功
-                if not os.path.exists(db_path):
-                    print(f"[OK] 已彻底清理损坏的向量数据库目录: {db_path}")
-                    return True
-                    
-            except PermissionError as pe:
-                # Windows 上可能有文件被锁定，等待后重试
-                if attempt < max_attempts - 1:
-                    wait_interval = wait_time * (attempt + 1)  # 递增等待时间
-                    print(f"[WARN] 文件被锁定，等待 {wait_interval:.1f} 秒后重试 ({attempt + 1}/{max_attempts})...")
-                    time.sleep(wait_interval)
-                    continue
-                else:
-                    print(f"[ERROR] 清理失败（文件被锁定）: {str(pe)}")
-                    print(f"   请手动删除目录: {db_path}")
-                    return False
-            except Exception as e:
-                if attempt < max_attempts - 1:
-                    wait_interval = wait_time * (attempt + 1)
-                    print(f"[WARN] 清理失败，等待 {wait_interval:.1f} 秒后重试 ({attempt + 1}/{max_attempts}): {str(e)}")
-                    time.sleep(wait_interval)
-                    continue
-                else:
-                    print(f"[ERROR] 清理失败: {str(e)}")
-                    print(f"   请手动删除目录: {db_path}")
-                    return False
-        
-        # 如果多次尝试后仍然存在，尝试使用 ignore_errors（忽略错误强制删除）
-        if os.path.exists(db_path):
-            try:
-                print(f"[INFO] 尝试强制删除模式（忽略错误）...")
-                shutil.rmtree(db_path, ignore_errors=True)
-                time.sleep(wait_time * 2)  # 等待更长时间
-                if not os.path.exists(db_path):
-                    print(f"[OK] 已强制清理数据库目录: {db_path}")
-                    return True
-            except Exception as e:
-                print(f"[WARN] 强制删除模式也失败: {str(e)}")
-        
-        # 最后尝试：重命名目录（如果无法删除，至少不影响后续操作）
-        if os.path.exists(db_path):
-            try:
-                temp_name = db_path + "_deleted_" + str(int(time.time()))
-                os.rename(db_path, temp_name)
-                print(f"[WARN] 无法删除目录，已重命名为: {temp_name}")
-                print(f"   可以在程序关闭后手动删除该备份目录")
-                return True  # 重命名成功也算成功（不影响后续操作）
-            except Exception as e:
-                print(f"❌ 无法清理或重命名目录: {str(e)}")
-                print(f"   目录可能被其他进程占用，请手动删除: {db_path}")
-                return False
-        
-        return False
-    else:
-        # 简单清理模式
-        try:
-            if os.path.exists(db_path):
-                shutil.rmtree(db_path)
-                print(f"[OK] 已清理数据库目录: {db_path}")
+    try:
+        with vector_db_lock(db_path, timeout=VECTOR_DB_LOCK_TIMEOUT if force else 0):
+            # 先释放本进程中共享的客户端，否则 Windows 上目录无法删除
+            get_vector_store_registry().invalidate(db_path)
+            release_compact_vector_index(db_path)
+            get_semantic_answer_cache().invalidate(db_path)
+            if _remove_db_dir(db_path):
+                forget_vector_db(db_path)
+                print(f"[OK] 已清理向量数据库目录: {db_path}")
                 return True
-        except Exception as e:
-            print(f"⚠️ 清理失败: {str(e)}")
             return False
-    
-    return False
+    except VectorDBLockTimeout as e:
+        print(f"[WARN] {str(e)}")
+        return False
+
+UPLOAD_VECTOR_DB_PATH = os.path.join("./chroma_db", "_uploads")  # 上传文件构建的向量数据库
 
 def get_vector_db_path(folder_path: str) -> str:
     """根据文件夹路径生成唯一的向量数据库目录路径
@@ -988,8 +1455,8 @@ def get_vector_db_path(folder_path: str) -> str:
         向量数据库目录路径
     """
     if not folder_path:
-        # 上传文件时没有文件夹路径，使用默认路径
-        return "./chroma_db"
+        # 上传文件时没有文件夹路径，使用独立的子目录（不能用 ./chroma_db 本身，它包含所有文件夹的数据库）
+        return UPLOAD_VECTOR_DB_PATH
     
     # 使用路径的哈希值创建唯一目录名
     # 规范化路径：与 normalize_path 保持一致，确保路径规范化逻辑统一
@@ -1025,47 +1492,729 @@ def get_vector_db_path(folder_path: str) -> str:
     db_dir_name = f"{safe_folder_name}_{path_hash}"
     return os.path.join("./chroma_db", db_dir_name)
 
-def load_existing_vector_store(folder_path: str = None, progress_callback=None):
-    """加载已有的向量数据库
-    
-    Args:
-        folder_path: 文件夹路径（用于确定向量数据库位置）
-        progress_callback: 进度回调函数，接收 (progress, message) 参数
-    
-    Returns:
-        (向量数据库对象, 错误详情字典)
-        如果成功：返回 (vectorstore, None)
-        如果失败：返回 (None, error_detail) 其中 error_detail 包含详细的错误信息
+# 向量数据库清单模块（记录每个数据库的文件夹、模型、维度、文本块数、磁盘占用和最近使用时间）
+VECTOR_DB_INVENTORY_FILE = os.path.join("./chroma_db", ".inventory.json")
+VECTOR_DB_SIZE_TTL = 3600  # 磁盘占用超过该时间（秒）重新计算；构建和替换时会立即标记为待计算
+VECTOR_DB_TOUCH_INTERVAL = 60  # 最近使用时间的最小更新间隔（秒），避免每次加载都重写清单
+VECTOR_DB_LEFTOVER_MARKERS = ("_backup_", "_new_", "_deleted_", "_old_")  # 替换、删除后残留的目录
+VECTOR_DB_SIZE_BATCH = 20  # 后台计算磁盘占用时每计算多少个目录写一次清单
+
+@st.cache_resource(show_spinner=False)
+def get_vector_db_inventory_state() -> Dict[str, Any]:
+    """本进程的清单状态（Streamlit 重跑脚本时保持不变，更新间隔和单个后台线程的限制才能跨重跑生效）
+
+    lock: 清单读写锁；last_touch: 数据库目录名 -> 本进程最近一次写入使用时间的时刻；
+    size_thread: 计算磁盘占用的后台线程
     """
+    return {"lock": threading.RLock(), "last_touch": {}, "size_thread": None}
+
+def classify_vector_db_dir(name: str) -> str:
+    """按目录名区分正式数据库（database）、未完成的构建目录（building）和残留目录（leftover）"""
+    if name.endswith("_building"):
+        return "building"
+    if any(marker in name for marker in VECTOR_DB_LEFTOVER_MARKERS):
+        return "leftover"
+    return "database"
+
+def _vector_db_inventory_key(db_path: str) -> str:
+    return os.path.basename(os.path.normpath(db_path))
+
+def _read_vector_db_inventory() -> Dict[str, Dict[str, Any]]:
     try:
-        # 优先使用新版本的包
-        try:
-            from langchain_huggingface import HuggingFaceEmbeddings
-        except ImportError:
-            from langchain_community.embeddings import HuggingFaceEmbeddings
-        
+        with open(VECTOR_DB_INVENTORY_FILE, 'r', encoding='utf-8') as f:
+            databases = json.load(f).get("databases", {})
+        return databases if isinstance(databases, dict) else {}
+    except Exception:
+        return {}
+
+def _update_vector_db_inventory(update) -> Dict[str, Dict[str, Any]]:
+    """读取-修改-写回清单（进程内线程锁 + 跨进程文件锁）
+
+    update 接收清单字典并原地修改，返回 False 表示没有变化、不需要写回。
+    清单只是缓存，锁超时或写入失败时只打印警告，不影响调用方。
+    """
+    with get_vector_db_inventory_state()["lock"]:
         try:
-            from langchain_chroma import Chroma
-        except ImportError:
-            from langchain_community.vectorstores import Chroma
-        
-        db_path = get_vector_db_path(folder_path) if folder_path else "./chroma_db"
-        
-        if not os.path.exists(db_path):
-            return None, None
-        
-        if progress_callback:
-            progress_callback(10, "🔄 正在加载已有向量数据库...")
-        
-        # 初始化嵌入模型（必须与创建时使用相同的模型）
-        # 优先使用本地模型路径，避免网络下载
-        embedding_model = load_embedding_model_config()
-        model_path = get_model_path(embedding_model)
-        embeddings = HuggingFaceEmbeddings(
-            model_name=model_path,
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
-        )
+            with vector_db_lock(VECTOR_DB_INVENTORY_FILE, timeout=5):
+                databases = _read_vector_db_inventory()
+                if update(databases) is not False:
+                    os.makedirs(os.path.dirname(VECTOR_DB_INVENTORY_FILE), exist_ok=True)
+                    _write_json_atomic(VECTOR_DB_INVENTORY_FILE, {"version": 1, "databases": databases})
+                return databases
+        except Exception as e:
+            print(f"[WARN] 更新向量数据库清单失败: {str(e)}")
+            return _read_vector_db_inventory()
+
+def _describe_vector_db_dir(db_path: str) -> Dict[str, Any]:
+    """从数据库目录的签名文件生成清单条目（不遍历目录，磁盘占用留给后台计算）"""
+    name = _vector_db_inventory_key(db_path)
+    signature = {}
+    try:
+        with open(os.path.join(db_path, ".docs_signature.json"), 'r', encoding='utf-8') as f:
+            signature = json.load(f)
+    except Exception:
+        pass
+    try:
+        modified_at = os.path.getmtime(db_path)
+    except OSError:
+        modified_at = None
+    return {
+        "db_path": os.path.normpath(db_path),
+        "kind": classify_vector_db_dir(name),
+        "folder_path": signature.get("folder_path"),
+        "embedding_model": signature.get("embedding_model"),
+        "embedding_dimension": signature.get("embedding_dimension"),
+        "chunk_count": signature.get("chunk_count"),
+        "file_count": signature.get("file_count"),
+        "created_at": signature.get("created_at"),
+        "build_status": signature.get("build_status"),
+        "vector_backend": detect_vector_backend(db_path),
+        "modified_at": modified_at,
+        "size_bytes": None,
+        "size_scanned_at": None,
+        "last_used_at": None,
+    }
+
+def record_vector_db(db_path: str, **fields):
+    """数据库构建或替换完成后更新清单条目（保留原有的使用时间，磁盘占用标记为待计算）
+
+    Args:
+        db_path: 向量数据库目录
+        **fields: 签名中没有的信息（如上传文件构建的数据库的模型和文本块数），值为 None 的字段被忽略
+    """
+    import time
+    
+    name = _vector_db_inventory_key(db_path)
+    entry = _describe_vector_db_dir(db_path)
+    entry.update({key: value for key, value in fields.items() if value is not None})
+    
+    def update(databases):
+        previous = databases.get(name) or {}
+        entry["last_used_at"] = previous.get("last_used_at") or time.time()
+        databases[name] = entry
+    
+    _update_vector_db_inventory(update)
+    get_vector_db_inventory_state()["last_touch"][name] = time.time()
+
+def forget_vector_db(db_path: str):
+    """数据库目录被删除后移除清单条目"""
+    name = _vector_db_inventory_key(db_path)
+    get_vector_db_inventory_state()["last_touch"].pop(name, None)
+    _update_vector_db_inventory(lambda databases: databases.pop(name, None) is not None)
+
+def touch_vector_db(db_path: str):
+    """记录数据库最近一次被加载使用的时间（同一进程内每个数据库最多每 VECTOR_DB_TOUCH_INTERVAL 秒写一次）"""
+    import time
+    
+    name = _vector_db_inventory_key(db_path)
+    now = time.time()
+    last_touch = get_vector_db_inventory_state()["last_touch"]
+    if now - last_touch.get(name, 0) < VECTOR_DB_TOUCH_INTERVAL:
+        return
+    last_touch[name] = now
+    
+    def update(databases):
+        entry = databases.get(name)
+        if entry is None:
+            if not os.path.isdir(db_path):
+                return False
+            entry = databases[name] = _describe_vector_db_dir(db_path)
+        entry["last_used_at"] = now
+    
+    _update_vector_db_inventory(update)
+
+def load_vector_db_inventory(reconcile: bool = True) -> List[Dict[str, Any]]:
+    """读取向量数据库清单
+
+    reconcile 为 True 时与 ./chroma_db 下的目录列表核对：只列出顶层目录、读取新目录的签名，
+    不遍历数据库文件，数据库很多时也很快。其他程序或手动增删的目录会在这里被补录或移除。
+
+    Returns:
+        清单条目列表（每项包含 name 字段），按最近使用时间倒序
+    """
+    root = os.path.dirname(VECTOR_DB_INVENTORY_FILE)
+    if reconcile:
+        try:
+            names = {entry.name for entry in os.scandir(root) if entry.is_dir()}
+        except OSError:
+            names = set()
+        
+        def update(databases):
+            for name in set(databases) - names:
+                del databases[name]
+            for name in names - set(databases):
+                databases[name] = _describe_vector_db_dir(os.path.join(root, name))
+        
+        databases = _read_vector_db_inventory()
+        if set(databases) != names:
+            databases = _update_vector_db_inventory(update)
+    else:
+        databases = _read_vector_db_inventory()
+    
+    entries = [dict(entry, name=name) for name, entry in databases.items()]
+    entries.sort(key=lambda entry: entry.get("last_used_at") or entry.get("modified_at") or 0, reverse=True)
+    return entries
+
+def compute_directory_size(path: str) -> int:
+    """目录下所有文件的总字节数（遍历过程中被删除的文件忽略）"""
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+def refresh_vector_db_sizes(blocking: bool = False, max_age: float = VECTOR_DB_SIZE_TTL) -> int:
+    """计算缺少或过期的数据库磁盘占用
+
+    默认在后台线程中计算（同一进程内同时只有一个线程），每算完 VECTOR_DB_SIZE_BATCH 个目录写一次清单，
+    界面下次读取清单时即可看到已完成的部分。
+
+    Args:
+        blocking: 是否在当前线程中计算完成后再返回（命令行使用）
+        max_age: 超过该时间（秒）的磁盘占用视为过期
+
+    Returns:
+        需要计算的数据库数量
+    """
+    import time
+    
+    root = os.path.dirname(VECTOR_DB_INVENTORY_FILE)
+    now = time.time()
+    pending = [name for name, entry in _read_vector_db_inventory().items()
+               if entry.get("size_bytes") is None or now - (entry.get("size_scanned_at") or 0) > max_age]
+    if not pending:
+        return 0
+    
+    def apply(sizes):
+        def update(databases):
+            for name, size in sizes.items():
+                if name in databases:
+                    databases[name].update(size_bytes=size, size_scanned_at=time.time())
+        _update_vector_db_inventory(update)
+    
+    def worker():
+        sizes = {}
+        for name in pending:
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                sizes[name] = compute_directory_size(path)
+            if len(sizes) >= VECTOR_DB_SIZE_BATCH:
+                apply(sizes)
+                sizes = {}
+        if sizes:
+            apply(sizes)
+    
+    if blocking:
+        worker()
+    else:
+        state = get_vector_db_inventory_state()
+        with state["lock"]:
+            if state["size_thread"] is None or not state["size_thread"].is_alive():
+                state["size_thread"] = threading.Thread(target=worker, name="vector-db-size", daemon=True)
+                state["size_thread"].start()
+    return len(pending)
+
+def summarize_vector_db_inventory(entries: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """汇总清单：正式数据库数量、已知的总磁盘占用、尚未计算的数量，以及残留目录的数量和占用"""
+    databases = [entry for entry in entries if entry.get("kind") == "database"]
+    others = [entry for entry in entries if entry.get("kind") != "database"]
+    return {
+        "count": len(databases),
+        "size_bytes": sum(entry.get("size_bytes") or 0 for entry in databases),
+        "pending": sum(1 for entry in entries if entry.get("size_bytes") is None),
+        "leftover_count": len(others),
+        "leftover_size_bytes": sum(entry.get("size_bytes") or 0 for entry in others),
+    }
+
+# 向量数据库磁盘配额模块（超出配额时按最近最少使用的顺序删除数据库，并清理替换、删除后残留的目录）
+VECTOR_DB_GC_DEFAULTS = {
+    "enabled": True,
+    "quota_mb": 2048,  # chroma_db 目录的磁盘配额，0 表示不限制（仍会清理残留目录）
+    "leftover_grace_seconds": 3600,  # 残留目录超过该时间才删除，避免与正在进行的替换操作冲突
+    "interval_seconds": 600,  # 同一进程内两次自动清理的最小间隔
+}
+VECTOR_DB_GC_LOCK = os.path.join("./chroma_db", ".gc")  # 多个进程同时只有一个执行清理
+
+@st.cache_resource(show_spinner=False)
+def get_vector_db_gc_state() -> Dict[str, Any]:
+    """本进程的自动清理状态（Streamlit 重跑脚本时保持不变，清理间隔和上次清理结果才能跨重跑生效）"""
+    return {"thread": None, "last_started": 0.0, "last_result": None, "lock": threading.Lock()}
+
+def load_vector_db_gc_config() -> Dict[str, Any]:
+    """从本地配置文件加载磁盘配额配置（配置项 "vector_db_gc"，未设置的字段使用默认值）"""
+    config = dict(VECTOR_DB_GC_DEFAULTS)
+    try:
+        custom = read_config_file().get("vector_db_gc") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+def _vector_db_dir_timestamp(entry: Dict[str, Any]) -> float:
+    """残留目录的产生时间：优先取目录名中的时间戳（毫秒），否则使用目录的修改时间"""
+    import re
+    
+    match = re.search(r"_(?:backup|new|deleted|old)_(\d{10,13})", entry["name"])
+    if match:
+        value = int(match.group(1))
+        return value / 1000 if value > 10 ** 11 else float(value)
+    return entry.get("modified_at") or 0.0
+
+def _vector_db_lock_recently_refreshed(db_path: str) -> bool:
+    """数据库的锁文件是否存在且在 VECTOR_DB_LOCK_STALE_SECONDS 内被刷新过（持有者仍在运行）"""
+    import time
+    
+    try:
+        return time.time() - os.path.getmtime(_vector_db_lock_file(db_path)) < VECTOR_DB_LOCK_STALE_SECONDS
+    except OSError:
+        return False
+
+def _vector_db_build_in_progress(entry: Dict[str, Any], grace_seconds: float) -> bool:
+    """构建目录是否可能仍在使用：锁文件仍在刷新，或目录在宽限期内有改动
+
+    新的构建目录没有 last_used_at，按修改时间排序会和真正过期的数据库排在一起，
+    因此不能只依赖排序和能否拿到锁来判断。
+    """
+    import time
+    
+    if _vector_db_lock_recently_refreshed(entry["db_path"]):
+        return True
+    try:
+        return time.time() - os.path.getmtime(entry["db_path"]) <= grace_seconds
+    except OSError:
+        return False
+
+def collect_vector_db_garbage(quota_mb: float = None, dry_run: bool = False,
+                              protected_paths: set = None) -> Dict[str, Any]:
+    """按磁盘配额清理向量数据库目录
+
+    1. 超过宽限期的残留目录（_backup_/_new_/_deleted_/_old_）直接删除；
+    2. 总占用仍超出配额时，未完成的构建目录和数据库按最近使用时间从旧到新删除，直到回到配额以内。
+       正在被会话或服务使用、正在构建（锁文件仍在刷新）的数据库和构建目录会被跳过。
+
+    Args:
+        quota_mb: 磁盘配额（MB），默认使用配置值
+        dry_run: 只返回清理计划，不删除
+        protected_paths: 额外不允许删除的数据库目录
+
+    Returns:
+        清理结果（配额、清理前后的占用、删除和跳过的目录）
+    """
+    import contextlib
+    import shutil
+    import time
+    
+    config = load_vector_db_gc_config()
+    quota_mb = config["quota_mb"] if quota_mb is None else quota_mb
+    quota_bytes = quota_mb * 1024 * 1024
+    result = {"quota_mb": quota_mb, "dry_run": dry_run, "removed": [], "skipped": []}
+    if not os.path.isdir(os.path.dirname(VECTOR_DB_GC_LOCK)):
+        result.update(total_mb_before=0.0, total_mb_after=0.0)
+        return result
+    
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(vector_db_lock(VECTOR_DB_GC_LOCK, timeout=0))
+        except VectorDBLockTimeout:
+            result["busy"] = True
+            return result
+        load_vector_db_inventory()
+        refresh_vector_db_sizes(blocking=True)
+        entries = load_vector_db_inventory(reconcile=False)
+        total = sum(entry.get("size_bytes") or 0 for entry in entries)
+        result["total_mb_before"] = round(total / (1024 * 1024), 2)
+        
+        protected = {os.path.normcase(os.path.abspath(path)) for path in (protected_paths or ())}
+        protected |= get_vector_store_registry().in_use_paths()
+        
+        def remove(entry, reason):
+            nonlocal total
+            path = entry["db_path"]
+            if not dry_run:
+                if entry["kind"] == "leftover":
+                    shutil.rmtree(path, ignore_errors=True)
+                    if os.path.exists(path):
+                        return False
+                    forget_vector_db(path)
+                elif entry["kind"] == "building":
+                    try:
+                        with vector_db_lock(path, timeout=0):
+                            if not _remove_db_dir(path):
+                                return False
+                        forget_vector_db(path)
+                    except VectorDBLockTimeout:
+                        return False
+                elif not cleanup_corrupted_db(path, force=False):
+                    return False
+            total -= entry.get("size_bytes") or 0
+            result["removed"].append({
+                "name": entry["name"],
+                "kind": entry["kind"],
+                "folder_path": entry.get("folder_path"),
+                "size_mb": round((entry.get("size_bytes") or 0) / (1024 * 1024), 2),
+                "reason": reason
+            })
+            return True
+        
+        now = time.time()
+        for entry in entries:
+            if entry["kind"] == "leftover" and now - _vector_db_dir_timestamp(entry) > config["leftover_grace_seconds"]:
+                if not remove(entry, "残留目录"):
+                    result["skipped"].append(entry["name"])
+        
+        if quota_bytes > 0 and total > quota_bytes:
+            candidates = [entry for entry in entries if entry["kind"] in ("database", "building")]
+            candidates.sort(key=lambda entry: entry.get("last_used_at") or entry.get("modified_at") or 0)
+            for entry in candidates:
+                if total <= quota_bytes:
+                    break
+                if os.path.normcase(os.path.abspath(entry["db_path"])) in protected:
+                    result["skipped"].append(entry["name"])
+                    continue
+                if entry["kind"] == "building" and _vector_db_build_in_progress(entry, config["leftover_grace_seconds"]):
+                    result["skipped"].append(entry["name"])
+                    continue
+                if not remove(entry, "超出磁盘配额"):
+                    result["skipped"].append(entry["name"])
+        
+        result["total_mb_after"] = round(total / (1024 * 1024), 2)
+    
+    if result["removed"] and not dry_run:
+        print(f"[INFO] 向量数据库清理: 删除 {len(result['removed'])} 个目录，"
+              f"占用 {result['total_mb_before']:.1f} MB -> {result['total_mb_after']:.1f} MB（配额 {quota_mb} MB）")
+    return result
+
+def start_vector_db_gc(force: bool = False) -> bool:
+    """在后台线程中执行磁盘配额清理（同一进程内同时只有一个线程，两次清理之间至少间隔 interval_seconds）
+
+    Returns:
+        是否启动了新的清理
+    """
+    import time
+    
+    config = load_vector_db_gc_config()
+    if not config["enabled"] and not force:
+        return False
+    state = get_vector_db_gc_state()
+    
+    def worker():
+        try:
+            state["last_result"] = dict(collect_vector_db_garbage(), finished_at=time.time())
+        except Exception as e:
+            print(f"[WARN] 向量数据库清理失败: {str(e)}")
+    
+    with state["lock"]:
+        if state["thread"] is not None and state["thread"].is_alive():
+            return False
+        if not force and time.time() - state["last_started"] < config["interval_seconds"]:
+            return False
+        state["last_started"] = time.time()
+        state["thread"] = threading.Thread(target=worker, name="vector-db-gc", daemon=True)
+        state["thread"].start()
+    return True
+
+def last_vector_db_gc_result() -> Optional[Dict[str, Any]]:
+    """本进程最近一次自动清理的结果（没有执行过时返回 None）"""
+    return get_vector_db_gc_state()["last_result"]
+
+# 共享向量数据库模块（同一进程内所有会话共用只读的向量数据库对象）
+VECTOR_STORE_CACHE_BUDGET_MB = 1024  # 空闲向量数据库的内存预算，超出后按最近最少使用淘汰
+
+def load_vector_store_cache_budget() -> int:
+    """从本地配置文件加载共享向量数据库的内存预算（MB）"""
+    try:
+        return int(read_config_file().get("vector_store_cache_mb", VECTOR_STORE_CACHE_BUDGET_MB))
+    except Exception:
+        pass
+    return VECTOR_STORE_CACHE_BUDGET_MB
+
+def _read_vector_db_generation(db_path: str) -> str:
+    """读取数据库的构建时间戳，数据库被重建替换后时间戳随之变化"""
+    try:
+        with open(os.path.join(db_path, ".docs_signature.json"), 'r', encoding='utf-8') as f:
+            return json.load(f).get("created_at", "")
+    except Exception:
+        # 没有签名的数据库（如上传文件）用目录的修改时间区分不同的构建
+        try:
+            return str(os.path.getmtime(db_path))
+        except OSError:
+            return ""
+
+def _estimate_vector_db_memory(db_path: str) -> int:
+    """估算数据库加载后占用的内存（字节）
+
+    chromadb 会把每个段目录中的 HNSW 索引文件整体读入内存，chroma.sqlite3 则按需读取，
+    因此以段目录下文件的总大小作为估算值。NumPy 索引检索时会扫描整个向量文件，以向量文件大小作为估算值。
+    """
+    if detect_vector_backend(db_path) == "numpy":
+        try:
+            return os.path.getsize(os.path.join(db_path, "vectors.f32"))
+        except OSError:
+            return 0
+    total = 0
+    try:
+        for entry in os.scandir(db_path):
+            if entry.is_dir():
+                total += sum(f.stat().st_size for f in Path(entry.path).rglob('*') if f.is_file())
+    except OSError:
+        pass
+    return total
+
+def _drop_chroma_system_cache(db_path: str):
+    """让 chromadb 不再复用该路径上已缓存的客户端
+
+    chromadb 在进程内按持久化路径缓存客户端，数据库目录被替换后，
+    同一路径的新客户端必须重新打开文件，否则会读到旧数据库的索引。
+    已经拿到旧客户端的对象不受影响，仍可继续查询。
+    """
+    try:
+        from chromadb.api.client import SharedSystemClient
+        for attr in ("_identifier_to_system", "_identifer_to_system"):
+            systems = getattr(SharedSystemClient, attr, None)
+            if isinstance(systems, dict):
+                systems.pop(db_path, None)
+                systems.pop(os.path.abspath(db_path), None)
+    except Exception:
+        pass
+
+def _close_vector_store(vectorstore):
+    """关闭向量数据库对象持有的 chromadb 客户端，释放索引占用的内存和文件句柄"""
+    if isinstance(vectorstore, NumpyVectorStore):
+        vectorstore.close()
+        return
+    try:
+        vectorstore._client._system.stop()
+    except Exception:
+        pass
+
+def _current_session_id() -> str:
+    """当前 Streamlit 会话的ID（不在 Streamlit 中运行时视为同一个持有者）
+
+    同一进程中有多个线程并发检索时（HTTP 服务），调用方应使用 new_vector_store_holder()
+    为每个请求单独登记持有者，并在请求结束时 release()。
+    """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except Exception:
+        pass
+    return "process"
+
+def _active_session_ids() -> Optional[set]:
+    """当前仍然连接的会话ID，无法获取时返回 None（此时不清理持有者）"""
+    try:
+        from streamlit.runtime import Runtime
+        session_mgr = Runtime.instance()._session_mgr
+        return {info.session.id for info in session_mgr.list_active_sessions()}
+    except Exception:
+        return None
+
+def new_vector_store_holder(name: str) -> str:
+    """为非 Streamlit 调用方（服务请求、后台任务）生成唯一的持有者ID，以 "process" 开头不会被当作已断开的会话清理"""
+    import uuid
+    return f"process:{name}:{uuid.uuid4().hex}"
+
+class VectorStoreRegistry:
+    """进程级的向量数据库注册表
+
+    以 (数据库路径, 构建时间戳) 为键缓存向量数据库对象，多个会话加载同一文件夹时共用一个客户端，
+    避免每个会话在内存中各保存一份 HNSW 索引。每个会话同时只持有一个数据库；
+    没有会话持有的数据库在总内存超出预算时按最近最少使用的顺序释放。
+    """
+    def __init__(self, budget_mb: int = VECTOR_STORE_CACHE_BUDGET_MB):
+        import threading
+        from collections import OrderedDict
+        
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # 键 -> {"vectorstore", "db_path", "holders", "size"}
+        self._holder_keys = {}  # 会话ID -> 键
+
+    @staticmethod
+    def make_key(db_path: str) -> Tuple[str, str]:
+        return (os.path.normcase(os.path.abspath(db_path)), _read_vector_db_generation(db_path))
+
+    def acquire(self, db_path: str, holder: str = None):
+        """获取已缓存的向量数据库并登记持有者，未缓存时返回 None"""
+        holder = holder or _current_session_id()
+        key = self.make_key(db_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._hold(key, holder)
+            return entry["vectorstore"]
+
+    def register(self, db_path: str, vectorstore, holder: str = None):
+        """登记新打开的向量数据库，返回实际共用的对象（并发加载时以先登记的为准）"""
+        holder = holder or _current_session_id()
+        key = self.make_key(db_path)
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is None:
+                self._entries[key] = {
+                    "vectorstore": vectorstore,
+                    "db_path": db_path,
+                    "holders": set(),
+                    "size": _estimate_vector_db_memory(db_path)
+                }
+            elif existing["vectorstore"] is not vectorstore and \
+                    getattr(getattr(existing["vectorstore"], "_client", None), "_system", None) is not \
+                    getattr(getattr(vectorstore, "_client", None), "_system", object()):
+                # 并发加载时后打开的对象没有登记，关闭它释放索引内存（与先登记的共用同一 chromadb 客户端时不能关闭）
+                _close_vector_store(vectorstore)
+            self._hold(key, holder)
+            self._enforce_budget()
+            return self._entries[key]["vectorstore"]
+
+    def prepare_open(self, db_path: str):
+        """打开未缓存的数据库之前调用：数据库已被重建时丢弃旧版本
+
+        旧版本不再接受新的持有者，空闲时直接释放；仍被其他会话使用的旧版本在释放后淘汰。
+        """
+        path_key = os.path.normcase(os.path.abspath(db_path))
+        with self._lock:
+            old_keys = [k for k in self._entries if k[0] == path_key]
+            if old_keys:
+                _drop_chroma_system_cache(db_path)
+            for key in old_keys:
+                if not self._entries[key]["holders"]:
+                    self._evict(key)
+
+    def release(self, holder: str = None):
+        """释放会话持有的向量数据库"""
+        holder = holder or _current_session_id()
+        with self._lock:
+            key = self._holder_keys.pop(holder, None)
+            if key in self._entries:
+                self._entries[key]["holders"].discard(holder)
+            self._enforce_budget()
+
+    def invalidate(self, db_path: str):
+        """数据库目录被删除时释放该路径上所有缓存的对象"""
+        path_key = os.path.normcase(os.path.abspath(db_path))
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == path_key]:
+                self._evict(key)
+
+    def in_use_paths(self) -> set:
+        """仍有会话持有的数据库目录（规范化的绝对路径），磁盘配额清理时跳过"""
+        with self._lock:
+            return {key[0] for key, entry in self._entries.items() if entry["holders"]}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "count": len(self._entries),
+                "in_use": sum(1 for e in self._entries.values() if e["holders"]),
+                "memory_mb": sum(e["size"] for e in self._entries.values()) / (1024 * 1024),
+                "budget_mb": self.budget_bytes / (1024 * 1024)
+            }
+
+    def _hold(self, key, holder: str):
+        previous = self._holder_keys.get(holder)
+        if previous is not None and previous != key and previous in self._entries:
+            self._entries[previous]["holders"].discard(holder)
+        self._holder_keys[holder] = key
+        self._entries[key]["holders"].add(holder)
+        self._entries.move_to_end(key)
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        for holder in entry["holders"]:
+            self._holder_keys.pop(holder, None)
+        if not any(k[0] == key[0] for k in self._entries):
+            # 该路径已没有其他版本，chromadb 的缓存只会引用这个客户端
+            _drop_chroma_system_cache(entry["db_path"])
+        _close_vector_store(entry["vectorstore"])
+        print(f"[INFO] 已释放共享向量数据库: {entry['db_path']}")
+
+    def _enforce_budget(self):
+        # 已断开的会话不会主动释放，淘汰前先清理它们的持有记录
+        active = _active_session_ids()
+        if active is not None:
+            for holder in [h for h in self._holder_keys if h not in active and not h.startswith("process")]:
+                key = self._holder_keys.pop(holder)
+                if key in self._entries:
+                    self._entries[key]["holders"].discard(holder)
+        
+        total = sum(e["size"] for e in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.budget_bytes:
+                break
+            entry = self._entries[key]
+            if not entry["holders"]:
+                total -= entry["size"]
+                self._evict(key)
+
+@st.cache_resource(show_spinner=False)
+def get_vector_store_registry() -> VectorStoreRegistry:
+    """获取进程级的向量数据库注册表（Streamlit 重跑脚本时保持不变）"""
+    return VectorStoreRegistry(load_vector_store_cache_budget())
+
+def load_existing_vector_store(folder_path: str = None, progress_callback=None, holder: str = None):
+    """加载已有的向量数据库
+    
+    Args:
+        folder_path: 文件夹路径（用于确定向量数据库位置）
+        progress_callback: 进度回调函数，接收 (progress, message) 参数
+        holder: 在共享注册表中登记的持有者（默认为当前 Streamlit 会话），用完后调用 release(holder)
+    
+    Returns:
+        (向量数据库对象, 错误详情字典)
+        如果成功：返回 (vectorstore, None)
+        如果失败：返回 (None, error_detail) 其中 error_detail 包含详细的错误信息
+    """
+    try:
+        db_path = get_vector_db_path(folder_path)
+        
+        if not os.path.exists(db_path):
+            return None, None
+        
+        # 其他会话已经加载过同一版本的数据库时直接共用
+        registry = get_vector_store_registry()
+        shared_vectorstore = registry.acquire(db_path, holder)
+        if shared_vectorstore is not None:
+            if progress_callback:
+                progress_callback(100, "✅ 向量数据库加载完成！")
+            print(f"✅ 复用已加载的向量数据库: {db_path}")
+            touch_vector_db(db_path)
+            return shared_vectorstore, None
+        registry.prepare_open(db_path)
+        
+        if progress_callback:
+            progress_callback(10, "🔄 正在加载已有向量数据库...")
+        
+        # 先根据元数据检查数据库（签名、维度、文本块数量），不需要加载嵌入模型
+        integrity = inspect_vector_db(db_path)
+        if integrity["status"] == "stale":
+            # 数据库本身完好，只是与当前设置不匹配：不加载也不删除（切换回原设置后仍可使用），重新构建时原子替换
+            print(f"⚠️ 向量数据库需要重新构建: {integrity['reason']}")
+            if progress_callback:
+                progress_callback(100, f"⚠️ 向量数据库需要重新构建（{integrity['reason']}）")
+            return None, {
+                'type': 'StaleIndex',
+                'message': f"{integrity['reason']}，请重新建立索引",
+                'stage': '元数据校验'
+            }
+        if integrity["status"] == "corrupted":
+            print(f"⚠️ 向量数据库不可用: {integrity['reason']}，正在清理...")
+            if progress_callback:
+                progress_callback(100, f"⚠️ 向量数据库不可用（{integrity['reason']}），正在清理...")
+            cleanup_corrupted_db(db_path, force=True)
+            return None, {
+                'type': 'IntegrityError',
+                'message': integrity['reason'],
+                'stage': '元数据校验'
+            }
+        
+        # 嵌入模型必须与创建时相同，在第一次检索时才加载
+        embeddings = LazyEmbeddings(load_embedding_model_config())
         
         if progress_callback:
             progress_callback(50, "🔄 正在加载向量数据库...")
@@ -1073,10 +2222,7 @@ def load_existing_vector_store(folder_path: str = None, progress_callback=None):
         # 从持久化目录加载
         load_error_detail = None
         try:
-            vectorstore = Chroma(
-                persist_directory=db_path,
-                embedding_function=embeddings
-            )
+            vectorstore = open_vector_store(db_path, embeddings)
         except Exception as load_error:
             # 加载失败，记录详细错误信息
             load_error_detail = {
@@ -1107,6 +2253,15 @@ def load_existing_vector_store(folder_path: str = None, progress_callback=None):
                     progress_callback(100, "❌ 向量数据库加载失败")
             return None, load_error_detail
         
+        if integrity["status"] == "ok":
+            # 元数据校验已通过，不再执行测试查询（避免在加载时就初始化嵌入模型）
+            if progress_callback:
+                progress_callback(100, "✅ 向量数据库加载完成！")
+            print(f"✅ 向量数据库元数据校验通过（{integrity['count']} 个文本块），已加载 {db_path}")
+            touch_vector_db(db_path)
+            return registry.register(db_path, vectorstore, holder), None
+        print(f"[INFO] 无法根据元数据校验向量数据库（{integrity['reason']}），改用测试查询验证")
+        
         # 验证向量数据库是否可用（使用兼容的验证方法）
         # 注意：新版本的 ChromaDB 可能不支持 len()，改用直接查询的方式验证
         verify_error_detail = None
@@ -1124,7 +2279,8 @@ def load_existing_vector_store(folder_path: str = None, progress_callback=None):
                 if progress_callback:
                     progress_callback(100, "✅ 向量数据库加载完成！")
                 print(f"✅ 向量数据库验证成功，已加载 {db_path}")
-                return vectorstore, None
+                touch_vector_db(db_path)
+                return registry.register(db_path, vectorstore, holder), None
                 
             except Exception as query_error:
                 # 查询失败，记录详细错误
@@ -1182,7 +2338,8 @@ def load_existing_vector_store(folder_path: str = None, progress_callback=None):
                     if progress_callback:
                         progress_callback(100, "✅ 向量数据库加载完成（跳过 len() 验证）")
                     print(f"✅ 向量数据库验证成功（通过查询验证），已加载 {db_path}")
-                    return vectorstore, None
+                    touch_vector_db(db_path)
+                    return registry.register(db_path, vectorstore, holder), None
                 except Exception as query_error:
                     # 查询也失败，说明数据库真的有问题
                     verify_error_detail = {
@@ -1218,7 +2375,8 @@ def load_existing_vector_store(folder_path: str = None, progress_callback=None):
         if progress_callback:
             progress_callback(100, "✅ 向量数据库加载完成！")
         
-        return vectorstore, None
+        touch_vector_db(db_path)
+        return registry.register(db_path, vectorstore, holder), None
     except Exception as e:
         # 加载失败，返回详细错误信息
         error_detail = {
@@ -1300,6 +2458,11 @@ def check_docs_changed(docs_dict: Dict[str, Any], folder_path: str) -> bool:
         with open(signature_file, 'r', encoding='utf-8') as f:
             old_signature = json.load(f)
         
+        # 上次构建未完成（被中断），需要继续构建
+        if old_signature.get("build_status", "complete") != "complete":
+            print(f"[INFO] 上次向量数据库构建未完成: {db_path}")
+            return True
+        
         # 检查嵌入模型是否变化
         current_embedding_model = load_embedding_model_config()
         old_embedding_model = old_signature.get("embedding_model", "BAAI/bge-small-zh-v1.5")
@@ -1432,7 +2595,7 @@ def check_docs_changed(docs_dict: Dict[str, Any], folder_path: str) -> bool:
         # 数据库的可用性由 load_existing_vector_store 来验证
         try:
             # 只检查数据库文件是否存在
-            chroma_sqlite = os.path.join(db_path, "chroma.sqlite3")
+            chroma_sqlite = vector_db_data_file(db_path)
             if not os.path.exists(chroma_sqlite):
                 print(f"[INFO] 数据库文件不存在: {chroma_sqlite}")
                 return True  # 数据库文件不存在，需要重新创建
@@ -1474,15 +2637,41 @@ def get_embedding_model_dimension(model_name: str) -> int:
     }
     return model_dimensions.get(model_name, 384)  # 默认384
 
-def save_docs_signature(docs_dict: Dict[str, Any], folder_path: str):
+def _collect_file_signatures(docs_dict: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """生成签名中每个文件的信息（大小、类型，持久路径还包括完整路径和修改时间）"""
+    files = {}
+    for filename, data in docs_dict.items():
+        file_path = data.get('path', '')
+        
+        file_info = {
+            "size": data.get('size', 0),
+            "type": data.get('type', '')  # 文件类型
+        }
+        
+        # 如果文件路径存在且是持久路径（非临时路径），记录完整路径和修改时间
+        if file_path and os.path.exists(file_path):
+            # 检查是否是临时路径
+            is_temp_path = 'temp' in file_path.lower() or 'tmp' in file_path.lower()
+            if not is_temp_path:
+                # 保存完整路径（规范化后）和修改时间
+                file_info["path"] = normalize_path(file_path)  # 保存规范化后的完整路径
+                file_info["mtime"] = os.path.getmtime(file_path)
+        
+        files[filename] = file_info
+    return files
+
+def save_docs_signature(docs_dict: Dict[str, Any], folder_path: str, extra: Dict[str, Any] = None,
+                        db_path: str = None):
     """保存文档签名
-    
+
     Args:
         docs_dict: 文档字典
         folder_path: 文件夹路径
+        extra: 附加写入签名的字段（如去重统计），可选
+        db_path: 签名写入的数据库目录，默认为文件夹对应的正式目录（构建时写入临时构建目录）
     """
     try:
-        db_path = get_vector_db_path(folder_path)
+        db_path = db_path or get_vector_db_path(folder_path)
         os.makedirs(db_path, exist_ok=True)
         signature_file = os.path.join(db_path, ".docs_signature.json")
         
@@ -1496,128 +2685,1104 @@ def save_docs_signature(docs_dict: Dict[str, Any], folder_path: str):
         signature = {
             "folder_path": normalized_folder_path,  # 保存规范化后的路径
             "file_count": len(docs_dict),
-            "files": {},
+            "files": _collect_file_signatures(docs_dict),
             "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             "embedding_model": embedding_model,  # 保存使用的模型
             "embedding_dimension": embedding_dimension  # 保存模型维度
         }
-        
-        for filename, data in docs_dict.items():
-            file_path = data.get('path', '')
-            
-            file_info = {
-                "size": data.get('size', 0),
-                "type": data.get('type', '')  # 文件类型
-            }
-            
-            # 如果文件路径存在且是持久路径（非临时路径），记录完整路径和修改时间
-            if file_path and os.path.exists(file_path):
-                # 检查是否是临时路径
-                is_temp_path = 'temp' in file_path.lower() or 'tmp' in file_path.lower()
-                if not is_temp_path:
-                    # 保存完整路径（规范化后）和修改时间
-                    file_info["path"] = normalize_path(file_path)  # 保存规范化后的完整路径
-                    file_info["mtime"] = os.path.getmtime(file_path)
-            
-            signature["files"][filename] = file_info
-        
+
+        if extra:
+            signature.update(extra)
+
         with open(signature_file, 'w', encoding='utf-8') as f:
             json.dump(signature, f, indent=2, ensure_ascii=False)
     except Exception:
         pass  # 保存签名失败不影响主流程
 
-class ProgressEmbeddings:
-    """包装的嵌入模型类，用于在生成向量时更新进度"""
-    def __init__(self, embeddings, progress_callback=None, total_docs=0, start_progress=70, end_progress=85):
-        self.embeddings = embeddings
-        self.progress_callback = progress_callback
-        self.total_docs = total_docs
-        self.start_progress = start_progress
-        self.end_progress = end_progress
-        self.processed_docs = 0
-        self.batch_size = 50  # 内部批处理大小，用于进度更新
-    
-    def embed_documents(self, texts):
-        """批量生成向量，并更新进度（如果一次性处理所有文档，则内部分批处理）"""
-        total_texts = len(texts)
-        
-        # 如果文档数量较少，直接处理
-        if total_texts <= self.batch_size:
-            result = self.embeddings.embed_documents(texts)
-            self.processed_docs += total_texts
-            
-            if self.progress_callback and self.total_docs > 0:
-                progress = self.start_progress + int((self.processed_docs / self.total_docs) * (self.end_progress - self.start_progress))
-                progress = min(progress, self.end_progress)
-                self.progress_callback(progress, f"🔄 步骤 3/4: 生成向量嵌入 ({self.processed_docs}/{self.total_docs} 个文档块)...")
-            
-            return result
-        
-        # 如果文档数量较多，分批处理以显示进度
-        all_embeddings = []
-        num_batches = (total_texts + self.batch_size - 1) // self.batch_size
-        
-        for batch_idx in range(num_batches):
-            start_idx = batch_idx * self.batch_size
-            end_idx = min(start_idx + self.batch_size, total_texts)
-            batch_texts = texts[start_idx:end_idx]
-            
-            # 生成当前批次的向量
-            batch_embeddings = self.embeddings.embed_documents(batch_texts)
-            all_embeddings.extend(batch_embeddings)
-            
-            # 更新进度
-            self.processed_docs += len(batch_texts)
-            if self.progress_callback and self.total_docs > 0:
-                progress = self.start_progress + int((self.processed_docs / self.total_docs) * (self.end_progress - self.start_progress))
-                progress = min(progress, self.end_progress)
-                self.progress_callback(progress, f"🔄 步骤 3/4: 生成向量嵌入 ({self.processed_docs}/{self.total_docs} 个文档块)...")
-        
-        return all_embeddings
-    
-    def embed_query(self, text):
-        """单个查询向量化（不更新进度）"""
-        return self.embeddings.embed_query(text)
-    
-    def __getattr__(self, name):
-        """代理其他属性和方法到原始 embeddings 对象"""
-        return getattr(self.embeddings, name)
+# 文档块去重模块（在生成向量之前剔除重复和近似重复的文本块）
+DEDUP_SIMHASH_BITS = 64
+DEDUP_SHINGLE_SIZE = 3  # 字符 n-gram 大小（中文按字符切分效果较好）
+DEDUP_HAMMING_THRESHOLD = 3  # SimHash 汉明距离不超过该值视为近似重复
+
+def _dedup_key_text(text: str) -> str:
+    """生成用于去重比较的规范化文本
+
+    去掉分块时添加的 "文件: xxx" 标题行，并压缩空白字符，
+    使不同版本文件中内容相同的文本块能够得到相同的指纹。
+    """
+    lines = text.split("\n")
+    if lines and lines[0].startswith("文件: "):
+        lines = lines[1:]
+    return " ".join("\n".join(lines).split())
+
+def compute_simhash(text: str, shingle_size: int = DEDUP_SHINGLE_SIZE) -> int:
+    """计算文本的 64 位 SimHash 指纹
 
-def create_local_vector_store(docs_dict: Dict[str, Any], progress_callback=None, folder_path: str = None):
-    """创建本地向量数据库，使用开源嵌入模型
-    
     Args:
-        docs_dict: 文档字典
-        progress_callback: 进度回调函数，接收 (progress, message) 参数
-        folder_path: 文件夹路径（用于签名）
+        text: 规范化后的文本
+        shingle_size: 字符 n-gram 大小
+
+    Returns:
+        64 位整数指纹
     """
-    try:
-        # 兼容不同版本的 langchain 导入
-        try:
-            from langchain_text_splitters import RecursiveCharacterTextSplitter
-        except ImportError:
-            try:
-                from langchain.text_splitter import RecursiveCharacterTextSplitter
-            except ImportError:
-                from langchain_core.text_splitter import RecursiveCharacterTextSplitter
-        
-        # 优先使用新版本的包
-        try:
-            from langchain_huggingface import HuggingFaceEmbeddings
-        except ImportError:
-            from langchain_community.embeddings import HuggingFaceEmbeddings
+    if len(text) <= shingle_size:
+        shingles = [text]
+    else:
+        shingles = [text[i:i + shingle_size] for i in range(len(text) - shingle_size + 1)]
+
+    weights = {}
+    for shingle in shingles:
+        weights[shingle] = weights.get(shingle, 0) + 1
+
+    vector = [0] * DEDUP_SIMHASH_BITS
+    for shingle, weight in weights.items():
+        h = int.from_bytes(hashlib.md5(shingle.encode('utf-8')).digest()[:8], 'big')
+        for bit in range(DEDUP_SIMHASH_BITS):
+            if h >> bit & 1:
+                vector[bit] += weight
+            else:
+                vector[bit] -= weight
+
+    fingerprint = 0
+    for bit in range(DEDUP_SIMHASH_BITS):
+        if vector[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+class ChunkDeduplicator:
+    """流式剔除完全重复（内容哈希）和近似重复（SimHash）的文本块
+
+    被剔除的文本块不会丢失来源：保留下来的代表块会记录所有来源文件，
+    可通过 provenance_updates() 获取需要写回 metadata 的来源信息
+    （"sources" 为 JSON 字符串，"duplicate_count" 为合并的块数）。
+    内存中只保存指纹和少量来源信息，不保存文本块内容。
+    """
+    def __init__(self, near_duplicates: bool = True, hamming_threshold: int = DEDUP_HAMMING_THRESHOLD):
+        self.near_duplicates = near_duplicates
+        self.hamming_threshold = hamming_threshold
+        # 将 64 位指纹切分为 (threshold + 1) 段，汉明距离不超过阈值的两个指纹
+        # 至少有一段完全相同（鸽巢原理），因此只需比较同段桶内的候选
+        self.band_count = hamming_threshold + 1
+        self.band_width = DEDUP_SIMHASH_BITS // self.band_count
+        self.band_mask = (1 << self.band_width) - 1
+        self.total = 0
+        self.kept = 0
+        self.exact_duplicates = 0
+        self.near_duplicates_dropped = 0
+        self._exact_index = {}
+        self._band_buckets = {}
+        self._fingerprints = []
+        self._first_sources = []
+        self._merged = {}  # 代表块序号 -> (来源列表, 合并块数)，只记录发生过合并的块
+
+    def _bands(self, fingerprint: int):
+        return [(b, (fingerprint >> (b * self.band_width)) & self.band_mask) for b in range(self.band_count)]
+
+    def add(self, doc) -> Optional[int]:
+        """处理一个文本块
+
+        Returns:
+            如果是新文本块，返回其序号（从 0 开始连续编号）；如果是重复块，返回 None
+        """
+        self.total += 1
+        key_text = _dedup_key_text(doc.page_content)
+        source = doc.metadata.get("source", "")
+        content_hash = hashlib.md5(key_text.encode('utf-8')).hexdigest()
+
+        # 1. 完全重复
+        match = self._exact_index.get(content_hash)
+        fingerprint = 0
+        bands = []
+        if match is not None:
+            self.exact_duplicates += 1
+        elif self.near_duplicates and key_text:
+            # 2. 近似重复
+            fingerprint = compute_simhash(key_text)
+            bands = self._bands(fingerprint)
+            for band in bands:
+                for candidate in self._band_buckets.get(band, ()):
+                    if bin(self._fingerprints[candidate] ^ fingerprint).count("1") <= self.hamming_threshold:
+                        match = candidate
+                        break
+                if match is not None:
+                    self.near_duplicates_dropped += 1
+                    break
+
+        if match is not None:
+            sources, count = self._merged.get(match, ([self._first_sources[match]] if self._first_sources[match] else [], 1))
+            if source and source not in sources:
+                sources.append(source)
+            self._merged[match] = (sources, count + 1)
+            return None
+
+        idx = self.kept
+        self.kept += 1
+        self._first_sources.append(source)
+        self._fingerprints.append(fingerprint)
+        self._exact_index[content_hash] = idx
+        for band in bands:
+            self._band_buckets.setdefault(band, []).append(idx)
+        return idx
+
+    def provenance_updates(self) -> Dict[int, Dict[str, Any]]:
+        """返回需要写回代表块的 metadata（Chroma 只支持标量 metadata，因此来源序列化为 JSON 字符串）"""
+        return {
+            idx: {
+                "source": self._first_sources[idx],
+                "sources": json.dumps(sources, ensure_ascii=False),
+                "duplicate_count": count,
+            }
+            for idx, (sources, count) in self._merged.items()
+        }
+
+    def stats(self) -> Dict[str, int]:
+        """返回去重统计：total、kept、exact_duplicates、near_duplicates、saved_embeddings"""
+        return {
+            "total": self.total,
+            "kept": self.kept,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates_dropped,
+            "saved_embeddings": self.exact_duplicates + self.near_duplicates_dropped,
+        }
+
+# 紧凑向量存储模块（向量量化为 int8 或 float16 保存在内存映射文件中，检索后用全精度向量重新打分）
+COMPACT_VECTORS_DEFAULTS = {
+    "enabled": False,
+    "dtype": "int8",  # int8（每个向量一个缩放系数）或 float16
+    "rescore_factor": 4,  # 量化向量先取 k × rescore_factor 个候选，再用全精度向量重新打分
+    "recall_sample": 200,  # 构建时抽取多少个向量作为查询，测量相对 float32 精确检索的召回率
+}
+COMPACT_VECTORS_DIR = "compact_vectors"  # 数据库目录下的子目录
+COMPACT_SEARCH_BLOCK = 65536  # 每次反量化并计算相似度的行数，限制临时内存
+COMPACT_RECALL_K = 10
+
+@st.cache_resource(show_spinner=False)
+def get_compact_index_cache() -> Dict[str, Any]:
+    """进程级的紧凑向量索引缓存（Streamlit 重跑脚本时保持不变，内存映射不会随重跑重复打开）
+
+    entries: (数据库路径, 构建时间戳, 元数据修改时间) -> CompactVectorIndex
+    """
+    return {"entries": {}, "lock": threading.Lock()}
+
+def load_compact_vectors_config() -> Dict[str, Any]:
+    """从本地配置文件加载紧凑向量配置（配置项 "compact_vectors"，未设置的字段使用默认值）"""
+    config = dict(COMPACT_VECTORS_DEFAULTS)
+    try:
+        custom = read_config_file().get("compact_vectors") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+def quantize_vectors(vectors, dtype: str = "int8"):
+    """量化向量矩阵
+
+    Returns:
+        (codes, scales)：int8 时 scales 为每个向量的缩放系数（vector ≈ codes × scale），float16 时为 None
+    """
+    import numpy as np
+    
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"不支持的紧凑向量类型: {dtype}（可选 int8、float16）")
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def top_rows_in_blocks(block_scores, total: int, query_count: int, count: int):
+    """分块计算相似度并保留每个查询得分最高的 count 个行号（不排序）
+
+    Args:
+        block_scores: block_scores(start, end) 返回 (查询数, end - start) 的相似度矩阵
+        total: 总行数
+        query_count: 查询数
+        count: 每个查询保留的行数
+    """
+    import numpy as np
+    
+    count = min(count, total)
+    best_scores = np.empty((query_count, 0), dtype=np.float32)
+    best_rows = np.empty((query_count, 0), dtype=np.int64)
+    for start in range(0, total, COMPACT_SEARCH_BLOCK):
+        end = min(start + COMPACT_SEARCH_BLOCK, total)
+        scores = np.concatenate([best_scores, block_scores(start, end)], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (query_count, end - start))], axis=1)
+        if scores.shape[1] > count:
+            keep = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+            scores = np.take_along_axis(scores, keep, axis=1)
+            rows = np.take_along_axis(rows, keep, axis=1)
+        best_scores, best_rows = scores, rows
+    return best_rows
+
+class FullPrecisionVectors:
+    """向量库自身保存的全精度向量（紧凑向量重新打分和测量召回率时读取，不另存 float32 副本）
+
+    NumPy 后端直接读取 vectors.f32 的内存映射；Chroma 通过 collection.get(include=["embeddings"]) 读取。
+    按 ID 读取，不依赖 collection.get 按 offset 分页返回的顺序（Chroma 不保证与插入顺序一致）。
+    """
+    def __init__(self, vectorstore):
+        self.collection = vectorstore._collection
+
+    def _numpy_vectors(self):
+        return self.collection.vectors if isinstance(self.collection, NumpyVectorStore) else None
+
+    def by_ids(self, ids: List[str]):
+        """按文本块ID读取向量，返回 (找到的ID列表, 向量矩阵)"""
+        import numpy as np
+        
+        vectors = self._numpy_vectors()
+        if vectors is not None:
+            rows = self.collection._rows_for_ids(ids)
+            found_ids = [chunk_id for chunk_id in ids if chunk_id in (self.collection._id_rows or {})]
+            order = np.argsort(rows)  # 按行号顺序读取内存映射文件
+            matrix = np.empty((len(rows), vectors.shape[1]), dtype=np.float32)
+            matrix[order] = np.asarray(vectors[np.asarray(rows, dtype=np.int64)[order]])
+            return found_ids, matrix
+        batch = self.collection.get(ids=list(ids), include=["embeddings"])
+        by_id = dict(zip(batch["ids"], batch["embeddings"]))
+        found_ids = [chunk_id for chunk_id in ids if chunk_id in by_id]
+        return found_ids, np.asarray([by_id[chunk_id] for chunk_id in found_ids], dtype=np.float32)
+
+    def block(self, ids: List[str]):
+        """读取与 ids 一一对应的向量（分批按ID读取；缺少任何一个ID时抛出 ValueError，避免行号错位）"""
+        import numpy as np
+        
+        batch_size = INDEX_BUILD_BATCH_SIZE * 8
+        parts = []
+        for start in range(0, len(ids), batch_size):
+            batch_ids = ids[start:start + batch_size]
+            found_ids, vectors = self.by_ids(batch_ids)
+            if len(found_ids) != len(batch_ids):
+                raise ValueError("向量库中缺少紧凑向量记录的文本块，请重新生成紧凑向量")
+            parts.append(vectors)
+        return np.concatenate(parts) if parts else np.empty((0, 0), dtype=np.float32)
+
+    def iter_batches(self, batch_size: int):
+        """按行号顺序分批读取全部向量，生成 (ID列表, 向量矩阵)"""
+        import numpy as np
+        
+        offset = 0
+        while True:
+            batch = self.collection.get(include=["embeddings"], limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            yield batch["ids"], np.asarray(batch["embeddings"], dtype=np.float32)
+            offset += len(batch["ids"])
+
+class CompactVectorIndex:
+    """数据库目录下的紧凑向量文件（只读，按需内存映射）
+
+    codes.npy（量化向量）、scales.npy（int8 的缩放系数）、ids.json（与行号对应的文本块 ID）、
+    meta.json（类型、维度、召回率报告）。
+    检索时完整扫描的只有量化向量，常驻内存约为 float32 的 1/4（int8）或 1/2（float16）；
+    重新打分时只从向量库读取候选文本块的全精度向量（FullPrecisionVectors）。
+    """
+    def __init__(self, path: str):
+        import numpy as np
+        
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "ids.json"), 'r', encoding='utf-8') as f:
+            self.ids = json.load(f)
+        self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode='r')
+        scales_file = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_file, mmap_mode='r') if os.path.exists(scales_file) else None
+
+    @classmethod
+    def build(cls, path: str, source: FullPrecisionVectors, count: int, dtype: str = "int8",
+              recall_sample: int = COMPACT_VECTORS_DEFAULTS["recall_sample"]) -> Optional["CompactVectorIndex"]:
+        """逐批量化向量库中的向量并写入紧凑向量文件（先写到临时目录再重命名），然后测量召回率
+
+        量化结果直接写入预先分配的内存映射文件，内存中只保留一个批次的全精度向量。
+        向量库为空时返回 None。
+        """
+        import shutil
+        import numpy as np
+        
+        temp_path = f"{os.path.normpath(path)}_tmp"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        ids = []
+        codes = None
+        scales = np.ones(count, dtype=np.float32) if dtype == "int8" else None
+        for batch_ids, vectors in source.iter_batches(INDEX_BUILD_BATCH_SIZE * 8):
+            batch_ids, vectors = batch_ids[:count - len(ids)], vectors[:count - len(ids)]
+            if not batch_ids:
+                break
+            batch_codes, batch_scales = quantize_vectors(vectors, dtype)
+            if codes is None:
+                codes = np.lib.format.open_memmap(os.path.join(temp_path, "codes.npy"), mode='w+',
+                                                  dtype=batch_codes.dtype, shape=(count, vectors.shape[1]))
+            codes[len(ids):len(ids) + len(batch_ids)] = batch_codes
+            if scales is not None:
+                scales[len(ids):len(ids) + len(batch_ids)] = batch_scales
+            ids.extend(batch_ids)
+        if codes is None:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return None
+        dimension = int(codes.shape[1])
+        codes.flush()
+        codes = None  # 释放内存映射，Windows 上打开的文件所在目录无法重命名
+        if len(ids) < count:
+            # 读取期间文本块数量减少（正常情况下调用者持有数据库锁，不会发生），截掉未写入的行
+            codes = np.array(np.load(os.path.join(temp_path, "codes.npy"), mmap_mode='r')[:len(ids)])
+            np.save(os.path.join(temp_path, "codes.npy"), codes)
+            codes = None
+        if scales is not None:
+            np.save(os.path.join(temp_path, "scales.npy"), scales[:len(ids)])
+        with open(os.path.join(temp_path, "ids.json"), 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        itemsize = 1 if dtype == "int8" else 2
+        meta = {
+            "dtype": dtype,
+            "count": len(ids),
+            "dimension": dimension,
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "compact_bytes": len(ids) * dimension * itemsize + (len(ids) * 4 if scales is not None else 0),
+            "float32_bytes": len(ids) * dimension * 4,
+        }
+        with open(os.path.join(temp_path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        
+        index = cls(temp_path)
+        meta["recall"] = index.measure_recall(source, recall_sample)
+        index = None  # 释放内存映射
+        with open(os.path.join(temp_path, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(temp_path, path)
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _block_scores(self, queries, start: int, end: int):
+        import numpy as np
+        
+        scores = queries @ np.asarray(self.codes[start:end], dtype=np.float32).T
+        if self.scales is not None:
+            scores *= np.asarray(self.scales[start:end])
+        return scores
+
+    def _top_rows(self, queries, count: int):
+        """分块扫描全部量化向量，返回每个查询相似度最高的 count 个行号（不排序）"""
+        return top_rows_in_blocks(lambda start, end: self._block_scores(queries, start, end),
+                                  len(self), len(queries), count)
+
+    def search(self, query_vectors, k: int = 4, rescore_factor: int = COMPACT_VECTORS_DEFAULTS["rescore_factor"],
+               source: FullPrecisionVectors = None) -> List[List[Tuple[str, float]]]:
+        """检索多个查询向量（嵌入向量已归一化，内积即余弦相似度）
+
+        Args:
+            source: 向量库的全精度向量，传入时先取 k × rescore_factor 个候选再重新打分，否则只用量化向量
+
+        Returns:
+            与查询一一对应的 [(文本块ID, 相似度)] 列表，按相似度降序
+        """
+        import numpy as np
+        
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        if len(self) == 0:
+            return [[] for _ in queries]
+        candidate_rows = self._top_rows(queries, k * max(1, rescore_factor) if source is not None else k)
+        if source is not None:
+            # 所有查询的候选合并后一次读取全精度向量
+            wanted = list(dict.fromkeys(self.ids[row] for rows in candidate_rows for row in rows))
+            found_ids, vectors = source.by_ids(wanted)
+            positions = {chunk_id: position for position, chunk_id in enumerate(found_ids)}
+        results = []
+        for query, rows in zip(queries, candidate_rows):
+            rows = np.sort(rows)  # 按行号顺序读取内存映射文件
+            if source is not None:
+                chunk_ids = [self.ids[row] for row in rows if self.ids[row] in positions]
+                scores = vectors[[positions[chunk_id] for chunk_id in chunk_ids]] @ query \
+                    if chunk_ids else np.empty(0, dtype=np.float32)
+            else:
+                chunk_ids = [self.ids[row] for row in rows]
+                scores = np.asarray(self.codes[rows], dtype=np.float32) @ query
+                if self.scales is not None:
+                    scores *= np.asarray(self.scales[rows])
+            order = np.argsort(-scores)[:k]
+            results.append([(chunk_ids[i], float(scores[i])) for i in order])
+        return results
+
+    def exact_search(self, source: FullPrecisionVectors, query_vectors, k: int = 4):
+        """float32 全精度精确检索（召回率基准，按紧凑向量的行号对应的ID分块读取向量库的全部向量），
+        返回每个查询的前 k 个行号（不排序）"""
+        import numpy as np
+        
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        return top_rows_in_blocks(lambda start, end: queries @ source.block(self.ids[start:end]).T,
+                                  len(self), len(queries), k)
+
+    def measure_recall(self, source: FullPrecisionVectors, sample: int = COMPACT_VECTORS_DEFAULTS["recall_sample"],
+                       k: int = COMPACT_RECALL_K,
+                       rescore_factor: int = COMPACT_VECTORS_DEFAULTS["rescore_factor"]) -> Dict[str, Any]:
+        """以 float32 精确检索为基准测量召回率
+
+        从已有向量中抽样并加入少量噪声作为查询（模拟与文本块相近但不相同的问题），
+        分别统计只用量化向量和量化后重新打分的 recall@k。
+        """
+        import numpy as np
+        
+        total = len(self)
+        k = min(k, total)
+        if total == 0 or sample <= 0:
+            return {"k": k, "queries": 0}
+        rng = np.random.default_rng(0)
+        rows = rng.choice(total, size=min(sample, total), replace=False)
+        _, queries = source.by_ids([self.ids[row] for row in np.sort(rows)])
+        queries = queries + rng.normal(0, 0.02, queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        
+        expected = [set(self.ids[row] for row in result) for result in self.exact_search(source, queries, k)]
+        
+        def recall(results):
+            hits = sum(len(expected_ids & {chunk_id for chunk_id, _ in result})
+                       for expected_ids, result in zip(expected, results))
+            return round(hits / (len(expected) * k), 4)
+        
+        return {
+            "k": k,
+            "queries": len(queries),
+            "rescore_factor": rescore_factor,
+            "quantized_recall": recall(self.search(queries, k)),
+            "rescored_recall": recall(self.search(queries, k, rescore_factor=rescore_factor, source=source)),
+        }
+
+def compact_vectors_path(db_path: str) -> str:
+    return os.path.join(db_path, COMPACT_VECTORS_DIR)
+
+def build_compact_vectors(vectorstore, db_path: str, dtype: str = None) -> Optional[Dict[str, Any]]:
+    """逐批读取向量库集合中的向量，生成紧凑向量文件（调用者需持有数据库锁）
+
+    Returns:
+        紧凑向量的元数据（包含召回率报告）；集合为空时返回 None
+    """
+    config = load_compact_vectors_config()
+    dtype = dtype or config["dtype"]
+    if dtype not in ("int8", "float16"):
+        raise ValueError(f"不支持的紧凑向量类型: {dtype}（可选 int8、float16）")
+    count = vectorstore._collection.count()
+    if not count:
+        return None
+    
+    index = CompactVectorIndex.build(compact_vectors_path(db_path), FullPrecisionVectors(vectorstore), count,
+                                     dtype=dtype, recall_sample=config["recall_sample"])
+    if index is None:
+        return None
+    recall = index.meta.get("recall", {})
+    print(f"[INFO] 紧凑向量（{dtype}）已生成: {len(index)} 个向量，"
+          f"{index.meta['compact_bytes'] / (1024 * 1024):.1f} MB（float32 为 {index.meta['float32_bytes'] / (1024 * 1024):.1f} MB），"
+          f"recall@{recall.get('k')}: 量化 {recall.get('quantized_recall')} / 重新打分 {recall.get('rescored_recall')}")
+    return index.meta
+
+def read_compact_vectors_meta(db_path: str) -> Optional[Dict[str, Any]]:
+    """读取紧凑向量的元数据（不存在时返回 None），不打开向量文件"""
+    try:
+        with open(os.path.join(compact_vectors_path(db_path), "meta.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_compact_vector_index(db_path: str) -> Optional[CompactVectorIndex]:
+    """获取数据库的紧凑向量索引（同一进程内按数据库版本共用；未启用或不存在时返回 None）"""
+    if not db_path or not load_compact_vectors_config()["enabled"]:
+        return None
+    path_key = os.path.normcase(os.path.abspath(db_path))
+    meta_file = os.path.join(compact_vectors_path(db_path), "meta.json")
+    try:
+        meta_mtime = os.path.getmtime(meta_file)
+    except OSError:
+        meta_mtime = None
+    # 重建数据库或单独重新生成紧凑向量（命令行 compact）后键随之变化
+    key = (path_key, _read_vector_db_generation(db_path), meta_mtime)
+    cache = get_compact_index_cache()
+    with cache["lock"]:
+        entries = cache["entries"]
+        if key in entries:
+            return entries[key]
+        for old_key in [k for k in entries if k[0] == path_key]:
+            del entries[old_key]  # 数据库已重建，丢弃旧版本
+        index = None
+        if meta_mtime is not None:
+            try:
+                index = CompactVectorIndex(compact_vectors_path(db_path))
+            except Exception as e:
+                print(f"[WARN] 紧凑向量文件无法读取，改用完整向量检索: {str(e)}")
+        entries[key] = index
+        return index
+
+def release_compact_vector_index(db_path: str):
+    """数据库目录被删除或替换前释放内存映射（Windows 上打开的文件所在目录无法重命名）"""
+    path_key = os.path.normcase(os.path.abspath(db_path))
+    cache = get_compact_index_cache()
+    with cache["lock"]:
+        for key in [k for k in cache["entries"] if k[0] == path_key]:
+            del cache["entries"][key]
+
+def compact_similarity_search(vectorstore, index: CompactVectorIndex, query_vectors, k: int = 4) -> List[List[Tuple[str, Dict[str, Any]]]]:
+    """用紧凑向量检索候选，按向量库中的全精度向量重新打分，再从向量库读取文本块内容
+
+    Returns:
+        与查询一一对应的 [(内容, 元数据)] 列表
+    """
+    results = index.search(query_vectors, k=k, rescore_factor=load_compact_vectors_config()["rescore_factor"],
+                           source=FullPrecisionVectors(vectorstore))
+    wanted = list(dict.fromkeys(chunk_id for result in results for chunk_id, _ in result))
+    if not wanted:
+        return [[] for _ in results]
+    records = vectorstore._collection.get(ids=wanted, include=["documents", "metadatas"])
+    by_id = {chunk_id: (content, metadata or {})
+             for chunk_id, content, metadata in zip(records["ids"], records["documents"], records["metadatas"])}
+    return [[by_id[chunk_id] for chunk_id, _ in result if chunk_id in by_id] for result in results]
+
+# NumPy 向量索引模块（不依赖 chromadb 的内存映射向量库：分块矩阵乘法精确检索，大库可选 IVF 粗量化）
+VECTOR_BACKENDS = ("numpy", "chroma")
+NUMPY_INDEX_META_FILE = "numpy_index.json"  # 存在该文件的数据库目录使用 NumPy 索引
+NUMPY_INDEX_DEFAULTS = {
+    "ivf_min_vectors": 50000,  # 文本块数量达到该值时在构建结束后训练 IVF 粗量化器，否则只做精确检索
+    "nprobe": 16,  # IVF 检索时搜索的聚类数量
+}
+
+def load_vector_backend_config() -> str:
+    """新建向量数据库使用的后端（配置项 "vector_backend"：numpy 或 chroma，默认 numpy）
+
+    已有的数据库按目录中的文件识别后端，切换配置后旧数据库仍可加载，下次重建时改用新后端。
+    """
+    try:
+        backend = read_config_file().get("vector_backend", "numpy")
+        if backend in VECTOR_BACKENDS:
+            return backend
+    except Exception:
+        pass
+    return "numpy"
+
+def load_numpy_index_config() -> Dict[str, Any]:
+    """从本地配置文件加载 NumPy 索引配置（配置项 "numpy_index"，未设置的字段使用默认值）"""
+    config = dict(NUMPY_INDEX_DEFAULTS)
+    try:
+        custom = read_config_file().get("numpy_index") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+def detect_vector_backend(db_path: str) -> Optional[str]:
+    """根据目录中的文件识别数据库后端（目录中没有数据时返回 None）"""
+    if os.path.exists(os.path.join(db_path, NUMPY_INDEX_META_FILE)):
+        return "numpy"
+    if os.path.exists(os.path.join(db_path, "chroma.sqlite3")):
+        return "chroma"
+    return None
+
+def vector_db_data_file(db_path: str) -> str:
+    """数据库的主数据文件（NumPy 索引为 numpy_index.json，Chroma 为 chroma.sqlite3）"""
+    if detect_vector_backend(db_path) == "numpy" or (not os.path.exists(db_path) and load_vector_backend_config() == "numpy"):
+        return os.path.join(db_path, NUMPY_INDEX_META_FILE)
+    return os.path.join(db_path, "chroma.sqlite3")
+
+def open_vector_store(db_path: str, embeddings, backend: str = None):
+    """打开（或新建）数据库目录上的向量库：已有数据按目录中的文件识别后端，新目录使用配置的后端"""
+    backend = backend or detect_vector_backend(db_path) or load_vector_backend_config()
+    if backend == "numpy":
+        return NumpyVectorStore(db_path, embeddings)
+    return _open_chroma(get_chroma_class(), db_path, embeddings)
+
+class _IndexDocument:
+    """没有安装 langchain 时使用的文本块对象（只有 page_content 和 metadata）"""
+    def __init__(self, page_content: str, metadata: Dict[str, Any] = None):
+        self.page_content = page_content
+        self.metadata = metadata or {}
+
+class NumpyVectorStore:
+    """基于 NumPy 内存映射文件的向量库，提供检索代码用到的 Chroma 接口
+
+    目录中的文件：
+      vectors.f32          float32 向量，逐行追加（嵌入模型输出已归一化，内积即余弦相似度）
+      records.jsonl        每行一个文本块 {"id", "text", "metadata"}，offsets.u64 记录每行的起始位置
+      ids.txt              文本块 ID，按需加载为 ID -> 行号的映射
+      metadata_updates.json 构建后更新的元数据（如去重后的来源信息）
+      numpy_index.json     维度和已提交的行数；行数之后的内容是中断写入的残留，重新打开写入时截断
+      ivf_*.npy            可选的 IVF 聚类中心、按聚类排列的行号和每个聚类的起止位置；
+                           训练之后追加的行不在聚类中，检索时对这部分行做精确计算
+
+    打开时只读取 numpy_index.json 并映射向量文件，不需要加载索引，几乎不耗时。
+    _collection 指向自身，直接调用 Chroma 集合接口（get/query/update/count）的代码无需区分后端。
+    """
+    def __init__(self, persist_directory: str, embedding_function=None):
+        self._persist_directory = persist_directory
+        self._embedding_function = embedding_function
+        self._collection = self
+        self._lock = threading.RLock()
+        self._id_rows = None
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self._persist_directory, name)
+
+    def _load(self):
+        import numpy as np
         
+        meta = {}
         try:
-            from langchain_chroma import Chroma
-        except ImportError:
-            from langchain_community.vectorstores import Chroma
+            with open(self._file(NUMPY_INDEX_META_FILE), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.dimension = meta.get("dimension")
+        self.rows = int(meta.get("count", 0))
+        self.vectors = self.offsets = None
+        if self.rows:
+            self.vectors = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode='r', shape=(self.rows, self.dimension))
+            self.offsets = np.memmap(self._file("offsets.u64"), dtype=np.uint64, mode='r', shape=(self.rows,))
+        try:
+            with open(self._file("metadata_updates.json"), 'r', encoding='utf-8') as f:
+                self._metadata_updates = json.load(f)
+        except (OSError, ValueError):
+            self._metadata_updates = {}
+        self.ivf = None
+        self._ivf_meta = meta.get("ivf")
+        if self._ivf_meta:
+            self.ivf = {name: np.load(self._file(f"ivf_{name}.npy"), mmap_mode='r')
+                        for name in ("centroids", "rows", "offsets")}
+            self._ivf_meta.setdefault("rows", len(self.ivf["rows"]))
+
+    def close(self):
+        """释放内存映射（Windows 上替换或删除目录之前需要调用）"""
+        with self._lock:
+            self.vectors = self.offsets = self.ivf = None
+            self._id_rows = None
+
+    def count(self) -> int:
+        return self.rows
+
+    def _write_meta(self, **extra):
+        meta = {"format": 1, "dimension": self.dimension, "count": self.rows,
+                "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        if self._ivf_meta:
+            meta["ivf"] = self._ivf_meta  # 追加写入时保留已训练的聚类
+        meta.update(extra)
+        _write_json_atomic(self._file(NUMPY_INDEX_META_FILE), meta)
+
+    def truncate(self, rows: int):
+        """丢弃 rows 之后的内容（断点续建时回到检查点，或清理中断写入的残留）"""
+        import numpy as np
+        
+        with self._lock:
+            rows = min(rows, self.rows)
+            self.close()
+            if self._ivf_meta and rows < self._ivf_meta["rows"]:
+                # 聚类中引用了被截掉的行，丢弃 IVF（构建结束时重新训练）
+                self._ivf_meta = None
+                for name in ("centroids", "rows", "offsets"):
+                    if os.path.exists(self._file(f"ivf_{name}.npy")):
+                        os.remove(self._file(f"ivf_{name}.npy"))
+            # 已提交的最后一个文本块所在行的结尾即 records.jsonl 的有效长度（rows 为 0 时所有文件清空）
+            record_end = 0
+            if rows:
+                last_offset = int(np.fromfile(self._file("offsets.u64"), dtype=np.uint64, count=rows)[rows - 1])
+                with open(self._file("records.jsonl"), 'rb') as f:
+                    f.seek(last_offset)
+                    f.readline()
+                    record_end = f.tell()
+            for name, size in (("records.jsonl", record_end), ("offsets.u64", rows * 8),
+                               ("vectors.f32", rows * (self.dimension or 0) * 4)):
+                if os.path.exists(self._file(name)):
+                    with open(self._file(name), 'r+b') as f:
+                        f.truncate(size)
+            if os.path.exists(self._file("ids.txt")):
+                with open(self._file("ids.txt"), 'r', encoding='utf-8', errors='replace') as f:
+                    ids = f.read().splitlines()[:rows]
+                with open(self._file("ids.txt"), 'w', encoding='utf-8') as f:
+                    f.write("".join(f"{chunk_id}\n" for chunk_id in ids))
+            self.rows = rows
+            self._write_meta()
+            self._load()
+
+    def _data_file_sizes(self) -> Dict[str, Tuple[int, int]]:
+        """向量和偏移文件的 (实际大小, 按已提交行数应有的大小)，文件不存在时实际大小为 0"""
+        expected = {"vectors.f32": self.rows * (self.dimension or 0) * 4, "offsets.u64": self.rows * 8}
+        return {name: (os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0, size)
+                for name, size in expected.items()}
+
+    def _has_uncommitted_data(self) -> bool:
+        # 追加写入的顺序是 records.jsonl、向量、偏移、ids.txt，最后才更新 numpy_index.json；
+        # 写入向量之后的任何中断都会让向量或偏移文件的大小与已提交行数不一致（records.jsonl 按偏移读取，末尾残留不影响）
+        return any(actual != expected for actual, expected in self._data_file_sizes().values())
+
+    def add_documents(self, documents: List[Any], ids: List[str] = None) -> List[str]:
+        """生成向量并追加写入（调用者需持有数据库锁）；所有文件落盘后才更新已提交的行数"""
+        import numpy as np
+        
+        if not documents:
+            return []
+        ids = list(ids) if ids else [f"chunk-{self.rows + i}" for i in range(len(documents))]
+        vectors = np.asarray(self._embedding_function.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = int(vectors.shape[1])
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"向量维度不匹配（数据库: {self.dimension}，新向量: {vectors.shape[1]}）")
+            os.makedirs(self._persist_directory, exist_ok=True)
+            if self._has_uncommitted_data():
+                self.truncate(self.rows)  # 上次写入中断（包括第一批），文件末尾有未提交的内容
+            self.close()
+            
+            offsets = []
+            with open(self._file("records.jsonl"), 'ab') as f:
+                for chunk_id, doc in zip(ids, documents):
+                    offsets.append(f.tell())
+                    line = json.dumps({"id": chunk_id, "text": doc.page_content, "metadata": doc.metadata or {}},
+                                      ensure_ascii=False) + "\n"
+                    f.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            for name, data in (("vectors.f32", vectors.tobytes()),
+                               ("offsets.u64", np.asarray(offsets, dtype=np.uint64).tobytes()),
+                               ("ids.txt", "".join(f"{chunk_id}\n" for chunk_id in ids).encode('utf-8'))):
+                with open(self._file(name), 'ab') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.rows += len(documents)
+            self._write_meta()
+            self._load()
+        return ids
+
+    def _read_records(self, rows) -> List[Dict[str, Any]]:
+        """按行号读取文本块（按文件位置顺序读取，返回顺序与 rows 一致）"""
+        records = {}
+        offsets = self.offsets
+        with open(self._file("records.jsonl"), 'rb') as f:
+            for row in sorted(set(int(row) for row in rows)):
+                f.seek(int(offsets[row]))
+                record = json.loads(f.readline().decode('utf-8'))
+                if record["id"] in self._metadata_updates:
+                    record["metadata"] = {**record["metadata"], **self._metadata_updates[record["id"]]}
+                records[row] = record
+        return [records[int(row)] for row in rows]
+
+    def _rows_for_ids(self, ids: List[str]) -> List[int]:
+        if self._id_rows is None:
+            with open(self._file("ids.txt"), 'r', encoding='utf-8') as f:
+                self._id_rows = {chunk_id: row for row, chunk_id in enumerate(f.read().splitlines()[:self.rows])}
+        return [self._id_rows[chunk_id] for chunk_id in ids if chunk_id in self._id_rows]
+
+    def _search_rows(self, queries, k: int) -> List[List[Tuple[int, float]]]:
+        """返回每个查询的 [(行号, 相似度)]，按相似度降序"""
+        import numpy as np
+        
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        with self._lock:
+            vectors, ivf = self.vectors, self.ivf
+        if vectors is None or k <= 0:
+            return [[] for _ in queries]
+        if ivf is None:
+            candidates = top_rows_in_blocks(lambda start, end: queries @ np.asarray(vectors[start:end]).T,
+                                            len(vectors), len(queries), k)
+        else:
+            # IVF：只在与查询最接近的 nprobe 个聚类中精确计算相似度；训练之后追加的行全部参与计算
+            nprobe = min(int(load_numpy_index_config()["nprobe"]), len(ivf["centroids"]))
+            nearest = np.argpartition(-(queries @ np.asarray(ivf["centroids"]).T), nprobe - 1, axis=1)[:, :nprobe]
+            untrained = np.arange(len(ivf["rows"]), len(vectors), dtype=np.int64)
+            candidates = [np.concatenate([ivf["rows"][ivf["offsets"][c]:ivf["offsets"][c + 1]] for c in clusters]
+                                         + [untrained])
+                          for clusters in nearest]
+        results = []
+        for query, rows in zip(queries, candidates):
+            rows = np.sort(np.asarray(rows, dtype=np.int64))
+            scores = np.asarray(vectors[rows]) @ query
+            order = np.argsort(-scores)[:k]
+            results.append([(int(rows[i]), float(scores[i])) for i in order])
+        return results
+
+    def build_ivf(self, nlist: int = None, iterations: int = 10):
+        """训练 IVF 粗量化器（球面 k-means），把行号按所属聚类排列后写入 ivf_*.npy"""
+        import numpy as np
+        
+        with self._lock:
+            vectors = self.vectors
+            if vectors is None:
+                return
+            total = len(vectors)
+            nlist = nlist or int(min(4096, max(16, 4 * np.sqrt(total))))
+            rng = np.random.default_rng(0)
+            sample = np.asarray(vectors[np.sort(rng.choice(total, size=min(total, nlist * 64), replace=False))])
+            centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                counts = np.bincount(assignment, minlength=nlist)
+                starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+                nonempty = counts > 0
+                centroids[nonempty] = np.add.reduceat(sample[np.argsort(assignment, kind='stable')], starts[nonempty], axis=0)
+                # 空聚类重新随机取一个样本作为中心
+                centroids[~nonempty] = sample[rng.choice(len(sample), size=int((~nonempty).sum()))]
+                centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+            
+            assignment = np.concatenate([
+                np.argmax(np.asarray(vectors[start:start + COMPACT_SEARCH_BLOCK]) @ centroids.T, axis=1)
+                for start in range(0, total, COMPACT_SEARCH_BLOCK)
+            ])
+            rows = np.argsort(assignment, kind='stable').astype(np.int64)
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+            self.close()
+            for name, data in (("centroids", centroids.astype(np.float32)), ("rows", rows), ("offsets", offsets)):
+                np.save(self._file(f"ivf_{name}.npy"), data)
+            self._write_meta(ivf={"nlist": nlist, "rows": total})
+            self._load()
+        print(f"[INFO] IVF 粗量化器已生成: {total} 个向量，{nlist} 个聚类")
+
+    def finalize(self):
+        """构建完成后调用：文本块数量较多时生成（或按全部行重新训练）IVF 粗量化器"""
+        if self.rows >= load_numpy_index_config()["ivf_min_vectors"]:
+            self.build_ivf()
+
+    def _documents(self, records) -> List[Any]:
         try:
-            from langchain.schema import Document as LangDocument
+            document_cls = get_langchain_document_class()
         except ImportError:
-            from langchain_core.documents import Document as LangDocument
+            document_cls = _IndexDocument
+        return [document_cls(page_content=record["text"], metadata=record["metadata"]) for record in records]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs) -> List[Any]:
+        results = self._search_rows([embedding], k)[0]
+        return self._documents(self._read_records([row for row, _ in results]))
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Any]:
+        return self.similarity_search_by_vector(self._embedding_function.embed_query(query), k=k)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs) -> List[Tuple[Any, float]]:
+        """返回 (文本块, 距离)，与 Chroma 一致距离越小越相似（1 - 余弦相似度）"""
+        results = self._search_rows([self._embedding_function.embed_query(query)], k)[0]
+        documents = self._documents(self._read_records([row for row, _ in results]))
+        return [(doc, 1.0 - score) for doc, (_, score) in zip(documents, results)]
+
+    # 以下为 Chroma 集合接口
+    def query(self, query_embeddings, n_results: int = 4, include=("documents", "metadatas", "distances"), **kwargs):
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for hits in self._search_rows(query_embeddings, n_results):
+            records = self._read_records([row for row, _ in hits])
+            result["ids"].append([record["id"] for record in records])
+            result["documents"].append([record["text"] for record in records])
+            result["metadatas"].append([record["metadata"] for record in records])
+            result["distances"].append([1.0 - score for _, score in hits])
+        return result
+
+    def get(self, ids: List[str] = None, include=("documents", "metadatas"), limit: int = None, offset: int = 0, **kwargs):
+        import numpy as np
         
-        # 步骤 0: 在开始处理之前，先检测并清理损坏的数据库目录（避免版本兼容性问题）
-        db_path = get_vector_db_path(folder_path) if folder_path else "./chroma_db"
+        if ids is not None:
+            rows = self._rows_for_ids(ids)
+        else:
+            rows = list(range(min(offset, self.rows), self.rows if limit is None else min(self.rows, offset + limit)))
+        records = self._read_records(rows) if rows else []
+        result = {"ids": [record["id"] for record in records]}
+        if "documents" in include:
+            result["documents"] = [record["text"] for record in records]
+        if "metadatas" in include:
+            result["metadatas"] = [record["metadata"] for record in records]
+        if "embeddings" in include:
+            result["embeddings"] = np.asarray(self.vectors[rows]).tolist() if rows else []
+        return result
+
+    def update(self, ids: List[str], metadatas: List[Dict[str, Any]] = None, **kwargs):
+        """更新文本块元数据（写入 metadata_updates.json，读取时覆盖原有字段）"""
+        if not metadatas:
+            return
+        with self._lock:
+            for chunk_id, metadata in zip(ids, metadatas):
+                self._metadata_updates[chunk_id] = {**self._metadata_updates.get(chunk_id, {}), **metadata}
+            _write_json_atomic(self._file("metadata_updates.json"), self._metadata_updates)
+
+    def inspect(self) -> Dict[str, Any]:
+        """元数据校验用：已提交的行数、维度，以及向量和偏移文件大小是否与行数完全一致"""
+        try:
+            complete = not self._has_uncommitted_data()
+        except OSError:
+            complete = False
+        return {"count": self.rows, "dimension": self.dimension, "complete": complete}
+
+# 流式索引构建模块
+class IndexBuildCancelled(Exception):
+    """构建任务被用户取消"""
+
+INDEX_CHUNK_SIZE = 1000
+INDEX_CHUNK_OVERLAP = 200
+INDEX_BUILD_BATCH_SIZE = 256  # 每批生成向量并写入集合的文本块数量，同时也是检查点间隔
+
+def iter_document_chunks(docs_dict: Dict[str, Any], text_splitter, document_cls):
+    """逐个文件分割文本，按顺序生成文本块（不在内存中保存全部文本块）
+
+    Args:
+        docs_dict: 文档字典
+        text_splitter: 文本分割器
+        document_cls: LangChain Document 类
+
+    Yields:
+        (文本段序号, Document)，Excel 的每个工作表是一个文本段
+    """
+    text_index = 0
+    for filename, data in docs_dict.items():
+        content = data['content']
+        if isinstance(content, dict):  # Excel文件
+            texts = [f"文件: {filename} | 工作表: {sheet}\n{sheet_content}" for sheet, sheet_content in content.items()]
+        else:
+            texts = [f"文件: {filename}\n{content}"]
+        for text in texts:
+            for split in text_splitter.split_text(text):
+                yield text_index, document_cls(page_content=split, metadata={"source": filename})
+            text_index += 1
+
+def add_documents_with_retry(vectorstore, documents: List[Any], ids: List[str], db_path: str, max_retries: int = 3):
+    """将一批文本块生成向量并写入集合，失败时只重试当前批次"""
+    import time
+    
+    for attempt in range(max_retries):
+        try:
+            vectorstore.add_documents(documents, ids=ids)
+            return
+        except Exception as add_error:
+            error_msg = str(add_error).lower()
+            if "dimension" in error_msg or "dimensionality" in error_msg:
+                # 维度不匹配无法通过重试解决
+                raise Exception(f"创建向量数据库失败：维度不匹配\n\n"
+                              f"错误信息: {str(add_error)}\n\n"
+                              f"可能的原因:\n"
+                              f"- 旧向量数据库使用了不同维度的模型\n"
+                              f"- 模型切换后未正确清理旧数据库\n\n"
+                              f"解决方案:\n"
+                              f"1. 手动删除向量数据库目录: {db_path}\n"
+                              f"2. 或在侧边栏的'向量数据库管理'中删除\n"
+                              f"3. 然后重新加载文件夹") from add_error
+            if attempt == max_retries - 1:
+                error_type = type(add_error).__name__
+                raise Exception(f"写入向量数据库失败（已重试 {max_retries} 次） [{error_type}]: {str(add_error)}\n\n"
+                              f"已提交的批次已保存，重新加载文件夹时会从中断处继续") from add_error
+            print(f"[WARN] 写入批次失败，{2 ** attempt} 秒后重试 ({attempt + 1}/{max_retries}): {str(add_error)}")
+            time.sleep(2 ** attempt)
+
+def _build_config_signature() -> Dict[str, Any]:
+    """影响文本块划分和编号的构建参数，参数变化时检查点失效"""
+    return {
+        "chunk_size": INDEX_CHUNK_SIZE,
+        "chunk_overlap": INDEX_CHUNK_OVERLAP,
+        "dedup_hamming_threshold": DEDUP_HAMMING_THRESHOLD,
+        "dedup_shingle_size": DEDUP_SHINGLE_SIZE,
+    }
+
+BUILD_CHECKPOINT_FILE = ".build_checkpoint"  # 临时构建目录中记录已提交文本块数量的计数文件
+
+def start_build_checkpoint(docs_dict: Dict[str, Any], folder_path: str, build_path: str):
+    """构建开始时在签名中记录文件、嵌入模型和构建参数（每次构建只写一次，批次进度写入计数文件）
+
+    Args:
+        docs_dict: 文档字典
+        folder_path: 文件夹路径
+        build_path: 临时构建目录
+    """
+    save_docs_signature(docs_dict, folder_path, db_path=build_path, extra={
+        "build_status": "building",
+        "checkpoint": {
+            "build_config": _build_config_signature(),
+            "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+    })
+
+def save_build_checkpoint(committed_chunks: int, build_path: str):
+    """记录构建检查点（已写入集合的文本块数量），先写临时文件再替换
+
+    Args:
+        committed_chunks: 已写入集合的文本块数量
+        build_path: 临时构建目录
+    """
+    checkpoint_file = os.path.join(build_path, BUILD_CHECKPOINT_FILE)
+    temp_path = f"{checkpoint_file}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(str(committed_chunks))
+    os.replace(temp_path, checkpoint_file)
+
+def _read_build_checkpoint(build_path: str) -> Optional[int]:
+    """读取检查点计数文件（不存在或无法解析时返回 None）"""
+    try:
+        with open(os.path.join(build_path, BUILD_CHECKPOINT_FILE), 'r', encoding='utf-8') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def load_build_checkpoint(docs_dict: Dict[str, Any], folder_path: str, build_path: str) -> int:
+    """读取临时构建目录中未完成构建的检查点
+
+    只有当签名记录的文件、嵌入模型和构建参数都与当前一致时才允许续建。
+    构建已完成但替换正式目录失败时，同样可以直接复用已写入的文本块。
+
+    Returns:
+        可以跳过的已提交文本块数量，0 表示需要从头构建
+    """
+    signature_file = os.path.join(build_path, ".docs_signature.json")
+    if not os.path.exists(signature_file):
+        return 0
+    try:
+        with open(signature_file, 'r', encoding='utf-8') as f:
+            old_signature = json.load(f)
+        build_status = old_signature.get("build_status")
+        if build_status == "complete":
+            checkpoint = {"committed_chunks": old_signature.get("chunk_count", 0),
+                          "build_config": old_signature.get("build_config")}
+        elif build_status == "building":
+            checkpoint = dict(old_signature.get("checkpoint", {}))
+            committed_chunks = _read_build_checkpoint(build_path)
+            if committed_chunks is not None:
+                checkpoint["committed_chunks"] = committed_chunks
+        else:
+            return 0
+        if checkpoint.get("build_config") != _build_config_signature():
+            return 0
+        if old_signature.get("embedding_model") != load_embedding_model_config():
+            return 0
+        # 用与保存签名相同的方式生成当前文件信息，经过 JSON 往返后再比较
+        current_files = json.loads(json.dumps(_collect_file_signatures(docs_dict), ensure_ascii=False))
+        if old_signature.get("files") != current_files:
+            return 0
+        if detect_vector_backend(build_path) != load_vector_backend_config():
+            return 0
+        return int(checkpoint.get("committed_chunks", 0))
+    except Exception as e:
+        print(f"[WARN] 读取构建检查点失败: {str(e)}")
+        return 0
+
+def create_local_vector_store(docs_dict: Dict[str, Any], progress_callback=None, folder_path: str = None):
+    """创建本地向量数据库，使用开源嵌入模型
+    
+    Args:
+        docs_dict: 文档字典
+        progress_callback: 进度回调函数，接收 (progress, message) 参数
+        folder_path: 文件夹路径（用于签名）
+    """
+    import contextlib
+    
+    lock_stack = contextlib.ExitStack()
+    try:
+        # 兼容不同版本的 langchain 导入（缺少依赖时在这里抛出 ImportError）
+        RecursiveCharacterTextSplitter = get_text_splitter_class()
+        get_huggingface_embeddings_class()
+        backend = load_vector_backend_config()
+        if backend == "chroma":
+            get_chroma_class()
+        LangDocument = get_langchain_document_class()
+        
+        # 新数据库先在临时构建目录中创建，完成后再原子替换正式目录
+        # 构建期间正式目录保持可读，构建失败或中断也不会破坏已有数据库
+        db_path = get_vector_db_path(folder_path)
+        build_path = _vector_db_build_path(db_path)
         
         # 检查目录权限（在创建目录之前）
         parent_dir = os.path.dirname(db_path) if os.path.dirname(db_path) else "."
@@ -1626,150 +3791,42 @@ def create_local_vector_store(docs_dict: Dict[str, Any], progress_callback=None,
         if not os.access(parent_dir, os.W_OK):
             raise PermissionError(f"没有写入权限: {parent_dir}")
         
-        # 如果数据库目录已存在，先检测是否损坏或模型维度不匹配
-        # 注意：此函数只在文档变化或数据库不存在时被调用
-        # 如果数据库存在且正常，调用者应该已经检查过文档变化
-        if os.path.exists(db_path):
-            if progress_callback:
-                progress_callback(5, "🔄 检测向量数据库状态...")
-            
-            # 检查模型维度是否匹配
-            embedding_model = load_embedding_model_config()
-            expected_dimension = get_embedding_model_dimension(embedding_model)
-            
-            # 尝试检测现有数据库的维度
-            dimension_mismatch = False
-            try:
-                # 尝试加载数据库来检测维度
-                try:
-                    from langchain_huggingface import HuggingFaceEmbeddings
-                except ImportError:
-                    from langchain_community.embeddings import HuggingFaceEmbeddings
-                
-                try:
-                    from langchain_chroma import Chroma
-                except ImportError:
-                    from langchain_community.vectorstores import Chroma
-                
-                # 使用当前模型初始化
-                model_path = get_model_path(embedding_model)
-                test_embeddings = HuggingFaceEmbeddings(
-                    model_name=model_path,
-                    model_kwargs={'device': 'cpu'},
-                    encode_kwargs={'normalize_embeddings': True}
-                )
-                
-                # 尝试加载向量数据库
-                test_vectorstore = Chroma(
-                    persist_directory=db_path,
-                    embedding_function=test_embeddings
-                )
-                
-                # 尝试访问数据库，如果维度不匹配会抛出异常
-                try:
-                    _ = len(test_vectorstore)
-                except Exception as dim_error:
-                    error_msg = str(dim_error).lower()
-                    if "dimension" in error_msg or "dimensionality" in error_msg:
-                        dimension_mismatch = True
-            except Exception:
-                # 如果检测失败，假设维度不匹配（安全起见）
-                dimension_mismatch = True
-            
-            # 检测数据库是否损坏（特别是 schema 兼容性问题）
-            is_corrupted = check_db_corrupted(db_path)
-            
-            if is_corrupted or dimension_mismatch:
-                # 数据库损坏或维度不匹配，需要清理后重新创建
-                if dimension_mismatch:
-                    if progress_callback:
-                        progress_callback(5, f"⚠️ 检测到模型维度不匹配（当前模型维度: {expected_dimension}），正在清理旧数据库...")
-                else:
-                    if progress_callback:
-                        progress_callback(5, "⚠️ 检测到数据库损坏（可能是版本兼容性问题），正在清理...")
-                cleanup_corrupted_db(db_path, force=True)
-                import time
-                time.sleep(2)  # 增加等待时间，确保文件系统完全更新
-                # 再次确认目录已删除
-                if os.path.exists(db_path):
-                    import shutil
-                    try:
-                        shutil.rmtree(db_path)
-                        print(f"✅ 强制删除数据库目录: {db_path}")
-                    except Exception as cleanup_error:
-                        print(f"⚠️ 强制删除失败: {str(cleanup_error)}")
-                        # 如果删除失败，重命名目录
-                        backup_name = db_path + "_backup_" + str(int(time.time()))
-                        try:
-                            os.rename(db_path, backup_name)
-                            print(f"⚠️ 已重命名数据库目录为备份: {backup_name}")
-                        except:
-                            pass
-            else:
-                # 数据库正常，但由于文档变化需要重新创建，清理旧数据库
-                # 注意：调用者应该已经检查过文档变化，这里直接清理即可
-                if progress_callback:
-                    progress_callback(5, "📝 检测到文档变化，清理旧向量数据库...")
-                cleanup_corrupted_db(db_path, force=True)
-                import time
-                time.sleep(0.5)  # 等待文件系统更新
+        # 持有数据库目录锁直到替换完成，避免其他进程同时删除或重建同一数据库
+        lock_stack.enter_context(vector_db_lock(db_path))
         
-        # 提取文本内容
-        if progress_callback:
-            progress_callback(15, "🔄 步骤 1/4: 提取文档内容...")
-        
-        texts = []
-        total_files = len(docs_dict)
-        for idx, (filename, data) in enumerate(docs_dict.items()):
-            content = data['content']
-            if isinstance(content, dict):  # Excel文件
-                for sheet, sheet_content in content.items():
-                    texts.append(f"文件: {filename} | 工作表: {sheet}\n{sheet_content}")
-            else:
-                texts.append(f"文件: {filename}\n{content}")
-            
-            if progress_callback and total_files > 0:
-                progress = 15 + int((idx + 1) / total_files * 10)
-                progress_callback(progress, f"🔄 步骤 1/4: 提取文档内容... ({idx + 1}/{total_files})")
+        # 如果上次构建被中断且文档、模型均未变化，从最后一个已提交的批次继续
+        resume_from = load_build_checkpoint(docs_dict, folder_path, build_path) if folder_path else 0
+        if resume_from > 0:
+            if progress_callback:
+                progress_callback(5, f"🔄 检测到未完成的构建，将从第 {resume_from} 个文本块继续...")
+            print(f"[INFO] 从检查点继续构建向量数据库: {build_path}（已提交 {resume_from} 个文本块）")
+        elif os.path.exists(build_path):
+            # 无法续建的残留构建目录（文档、模型或构建参数已变化）
+            if progress_callback:
+                progress_callback(5, "🔄 清理上次未完成的构建...")
+            if not _remove_db_dir(build_path):
+                raise Exception(f"无法清理上次未完成的构建目录: {build_path}\n\n请关闭占用该目录的程序后手动删除")
         
-        # 分割文本
-        if progress_callback:
-            progress_callback(30, "🔄 步骤 2/4: 分割文本...")
+        # 统计待分割的文本段数（Excel 每个工作表单独一段），用于显示进度
+        total_texts = sum(len(data['content']) if isinstance(data['content'], dict) else 1
+                          for data in docs_dict.values())
         
         text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
+            chunk_size=INDEX_CHUNK_SIZE,
+            chunk_overlap=INDEX_CHUNK_OVERLAP,
             length_function=len,
         )
         
-        documents = []
-        total_texts = len(texts)
-        for i, text in enumerate(texts):
-            splits = text_splitter.split_text(text)
-            for split in splits:
-                documents.append(LangDocument(
-                    page_content=split,
-                    metadata={"source": list(docs_dict.keys())[i % len(docs_dict)]}
-                ))
-            
-            if progress_callback and total_texts > 0:
-                progress = 30 + int((i + 1) / total_texts * 20)
-                progress_callback(progress, f"🔄 步骤 2/4: 分割文本... ({i + 1}/{total_texts})")
-        
         # 使用本地嵌入模型
         if progress_callback:
-            progress_callback(55, "🔄 步骤 3/4: 初始化嵌入模型（首次运行会下载模型，可能需要几分钟）...")
+            progress_callback(15, "🔄 步骤 1/3: 初始化嵌入模型（首次运行会下载模型，可能需要几分钟）...")
         
         # 优先使用本地模型路径，避免网络下载
         embedding_model = load_embedding_model_config()
         model_path = get_model_path(embedding_model)
         
         try:
-            embeddings = HuggingFaceEmbeddings(
-                model_name=model_path,  # 使用配置的嵌入模型
-                model_kwargs={'device': 'cpu'},
-                encode_kwargs={'normalize_embeddings': True}
-            )
+            embeddings = get_shared_embeddings(embedding_model)
         except Exception as model_error:
             error_type = type(model_error).__name__
             error_msg = str(model_error)
@@ -1783,197 +3840,142 @@ def create_local_vector_store(docs_dict: Dict[str, Any], progress_callback=None,
                           f"- 使用 download_model.py 手动下载模型\n"
                           f"- 检查网络连接") from model_error
         
-        # 检查文档是否为空
-        if not documents or len(documents) == 0:
-            raise ValueError("没有可用的文档内容，无法创建向量数据库。请检查文档是否为空或格式是否正确。")
+        # 创建临时构建目录（断点续建时目录已存在）
+        os.makedirs(build_path, exist_ok=True)
         
-        # 确保目录不存在后再创建（之前的清理应该已经删除了目录）
-        # 如果目录仍然存在，强制删除（可能是维度不匹配的旧数据库）
-        if os.path.exists(db_path):
-            import shutil
-            import time
-            
-            # 使用cleanup_corrupted_db函数进行强力清理
-            cleanup_success = cleanup_corrupted_db(db_path, force=True)
-            
-            if not cleanup_success:
-                # 如果清理失败，尝试重命名作为备份（避免阻塞后续操作）
-                backup_name = db_path + "_backup_" + str(int(time.time()))
+        # 步骤 2: 流式构建 —— 逐个文件分割、去重，按固定大小的批次生成向量并写入集合
+        # 每个批次提交后在签名中记录检查点，中断后可从最后一个已提交的批次继续
+        if progress_callback:
+            progress_callback(20, "🔄 步骤 2/3: 分割文本并生成向量嵌入（这可能需要几分钟，请耐心等待）...")
+        
+        vectorstore = open_vector_store(build_path, embeddings, backend=backend)
+        # 回到检查点（丢弃最后一个批次写入集合后、检查点记录前中断时留下的内容）
+        if isinstance(vectorstore, NumpyVectorStore):
+            if vectorstore.count() > resume_from:
+                vectorstore.truncate(resume_from)
+        elif vectorstore._collection.count() > resume_from:
+            # Chroma 不能按行截断：删除编号不小于检查点的文本块，续建时以同样的 ID 重新写入
+            leftover_ids = []
+            for chunk_id in vectorstore._collection.get(include=[])["ids"]:
                 try:
-                    os.rename(db_path, backup_name)
-                    print(f"⚠️ 无法删除目录，已重命名为备份: {backup_name}")
-                    print(f"   可以在程序关闭后手动删除该备份目录")
-                except Exception as rename_error:
-                    # 如果重命名也失败，记录警告但不抛出异常（允许继续创建新数据库）
-                    print(f"⚠️ 无法删除或重命名目录: {str(rename_error)}")
-                    print(f"   目录 {db_path} 可能被其他进程占用")
-                    print(f"   建议：关闭其他可能使用该数据库的程序，然后手动删除目录")
-                    # 尝试创建一个带时间戳的新目录名
-                    db_path = db_path + "_new_" + str(int(time.time()))
-                    print(f"   将使用新目录: {db_path}")
-        
-        # 创建新目录
-        os.makedirs(db_path, exist_ok=True)
+                    if int(chunk_id.rsplit("-", 1)[1]) >= resume_from:
+                        leftover_ids.append(chunk_id)
+                except (IndexError, ValueError):
+                    pass
+            if leftover_ids:
+                print(f"[INFO] 删除检查点之后写入的 {len(leftover_ids)} 个文本块: {build_path}")
+                vectorstore._collection.delete(ids=leftover_ids)
+        if folder_path:
+            # 先写计数文件再写签名：两者之间中断时签名仍是上次的状态
+            save_build_checkpoint(resume_from, build_path)
+            start_build_checkpoint(docs_dict, folder_path, build_path)
+        
+        deduplicator = ChunkDeduplicator()
+        batch = []
+        batch_ids = []
+        committed = resume_from
+        texts_done = 0
+        
+        def flush_batch():
+            """将当前批次写入向量集合并记录检查点"""
+            nonlocal committed
+            add_documents_with_retry(vectorstore, batch, batch_ids, build_path)
+            committed += len(batch)
+            batch.clear()
+            batch_ids.clear()
+            if folder_path:
+                save_build_checkpoint(committed, build_path)
+        
+        for text_index, document in iter_document_chunks(docs_dict, text_splitter, LangDocument):
+            chunk_index = deduplicator.add(document)
+            if chunk_index is not None and chunk_index >= resume_from:
+                # 使用稳定的文本块 ID，续建和更新来源信息时据此定位
+                batch.append(document)
+                batch_ids.append(f"chunk-{chunk_index}")
+                if len(batch) >= INDEX_BUILD_BATCH_SIZE:
+                    flush_batch()
+            
+            if text_index + 1 > texts_done:
+                texts_done = text_index + 1
+                if progress_callback and total_texts > 0:
+                    progress = 20 + int(texts_done / total_texts * 70)
+                    progress_callback(min(progress, 90), f"🔄 步骤 2/3: 生成向量嵌入（已处理 {texts_done}/{total_texts} 段文本，"
+                                                         f"已写入 {committed} 个文本块）...")
+        if batch:
+            flush_batch()
         
-        # 步骤 3: 预生成向量嵌入（带进度更新，用于显示进度和预热模型）
-        # 注意：Chroma.from_documents 会在内部重新生成向量，但预生成可以：
-        # 1. 显示详细的进度更新
-        # 2. 预热模型（首次使用时会加载模型到内存）
-        # 3. 提前发现模型错误
-        total_docs = len(documents)
-        batch_size = 50  # 每批处理50个文档，避免内存占用过大
+        # 检查文档是否为空
+        if deduplicator.kept == 0:
+            raise ValueError("没有可用的文档内容，无法创建向量数据库。请检查文档是否为空或格式是否正确。")
         
-        # 步骤 3: 使用带进度更新的嵌入模型
-        total_docs = len(documents)
+        # 步骤 3: 将被剔除的重复文本块的来源写回代表块
         if progress_callback:
-            progress_callback(70, f"🔄 步骤 3/4: 生成向量嵌入（共 {total_docs} 个文档块，这可能需要几分钟，请耐心等待）...")
-        
-        # 使用包装的嵌入模型，在生成向量时自动更新进度
-        progress_embeddings = ProgressEmbeddings(
-            embeddings=embeddings,
-            progress_callback=progress_callback,
-            total_docs=total_docs,
-            start_progress=70,
-            end_progress=85
-        )
+            progress_callback(92, "🔄 步骤 3/3: 更新文本块来源信息...")
+        provenance = deduplicator.provenance_updates()
+        if provenance:
+            try:
+                chunk_ids = sorted(provenance)
+                vectorstore._collection.update(
+                    ids=[f"chunk-{idx}" for idx in chunk_ids],
+                    metadatas=[provenance[idx] for idx in chunk_ids]
+                )
+            except Exception as update_error:
+                # 来源信息更新失败不影响检索
+                print(f"[WARN] 更新重复文本块来源信息失败: {str(update_error)}")
         
-        # 步骤 4: 创建向量存储（使用带进度更新的嵌入模型）
-        if progress_callback:
-            progress_callback(85, "🔄 步骤 4/4: 创建向量存储...")
+        dedup_stats = deduplicator.stats()
+        if dedup_stats["saved_embeddings"] > 0:
+            print(f"[INFO] 文本块去重: {dedup_stats['total']} -> {dedup_stats['kept']} "
+                  f"(完全重复 {dedup_stats['exact_duplicates']}，近似重复 {dedup_stats['near_duplicates']})，"
+                  f"节省 {dedup_stats['saved_embeddings']} 次向量计算")
         
-        # 兼容不同版本的参数名
-        max_retries = 3  # 增加重试次数
-        last_error = None
+        # 保存文档签名（同时记录去重统计，标记构建完成）
+        if folder_path:
+            save_docs_signature(docs_dict, folder_path, db_path=build_path, extra={
+                "build_status": "complete",
+                "chunk_count": deduplicator.kept,
+                "build_config": _build_config_signature(),
+                "dedup": dedup_stats
+            })
+        try:
+            os.remove(os.path.join(build_path, BUILD_CHECKPOINT_FILE))
+        except OSError:
+            pass
         
-        for attempt in range(max_retries):
+        # NumPy 索引在文本块较多时生成 IVF 粗量化器
+        if isinstance(vectorstore, NumpyVectorStore):
+            vectorstore.finalize()
+        
+        # 启用紧凑向量时在替换之前生成（失败时只打印警告，检索改用完整向量）
+        if load_compact_vectors_config()["enabled"]:
+            if progress_callback:
+                progress_callback(94, "🔄 生成紧凑向量...")
             try:
-                # 在创建前再次确认目录是空的（防止维度不匹配）
-                if os.path.exists(db_path):
-                    # 检查目录是否为空
-                    try:
-                        dir_contents = os.listdir(db_path)
-                        if dir_contents:
-                            # 目录不为空，可能是旧数据库残留，强制清理
-                            import shutil
-                            if progress_callback:
-                                progress_callback(87, f"⚠️ 检测到旧数据库残留，正在清理（尝试 {attempt + 1}/{max_retries}）...")
-                            try:
-                                shutil.rmtree(db_path)
-                                os.makedirs(db_path, exist_ok=True)
-                                print(f"✅ 清理了非空数据库目录: {db_path}")
-                                import time
-                                time.sleep(1)  # 等待文件系统更新
-                            except Exception as cleanup_error:
-                                print(f"⚠️ 清理目录失败: {str(cleanup_error)}")
-                    except Exception:
-                        pass  # 如果无法列出目录，继续尝试创建
-                
-                # 尝试使用 embedding 参数（标准参数名）
-                if progress_callback:
-                    progress_callback(88, f"🔄 正在创建向量数据库（尝试 {attempt + 1}/{max_retries}）...")
-                try:
-                    # 优先使用 embedding 参数（这是标准参数名）
-                    vectorstore = Chroma.from_documents(
-                        documents=documents,
-                        embedding=progress_embeddings,
-                        persist_directory=db_path
-                    )
-                    break  # 成功创建，退出循环
-                except TypeError as param_error:
-                    # 如果 embedding 参数不支持，尝试 embedding_function
-                    error_msg = str(param_error).lower()
-                    if "embedding" in error_msg or "unexpected keyword" in error_msg:
-                        try:
-                            vectorstore = Chroma.from_documents(
-                                documents=documents,
-                                embedding_function=progress_embeddings,
-                                persist_directory=db_path
-                            )
-                            break  # 成功创建，退出循环
-                        except TypeError:
-                            # 如果两种参数名都不支持，抛出原始错误
-                            raise param_error
-                    else:
-                        raise
-            except Exception as create_error:
-                # 检查是否是维度不匹配错误
-                error_msg = str(create_error).lower()
-                if "dimension" in error_msg or "dimensionality" in error_msg:
-                    # 维度不匹配，强制清理数据库并重试
-                    if progress_callback:
-                        progress_callback(87, f"⚠️ 检测到维度不匹配错误，正在清理旧数据库并重试（尝试 {attempt + 1}/{max_retries}）...")
-                    import shutil
-                    import time
-                    try:
-                        if os.path.exists(db_path):
-                            shutil.rmtree(db_path)
-                            print(f"✅ 清理了维度不匹配的数据库目录: {db_path}")
-                            time.sleep(2)  # 等待文件系统更新
-                        os.makedirs(db_path, exist_ok=True)
-                    except Exception as cleanup_error:
-                        print(f"⚠️ 清理数据库目录失败: {str(cleanup_error)}")
-                    
-                    # 如果是最后一次尝试，抛出详细错误
-                    if attempt == max_retries - 1:
-                        raise Exception(f"创建向量数据库失败：维度不匹配\n\n"
-                                      f"错误信息: {str(create_error)}\n\n"
-                                      f"可能的原因:\n"
-                                      f"- 旧向量数据库使用了不同维度的模型\n"
-                                      f"- 模型切换后未正确清理旧数据库\n\n"
-                                      f"解决方案:\n"
-                                      f"1. 手动删除向量数据库目录: {db_path}\n"
-                                      f"2. 或在侧边栏的'向量数据库管理'中删除\n"
-                                      f"3. 然后重新加载文件夹") from create_error
-                    # 否则继续重试
-                    continue
-                elif isinstance(create_error, TypeError) and "multiple values for keyword argument" in str(create_error):
-                    # 参数重复传递错误，尝试使用不同的参数传递方式
-                    if progress_callback:
-                        progress_callback(88, f"🔄 检测到参数冲突，尝试使用替代方式创建向量数据库（尝试 {attempt + 1}/{max_retries}）...")
-                    try:
-                        # 尝试只使用位置参数传递 documents，其他参数使用关键字
-                        vectorstore = Chroma.from_documents(
-                            documents,
-                            embedding=progress_embeddings,
-                            persist_directory=db_path
-                        )
-                        break  # 成功创建，退出循环
-                    except Exception as e:
-                        # 如果还是失败，记录错误并在最后一次尝试时抛出
-                        last_error = e
-                        if attempt == max_retries - 1:
-                            raise Exception(f"创建向量数据库失败：参数传递错误\n\n"
-                                          f"错误信息: {str(create_error)}\n\n"
-                                          f"可能的原因:\n"
-                                          f"- langchain_chroma 版本不兼容\n"
-                                          f"- 参数传递方式冲突\n\n"
-                                          f"解决方案:\n"
-                                          f"1. 更新 langchain-chroma: pip install --upgrade langchain-chroma\n"
-                                          f"2. 检查 Chroma 版本兼容性\n"
-                                          f"3. 查看完整错误信息以获取更多细节") from create_error
-                        continue
-                else:
-                    # 其他错误，记录并重试
-                    last_error = create_error
-                    if attempt == max_retries - 1:
-                        raise
-                    continue
-        else:
-            # 所有重试都失败了
-            if last_error:
-                error_type = type(last_error).__name__
-                raise Exception(f"创建向量数据库失败（已重试 {max_retries} 次） [{error_type}]: {str(last_error)}") from last_error
-            else:
-                raise Exception("创建向量数据库失败：未知错误")
+                build_compact_vectors(vectorstore, build_path)
+            except Exception as compact_error:
+                print(f"[WARN] 生成紧凑向量失败: {str(compact_error)}")
         
+        # 步骤 4: 用构建完成的目录替换正式目录
         if progress_callback:
-            progress_callback(100, "✅ 向量数据库创建完成！")
+            progress_callback(96, "🔄 切换到新的向量数据库...")
+        _release_vector_store(vectorstore)
+        swap_in_vector_db(build_path, db_path)
+        vectorstore = open_vector_store(db_path, embeddings)
+        # 上传文件构建的数据库没有签名，模型和文本块数直接记入清单
+        record_vector_db(db_path, embedding_model=embedding_model,
+                         embedding_dimension=get_embedding_model_dimension(embedding_model),
+                         chunk_count=deduplicator.kept, file_count=len(docs_dict))
         
-        # 保存文档签名
-        if folder_path:
-            save_docs_signature(docs_dict, folder_path)
+        if progress_callback:
+            message = "✅ 向量数据库创建完成！"
+            if dedup_stats["saved_embeddings"] > 0:
+                message += f"（去除 {dedup_stats['saved_embeddings']} 个重复文本块）"
+            progress_callback(100, message)
         
         return vectorstore
+    except IndexBuildCancelled:
+        # 取消构建不是错误，已提交的批次保留在检查点中
+        raise
     except ImportError as e:
         # 导入错误，可能是缺少依赖包
         error_msg = str(e)
@@ -2047,19 +4049,770 @@ def create_local_vector_store(docs_dict: Dict[str, Any], progress_callback=None,
         
         # 抛出异常，让调用者使用占位符显示错误
         raise Exception(error_detail)
+    finally:
+        lock_stack.close()
+
+# 后台索引构建任务模块（在独立的工作进程中构建向量数据库，不阻塞 Streamlit 脚本运行）
+INDEX_JOBS_DIR = os.path.join(".", ".index_jobs")
+INDEX_JOB_HEARTBEAT_SECONDS = 5  # 工作进程更新心跳的间隔
+INDEX_JOB_STALE_SECONDS = 60  # 超过该时间没有心跳的任务视为已失效（进程已退出）
+# 排队状态下的心跳是父进程启动工作进程时写入的；工作进程要先导入本模块（streamlit 等）才能开始心跳，
+# 冷启动（磁盘缓存为空、杀毒软件扫描）可能远超 INDEX_JOB_STALE_SECONDS，因此单独放宽
+INDEX_JOB_START_SECONDS = 600
+
+def _index_job_file(job_id: str, suffix: str = ".json") -> str:
+    return os.path.join(INDEX_JOBS_DIR, f"{job_id}{suffix}")
+
+def _index_job_lock_file(db_path: str) -> str:
+    """每个向量数据库目录对应一个单飞锁文件，保证同一目标同时只有一个构建任务"""
+    # 不使用 normalize_path：目录是否存在会影响其结果，而锁必须在构建前后保持同一个键
+    key = hashlib.md5(os.path.normcase(os.path.abspath(db_path)).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(INDEX_JOBS_DIR, "active", f"{key}.lock")
+
+def _write_json_atomic(file_path: str, data: Dict[str, Any]):
+    """先写临时文件再替换，避免读取方读到写了一半的 JSON"""
+    import threading
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(temp_path, file_path)
+
+def get_index_job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    """读取构建任务状态
+
+    Returns:
+        状态字典（包含 job_id、folder_path、db_path、status、progress、message、error 等），
+        任务不存在时返回 None。status 为 queued/running/completed/failed/cancelled 之一；
+        queued/running 状态的任务如果心跳超时（queued 为 INDEX_JOB_START_SECONDS，running 为
+        INDEX_JOB_STALE_SECONDS），会被报告为 failed。
+    """
+    try:
+        with open(_index_job_file(job_id), 'r', encoding='utf-8') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    
+    import time
+    stale_seconds = INDEX_JOB_START_SECONDS if job.get("status") == "queued" else INDEX_JOB_STALE_SECONDS
+    if job.get("status") in ("queued", "running") and time.time() - job.get("heartbeat", 0) > stale_seconds:
+        job["error"] = job.get("error") or ("构建进程未能启动（启动超时）" if job["status"] == "queued"
+                                            else "构建进程已意外退出（心跳超时）")
+        job["status"] = "failed"
+    return job
+
+def _update_index_job(job_id: str, **fields):
+    """更新任务状态文件（同时刷新心跳时间）"""
+    import time
+    job = get_index_job_status(job_id) or {"job_id": job_id}
+    job.update(fields)
+    job["heartbeat"] = time.time()
+    job["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    _write_json_atomic(_index_job_file(job_id), job)
+
+def _is_index_job_active(job: Optional[Dict[str, Any]]) -> bool:
+    return bool(job) and job.get("status") in ("queued", "running")
+
+def get_active_index_job(folder_path: str = None) -> Optional[Dict[str, Any]]:
+    """获取某个向量数据库目录上正在运行的构建任务（没有则返回 None）"""
+    db_path = get_vector_db_path(folder_path)
+    try:
+        with open(_index_job_lock_file(db_path), 'r', encoding='utf-8') as f:
+            job_id = f.read().strip()
+    except OSError:
+        return None
+    job = get_index_job_status(job_id)
+    return job if _is_index_job_active(job) else None
+
+def start_index_build_job(folder_path: str = None, docs_dict: Dict[str, Any] = None, force: bool = False) -> str:
+    """启动后台构建任务（同一向量数据库目录同时只会有一个任务在运行）
+
+    Args:
+        folder_path: 文件夹路径（工作进程会重新读取该文件夹）
+        docs_dict: 文档字典（上传文件时没有文件夹路径，直接传入文档内容）
+        force: 是否丢弃已有数据库和构建检查点，强制重新创建（新数据库构建完成后才会替换旧数据库）
+
+    Returns:
+        任务ID；如果目标上已有任务在运行，返回已有任务的ID
+    """
+    import subprocess
+    import sys
+    import time
+    import uuid
+    
+    db_path = get_vector_db_path(folder_path)
+    lock_file = _index_job_lock_file(db_path)
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    
+    job_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid.uuid4().hex[:8]
+    for _ in range(2):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(job_id)
+            break
+        except FileExistsError:
+            existing = get_active_index_job(folder_path)
+            if existing:
+                print(f"[INFO] 向量数据库已有构建任务在运行: {existing['job_id']}")
+                return existing["job_id"]
+            # 锁文件残留（任务已结束或进程已退出），清理后重试
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+    else:
+        raise RuntimeError(f"无法获取构建任务锁: {lock_file}")
+    
+    docs_file = None
+    if docs_dict is not None:
+        docs_file = _index_job_file(job_id, ".docs.json")
+        _write_json_atomic(docs_file, docs_dict)
+    
+    _update_index_job(
+        job_id,
+        folder_path=folder_path,
+        db_path=db_path,
+        docs_file=docs_file,
+        force=force,
+        status="queued",
+        progress=0,
+        message="⏳ 等待构建进程启动...",
+        error=None,
+        created_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        started=time.time()
+    )
+    
+    try:
+        log_file = open(_index_job_file(job_id, ".log"), 'a', encoding='utf-8')
+        popen_kwargs = {}
+        if os.name == 'nt':
+            popen_kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            popen_kwargs["start_new_session"] = True  # 浏览器关闭或 Streamlit 重跑都不会影响工作进程
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "build-index-job", job_id],
+            cwd=os.getcwd(),
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            **popen_kwargs
+        )
+        log_file.close()
+        _update_index_job(job_id, pid=process.pid)
+    except Exception as e:
+        _update_index_job(job_id, status="failed", error=f"无法启动构建进程: {str(e)}")
+        _release_index_job_lock(db_path, job_id)
+        raise
+    
+    print(f"[INFO] 已启动后台构建任务 {job_id}: {db_path}")
+    return job_id
+
+def cancel_index_build_job(job_id: str) -> bool:
+    """请求取消构建任务（工作进程会在下一次进度更新时停止，已提交的批次保留以便续建）"""
+    job = get_index_job_status(job_id)
+    if not _is_index_job_active(job):
+        return False
+    with open(_index_job_file(job_id, ".cancel"), 'w', encoding='utf-8') as f:
+        f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return True
+
+def _release_index_job_lock(db_path: str, job_id: str):
+    """释放单飞锁（只释放属于当前任务的锁）"""
+    lock_file = _index_job_lock_file(db_path)
+    try:
+        with open(lock_file, 'r', encoding='utf-8') as f:
+            owner = f.read().strip()
+        if owner == job_id:
+            os.remove(lock_file)
+    except OSError:
+        pass
+
+def run_index_build_job(job_id: str) -> int:
+    """工作进程入口：执行构建任务并持续更新任务状态
+
+    Returns:
+        进程退出码（0 表示成功）
+    """
+    import threading
+    
+    job = get_index_job_status(job_id)
+    if not job:
+        print(f"[ERROR] 构建任务不存在: {job_id}")
+        return 1
+    
+    folder_path = job.get("folder_path")
+    db_path = job.get("db_path")
+    cancel_file = _index_job_file(job_id, ".cancel")
+    state = {"progress": 0, "message": "🔄 构建进程已启动..."}
+    write_lock = threading.Lock()  # 心跳线程和构建线程都会读改写状态文件
+    stop_heartbeat = threading.Event()
+    
+    def heartbeat():
+        # 模型加载等长时间步骤中没有进度回调，由心跳线程证明进程仍然存活
+        while not stop_heartbeat.wait(INDEX_JOB_HEARTBEAT_SECONDS):
+            with write_lock:
+                _update_index_job(job_id, **state)
+    
+    def progress_callback(progress, message):
+        if os.path.exists(cancel_file):
+            raise IndexBuildCancelled(job_id)
+        state["progress"] = progress
+        state["message"] = message
+        with write_lock:
+            _update_index_job(job_id, **state)
+    
+    def finish(**fields):
+        # 先停止心跳线程，避免最终状态被心跳覆盖；先释放锁，读取到最终状态时目标已可重新构建
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+        _release_index_job_lock(db_path, job_id)
+        _update_index_job(job_id, **fields)
+    
+    # 在读取文件、导入 langchain/torch 和加载嵌入模型之前开始心跳
+    _update_index_job(job_id, status="running", pid=os.getpid(), **state)
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    
+    try:
+        if job.get("docs_file"):
+            with open(job["docs_file"], 'r', encoding='utf-8') as f:
+                docs_dict = json.load(f)
+        else:
+            progress_callback(1, "🔄 正在读取文件...")
+            docs_dict = process_folder(folder_path)
+        
+        if not docs_dict:
+            raise ValueError("没有可用的文档，无法创建向量数据库")
+        
+        if job.get("force"):
+            # 强制重建：丢弃可能存在的检查点，旧数据库在新数据库构建完成后才被替换
+            with vector_db_lock(db_path):
+                _remove_db_dir(_vector_db_build_path(db_path))
+        
+        vectorstore = create_local_vector_store(docs_dict, progress_callback=progress_callback, folder_path=folder_path)
+        if vectorstore is None:
+            finish(status="failed", error="向量数据库功能不可用（缺少依赖包）")
+            return 1
+        finish(status="completed", progress=100, message="✅ 向量数据库创建完成！", file_count=len(docs_dict))
+        return 0
+    except IndexBuildCancelled:
+        finish(status="cancelled", message="⏹️ 构建已取消（已提交的批次已保存，重新加载时会继续）")
+        return 1
+    except Exception as e:
+        finish(status="failed", error=str(e))
+        return 1
+    finally:
+        stop_heartbeat.set()
+        _release_index_job_lock(db_path, job_id)
+        for leftover in (cancel_file, job.get("docs_file")):
+            if leftover and os.path.exists(leftover):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+
+# DeepSeek API 限流模块（同一进程内所有会话、批量任务和服务请求共用）
+DEEPSEEK_RATE_LIMIT_DEFAULTS = {
+    "requests_per_minute": 60,  # 每分钟请求数，0 表示不限制
+    "tokens_per_minute": 200000,  # 每分钟 token 数（按提示长度估算，收到响应后按实际用量修正），0 表示不限制
+    "max_concurrency": 8,  # 并发请求数上限（自适应调整的上界）
+    "min_concurrency": 1,
+    "max_queue_seconds": 120,  # 排队等待的最长时间，超过后放弃本次调用
+}
+DEEPSEEK_OVERLOAD_STATUS = (429, 500, 502, 503, 504)
+
+class RateLimitQueueTimeout(TimeoutError):
+    """API 调用在限流队列中等待超时"""
+    pass
+
+def load_rate_limit_config() -> Dict[str, float]:
+    """从本地配置文件加载 DeepSeek API 限流配置（配置项 "deepseek_rate_limit"，未设置的字段使用默认值）"""
+    config = dict(DEEPSEEK_RATE_LIMIT_DEFAULTS)
+    try:
+        custom = read_config_file().get("deepseek_rate_limit") or {}
+        for key in config:
+            if isinstance(custom.get(key), (int, float)) and custom[key] >= 0:
+                config[key] = custom[key]
+    except Exception:
+        pass
+    config["max_concurrency"] = max(1, int(config["max_concurrency"]))
+    config["min_concurrency"] = max(1, min(int(config["min_concurrency"]), config["max_concurrency"]))
+    return config
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数（中文约 0.6 token/字，其他字符约 0.3 token/字符）"""
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的配额，按秒连续补充
+
+    reserve 允许余额为负（预约），返回需要等待的秒数，等待结束时预约的配额正好补足。
+    """
+    def __init__(self, per_minute: float):
+        import time
+        
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        import time
+        
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            # 单次请求超过桶容量时按容量计算，避免永远等不到
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / self.rate)
+
+    def adjust(self, delta: float):
+        """修正预约量（delta 为实际用量与预约量之差，正数表示多扣）"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - delta)
+
+class _RatePermit:
+    """一次 API 调用的许可，调用结束后由调用方填写结果（状态码、实际 token 用量、Retry-After）"""
+    def __init__(self, limiter, estimated_tokens: int):
+        self.limiter = limiter
+        self.estimated_tokens = estimated_tokens
+        self.status_code = None
+        self.tokens_used = None
+        self.retry_after = None
+        self.wait_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import requests
+        
+        if exc_type is not None and issubclass(exc_type, requests.exceptions.Timeout):
+            self.status_code = "timeout"  # 超时同样视为服务端过载信号
+        self.limiter._release(self)
+        return False
+
+class DeepSeekRateLimiter:
+    """DeepSeek API 客户端限流器
+
+    - 请求数和 token 数各用一个令牌桶（RPM / TPM）限制速率；
+    - 并发数按 AIMD 自适应调整：请求成功时缓慢增加（每轮加 1），收到 429/5xx 或超时时减半；
+    - 收到 429 时所有调用方一起暂停（优先使用 Retry-After），而不是各自重试再次触发限流。
+    """
+    def __init__(self, requests_per_minute: float = 60, tokens_per_minute: float = 200000,
+                 max_concurrency: int = 8, min_concurrency: int = 1, max_queue_seconds: float = 120):
+        import time
+        
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_queue_seconds = max_queue_seconds
+        self.concurrency_limit = float(max(min_concurrency, min(4, max_concurrency)))
+        self._in_flight = 0
+        self._waiting = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._started = time.monotonic()
+        self._cond = threading.Condition()
+        self._stats = {"requests": 0, "throttled": 0, "overloaded": 0, "queue_timeouts": 0,
+                       "total_wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def acquire(self, estimated_tokens: int, timeout: float = None, request_cap: TokenBucket = None) -> _RatePermit:
+        """排队获取一次调用许可（阻塞），返回的许可用于 with 语句
+
+        request_cap 为调用方额外的每分钟请求数上限（例如批量问答的 RPM 设置），与全局的 RPM / TPM 同时生效。
+
+        Raises:
+            RateLimitQueueTimeout: 等待超过 timeout（默认 max_queue_seconds）
+        """
+        import time
+        
+        timeout = self.max_queue_seconds if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                while self._in_flight >= int(self.concurrency_limit) or time.monotonic() < self._paused_until:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["queue_timeouts"] += 1
+                        raise RateLimitQueueTimeout(f"API 调用排队超过 {timeout:g} 秒（当前并发上限 "
+                                                    f"{int(self.concurrency_limit)}，排队 {self._waiting} 个）")
+                    pause_left = self._paused_until - time.monotonic()
+                    self._cond.wait(min(remaining, pause_left) if pause_left > 0 else remaining)
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+        
+        # 速率限制：按预约量等待，等待期间占用并发名额，避免等待结束时瞬间涌出大量请求
+        wait = 0.0
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.reserve(estimated_tokens))
+        if request_cap:
+            wait = max(wait, request_cap.reserve(1))
+        if wait:
+            time.sleep(wait)
+        
+        permit = _RatePermit(self, estimated_tokens)
+        permit.wait_seconds = time.monotonic() - started
+        with self._cond:
+            self._stats["requests"] += 1
+            self._stats["total_wait_seconds"] += permit.wait_seconds
+            self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], permit.wait_seconds)
+        return permit
+
+    def _release(self, permit: _RatePermit):
+        import time
+        
+        if self.token_bucket and permit.tokens_used is not None:
+            self.token_bucket.adjust(permit.tokens_used - permit.estimated_tokens)
+        
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if permit.status_code in DEEPSEEK_OVERLOAD_STATUS or permit.status_code == "timeout":
+                self._stats["overloaded"] += 1
+                # 同一批并发请求同时失败时只减半一次
+                if now - self._last_decrease > 2:
+                    self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                    self._last_decrease = now
+                if permit.status_code == 429:
+                    self._stats["throttled"] += 1
+                    try:
+                        pause = float(permit.retry_after)
+                    except (TypeError, ValueError):
+                        pause = 2.0
+                    self._paused_until = max(self._paused_until, now + min(pause, 60))
+            elif permit.status_code == 200:
+                self.concurrency_limit = min(self.max_concurrency,
+                                             self.concurrency_limit + 1 / self.concurrency_limit)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """限流器状态：排队数、并发数和等待时间"""
+        import time
+        
+        with self._cond:
+            requests_count = self._stats["requests"]
+            return {
+                "waiting": self._waiting,
+                "in_flight": self._in_flight,
+                "concurrency_limit": int(self.concurrency_limit),
+                "paused_seconds": round(max(0.0, self._paused_until - time.monotonic()), 1),
+                "requests": requests_count,
+                "throttled": self._stats["throttled"],
+                "overloaded": self._stats["overloaded"],
+                "queue_timeouts": self._stats["queue_timeouts"],
+                "avg_wait_seconds": round(self._stats["total_wait_seconds"] / requests_count, 2) if requests_count else 0.0,
+                "max_wait_seconds": round(self._stats["max_wait_seconds"], 2)
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_deepseek_rate_limiter() -> DeepSeekRateLimiter:
+    """进程级共享的 DeepSeek API 限流器（配置修改后需重启应用生效）"""
+    return DeepSeekRateLimiter(**load_rate_limit_config())
+
+# DeepSeek 请求截止时间与对冲模块
+DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
+DEEPSEEK_CALL_DEADLINE = 120  # 单次调用（含所有重试）的总时间上限（秒）
+DEEPSEEK_HEDGING_DEFAULTS = {
+    "enabled": False,  # 对冲请求会重复消耗 token，默认关闭
+    "percentile": 0.95,  # 对冲延迟取最近成功请求耗时的分位数
+    "min_samples": 20,  # 样本不足时不对冲
+    "min_delay_seconds": 2.0,
+}
+
+class RequestCancelled(Exception):
+    """对冲请求在发出前被取消（另一个请求已经成功返回）"""
+    pass
+
+def load_hedging_config() -> Dict[str, Any]:
+    """从本地配置文件加载请求对冲配置（配置项 "deepseek_hedging"，未设置的字段使用默认值）"""
+    config = dict(DEEPSEEK_HEDGING_DEFAULTS)
+    try:
+        custom = read_config_file().get("deepseek_hedging") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+class LatencyTracker:
+    """记录最近成功请求的耗时，用于计算对冲延迟"""
+    def __init__(self, max_samples: int = 200):
+        from collections import deque
+        
+        self._samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+        self.hedges = 0  # 发出的对冲请求数
+        self.hedge_wins = 0  # 对冲请求先于原请求返回的次数
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def record_hedge(self, won: bool = False):
+        with self._lock:
+            if won:
+                self.hedge_wins += 1
+            else:
+                self.hedges += 1
+
+    def percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.percentile(0.5)
+        p95 = self.percentile(0.95)
+        with self._lock:
+            return {
+                "samples": len(self._samples),
+                "p50_seconds": round(p50, 2) if p50 is not None else None,
+                "p95_seconds": round(p95, 2) if p95 is not None else None,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_deepseek_latency_tracker() -> LatencyTracker:
+    """进程级共享的 DeepSeek 请求耗时统计"""
+    return LatencyTracker()
+
+def _post_deepseek(headers: Dict[str, str], data: Dict[str, Any], timeout: float, estimated_tokens: int,
+                   queue_timeout: float, is_hedge: bool = False, cancel_event: threading.Event = None,
+                   request_cap: TokenBucket = None):
+    """经过限流器发送一次请求，返回 (response, result, info)，info 中为本次请求的耗时、排队时间和是否对冲
+
+    对冲请求只使用空闲的并发名额（不排队）；在发出前被取消时抛出 RequestCancelled。
+    """
+    import requests
+    import time
+    
+    with get_deepseek_rate_limiter().acquire(estimated_tokens, timeout=0 if is_hedge else queue_timeout,
+                                             request_cap=request_cap) as permit:
+        if cancel_event is not None and cancel_event.is_set():
+            raise RequestCancelled()
+        started = time.monotonic()
+        with requests.Session() as session:
+            response = session.post(DEEPSEEK_API_URL, headers=headers, json=data, timeout=timeout)
+        permit.status_code = response.status_code
+        permit.retry_after = response.headers.get("Retry-After")
+        result = response.json() if response.status_code == 200 else None
+        if result:
+            permit.tokens_used = (result.get("usage") or {}).get("total_tokens")
+    info = {"latency_seconds": time.monotonic() - started, "queue_wait_seconds": permit.wait_seconds, "hedged": False}
+    if response.status_code == 200:
+        get_deepseek_latency_tracker().record(info["latency_seconds"])
+        get_prompt_cache_stats().record((result or {}).get("usage") or {})
+    return response, result, info
+
+def _post_deepseek_hedged(headers: Dict[str, str], data: Dict[str, Any], timeout: float, estimated_tokens: int,
+                          queue_timeout: float, hedge_delay: float, request_cap: TokenBucket = None):
+    """发送请求，超过 hedge_delay 仍未返回时再发出一个相同的请求，使用先成功返回的结果
+
+    另一个请求被放弃：尚未发出时直接取消；已经发出的无法中断，它的超时不超过本次调用的剩余时间，
+    结束后结果被丢弃并释放限流名额。两个请求都失败时按原请求的结果处理。
+    """
+    from concurrent.futures import Future, wait, FIRST_COMPLETED
+    
+    cancel_event = threading.Event()
+    tracker = get_deepseek_latency_tracker()
+    
+    def start(is_hedge: bool, attempt_timeout: float) -> Future:
+        future = Future()
+        def run():
+            try:
+                future.set_result(_post_deepseek(headers, data, attempt_timeout, estimated_tokens,
+                                                 queue_timeout, is_hedge, cancel_event, request_cap))
+            except BaseException as e:
+                future.set_exception(e)
+        threading.Thread(target=run, name="deepseek-hedge" if is_hedge else "deepseek-request", daemon=True).start()
+        return future
+    
+    primary = start(False, timeout)
+    pending = {primary}
+    hedged = False
+    done, _ = wait(pending, timeout=hedge_delay)
+    if not done and timeout - hedge_delay > 1:
+        tracker.record_hedge()
+        pending.add(start(True, timeout - hedge_delay))
+        hedged = True
+    
+    winner = None
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result()[0].status_code == 200:
+                winner = future
+                break
+    if winner is None:
+        winner = primary
+    else:
+        cancel_event.set()
+        if winner is not primary:
+            tracker.record_hedge(won=True)
+    response, result, info = winner.result()
+    info["hedged"] = hedged
+    return response, result, info
+
+# 调用统计模块（每次 DeepSeek 调用的 token 用量和耗时，记录到本地 SQLite）
+LLM_METRICS_DB = os.path.join(".", ".llm_metrics.sqlite3")
+
+_llm_metrics_lock = threading.Lock()
+
+class LLMResult(str):
+    """DeepSeek 调用结果
+
+    本身就是回答文本（失败时为错误提示），原来按字符串使用的代码不需要修改；同时携带本次调用的信息：
+    ok、status_code、error、prompt_tokens、completion_tokens、cached_tokens（上下文缓存命中）、total_tokens、
+    latency_seconds（成功请求的 HTTP 耗时）、queue_wait_seconds（限流排队）、
+    total_seconds（含排队、重试和等待的总耗时）、retries、hedged。
+    请求是非流式的，无法测量首个 token 的到达时间，因此不记录 TTFT。
+    """
+    FIELDS = ("ok", "purpose", "model", "status_code", "error", "prompt_tokens", "completion_tokens",
+              "cached_tokens", "total_tokens", "latency_seconds", "queue_wait_seconds",
+              "total_seconds", "retries", "hedged")
+
+    def __new__(cls, content: str, **metrics):
+        obj = super().__new__(cls, content)
+        for name in cls.FIELDS:
+            setattr(obj, name, metrics.get(name))
+        return obj
+
+    def metrics(self) -> Dict[str, Any]:
+        return {name: getattr(self, name, None) for name in self.FIELDS}
+
+def _connect_llm_metrics():
+    import sqlite3
+    
+    conn = sqlite3.connect(LLM_METRICS_DB, timeout=5)
+    conn.execute("""CREATE TABLE IF NOT EXISTS llm_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        purpose TEXT, model TEXT, ok INTEGER, status_code INTEGER, error TEXT,
+        prompt_tokens INTEGER, completion_tokens INTEGER, cached_tokens INTEGER, total_tokens INTEGER,
+        latency_seconds REAL, queue_wait_seconds REAL, total_seconds REAL,
+        retries INTEGER, hedged INTEGER)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_created_at ON llm_calls (created_at)")
+    return conn
+
+def record_llm_call(result: LLMResult):
+    """把一次调用的统计写入本地数据库（写入失败只打印警告，不影响调用结果）"""
+    import time
+    
+    metrics = result.metrics()
+    metrics["ok"] = int(bool(metrics["ok"]))
+    metrics["hedged"] = int(bool(metrics["hedged"]))
+    try:
+        with _llm_metrics_lock:
+            conn = _connect_llm_metrics()
+            try:
+                conn.execute(
+                    f"INSERT INTO llm_calls (created_at, {', '.join(LLMResult.FIELDS)}) "
+                    f"VALUES (?, {', '.join('?' for _ in LLMResult.FIELDS)})",
+                    [time.time()] + [metrics[name] for name in LLMResult.FIELDS]
+                )
+                conn.commit()
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"[WARN] 记录 API 调用统计失败: {str(e)}")
+
+def summarize_llm_metrics(hours: float = None) -> Dict[str, Any]:
+    """汇总 API 调用统计
+
+    Args:
+        hours: 只统计最近若干小时（None 表示全部）
+
+    Returns:
+        总调用数、失败数、各类 token 合计、缓存命中率、耗时分位数，以及按用途（问答、总结等）的分组统计
+    """
+    import time
+    
+    summary = {"calls": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+               "cache_hit_rate": 0.0, "avg_latency_seconds": None, "p95_latency_seconds": None,
+               "avg_total_seconds": None, "retries": 0, "hedged": 0, "by_purpose": {}}
+    if not os.path.exists(LLM_METRICS_DB):
+        return summary
+    
+    since = time.time() - hours * 3600 if hours else 0
+    with _llm_metrics_lock:
+        conn = _connect_llm_metrics()
+        try:
+            rows = conn.execute(
+                "SELECT purpose, ok, prompt_tokens, completion_tokens, cached_tokens, latency_seconds, "
+                "total_seconds, retries, hedged FROM llm_calls WHERE created_at >= ?", (since,)
+            ).fetchall()
+        finally:
+            conn.close()
+    
+    latencies = []
+    totals = []
+    for purpose, ok, prompt_tokens, completion_tokens, cached_tokens, latency, total, retries, hedged in rows:
+        group = summary["by_purpose"].setdefault(purpose or "chat", {"calls": 0, "errors": 0, "tokens": 0,
+                                                                      "latency_sum": 0.0, "latency_count": 0})
+        for target in (summary, group):
+            target["calls"] += 1
+            target["errors"] += 0 if ok else 1
+        summary["prompt_tokens"] += prompt_tokens or 0
+        summary["completion_tokens"] += completion_tokens or 0
+        summary["cached_tokens"] += cached_tokens or 0
+        summary["retries"] += retries or 0
+        summary["hedged"] += hedged or 0
+        group["tokens"] += (prompt_tokens or 0) + (completion_tokens or 0)
+        if latency is not None:
+            latencies.append(latency)
+            group["latency_sum"] += latency
+            group["latency_count"] += 1
+        if total is not None:
+            totals.append(total)
+    
+    if summary["prompt_tokens"]:
+        summary["cache_hit_rate"] = round(summary["cached_tokens"] / summary["prompt_tokens"], 3)
+    if latencies:
+        latencies.sort()
+        summary["avg_latency_seconds"] = round(sum(latencies) / len(latencies), 2)
+        summary["p95_latency_seconds"] = round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))], 2)
+    if totals:
+        summary["avg_total_seconds"] = round(sum(totals) / len(totals), 2)
+    for group in summary["by_purpose"].values():
+        count = group.pop("latency_count")
+        latency_sum = group.pop("latency_sum")
+        group["avg_latency_seconds"] = round(latency_sum / count, 2) if count else None
+    return summary
 
 # DeepSeek API接口
 def query_deepseek(prompt: str, api_key: str, model: str = "deepseek-chat", max_tokens: int = 2000, 
-                   max_retries: int = 3, timeout: int = None):
+                   max_retries: int = 3, timeout: int = None, deadline: float = None, hedge: bool = None,
+                   purpose: str = "chat", request_cap: TokenBucket = None) -> LLMResult:
     """调用DeepSeek API，带重试机制
     
+    返回 LLMResult：可以直接当作回答文本使用，同时带有 token 用量和耗时，每次调用都会记录到本地统计数据库。
+    
     Args:
         prompt: 提示文本
         api_key: DeepSeek API密钥
         model: 模型名称
         max_tokens: 最大token数
         max_retries: 最大重试次数
-        timeout: 超时时间（秒），如果为None则使用默认值或从session_state获取
+        timeout: 单次请求的超时时间（秒），如果为None则使用默认值或从session_state获取
+        deadline: 整个调用（含所有重试和等待）的总时间上限（秒），如果为None则从session_state获取
+        hedge: 是否启用请求对冲（请求耗时超过最近的 p95 时再发出一个相同的请求），如果为None则使用配置
+        purpose: 调用用途（answer、summary、analysis 等），用于分组统计
+        request_cap: 调用方额外的每分钟请求数上限（TokenBucket），在共享限流器中与全局限制同时生效
     """
     import requests
     import time
@@ -2075,6 +4828,18 @@ def query_deepseek(prompt: str, api_key: str, model: str = "deepseek-chat", max_
         if 'st' in globals() and hasattr(st, 'session_state'):
             max_retries = st.session_state.get('api_max_retries', 3)
     
+    if deadline is None:
+        if 'st' in globals() and hasattr(st, 'session_state'):
+            deadline = st.session_state.get('api_deadline', DEEPSEEK_CALL_DEADLINE)
+        else:
+            deadline = DEEPSEEK_CALL_DEADLINE
+    hedging = load_hedging_config()
+    if hedge is None:
+        if 'st' in globals() and hasattr(st, 'session_state'):
+            hedge = st.session_state.get('api_hedging', hedging["enabled"])
+        else:
+            hedge = hedging["enabled"]
+    
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -2083,54 +4848,97 @@ def query_deepseek(prompt: str, api_key: str, model: str = "deepseek-chat", max_
     data = {
         "model": model,
         "messages": [
-            {"role": "system", "content": "你是一个有帮助的助手，请基于提供的文档内容回答问题。"},
+            {"role": "system", "content": DEEPSEEK_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
         "max_tokens": max_tokens,
         "temperature": 0.3
     }
     
+    # 所有调用共用进程级限流器（RPM/TPM 令牌桶 + 自适应并发）
+    estimated_tokens = estimate_tokens(prompt) + max_tokens
+    
+    # 总截止时间：每次请求的超时、排队和重试等待都不超过剩余时间
+    call_started = time.monotonic()
+    call_deadline = call_started + deadline
+    def remaining() -> float:
+        return call_deadline - time.monotonic()
+    
+    # 最近一次请求的状态，用于生成调用统计
+    last = {"status_code": None, "info": {}, "usage": {}, "queue_wait_seconds": 0.0}
+    
+    def finish(content: str, ok: bool = False, retries: int = 0) -> LLMResult:
+        usage = last["usage"]
+        info = last["info"]
+        latency = info.get("latency_seconds") if ok else None
+        llm_result = LLMResult(
+            content,
+            ok=ok,
+            purpose=purpose,
+            model=model,
+            status_code=last["status_code"],
+            error=None if ok else content[:200],
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            cached_tokens=usage.get("prompt_cache_hit_tokens"),
+            total_tokens=usage.get("total_tokens"),
+            latency_seconds=round(latency, 3) if latency is not None else None,
+            queue_wait_seconds=round(last["queue_wait_seconds"], 3),
+            total_seconds=round(time.monotonic() - call_started, 3),
+            retries=retries,
+            hedged=bool(info.get("hedged"))
+        )
+        record_llm_call(llm_result)
+        return llm_result
+    
     # 重试机制
     for attempt in range(max_retries):
+        # 每次尝试使用相同的超时时间，总耗时由截止时间限制
+        current_timeout = min(timeout, remaining())
+        if current_timeout < 1:
+            return finish(f"请求超时（超过总超时时间 {deadline:g} 秒，已尝试 {attempt} 次）。DeepSeek服务器响应慢或网络不稳定，请稍后重试，或在侧边栏\"高级设置\"中增加总超时时间", retries=attempt)
         try:
-            # 根据尝试次数增加超时时间
-            current_timeout = timeout + (attempt * 20)
-            
-            response = requests.post(
-                "https://api.deepseek.com/v1/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=current_timeout
-            )
+            queue_timeout = min(get_deepseek_rate_limiter().max_queue_seconds, remaining())
+            hedge_delay = None
+            if hedge:
+                p95 = get_deepseek_latency_tracker().percentile(hedging["percentile"], hedging["min_samples"])
+                if p95 is not None:
+                    hedge_delay = max(hedging["min_delay_seconds"], p95)
+            if hedge_delay is not None and hedge_delay < current_timeout:
+                response, result, info = _post_deepseek_hedged(headers, data, current_timeout, estimated_tokens,
+                                                               queue_timeout, hedge_delay, request_cap)
+            else:
+                response, result, info = _post_deepseek(headers, data, current_timeout, estimated_tokens, queue_timeout,
+                                                        request_cap=request_cap)
+            last.update(status_code=response.status_code, info=info, usage=(result or {}).get("usage") or {})
+            last["queue_wait_seconds"] += info["queue_wait_seconds"]
             
             if response.status_code == 200:
-                result = response.json()
                 if "choices" in result and len(result["choices"]) > 0:
-                    return result["choices"][0]["message"]["content"]
+                    return finish(result["choices"][0]["message"]["content"], ok=True, retries=attempt)
                 else:
-                    return "API返回格式异常，请重试"
+                    return finish("API返回格式异常，请重试", retries=attempt)
             elif response.status_code == 401:
-                return "API密钥无效，请检查您的DeepSeek API密钥"
+                return finish("API密钥无效，请检查您的DeepSeek API密钥", retries=attempt)
             elif response.status_code == 429:
-                wait_time = 2 ** attempt  # 指数退避：2秒、4秒、8秒
+                # 限流器已让所有调用方一起暂停（优先按 Retry-After），并降低了并发上限，重试时会自动排队等待
                 if attempt < max_retries - 1:
-                    time.sleep(wait_time)
                     continue
-                return "API请求频率过高，请稍后再试"
+                return finish("API请求频率过高，请稍后再试", retries=attempt)
             elif response.status_code == 500:
                 if attempt < max_retries - 1:
-                    time.sleep(2 ** attempt)
+                    time.sleep(max(0, min(2 ** attempt, remaining())))
                     continue
-                return "DeepSeek服务器错误，请稍后重试"
+                return finish("DeepSeek服务器错误，请稍后重试", retries=attempt)
             elif response.status_code == 400:
                 # 检查是否是上下文长度超限错误
                 error_text = response.text.lower()
                 if "context" in error_text and ("length" in error_text or "exceeded" in error_text or "too long" in error_text):
-                    return "❌ 文档内容过长，超过了API的上下文窗口限制（64K tokens）。\n\n建议：\n1. 减少选择的文档数量\n2. 或者使用分块总结功能（如果可用）\n3. 或者先对每篇文档进行摘要，再总结摘要内容"
+                    return finish("❌ 文档内容过长，超过了API的上下文窗口限制（64K tokens）。\n\n建议：\n1. 减少选择的文档数量\n2. 或者使用分块总结功能（如果可用）\n3. 或者先对每篇文档进行摘要，再总结摘要内容", retries=attempt)
                 else:
-                    return f"API请求参数错误 (状态码: 400): {response.text[:200]}"
+                    return finish(f"API请求参数错误 (状态码: 400): {response.text[:200]}", retries=attempt)
             else:
-                return f"API请求失败 (状态码: {response.status_code}): {response.text[:200]}"
+                return finish(f"API请求失败 (状态码: {response.status_code}): {response.text[:200]}", retries=attempt)
                 
         except requests.exceptions.Timeout:
             if attempt < max_retries - 1:
@@ -2138,10 +4946,10 @@ def query_deepseek(prompt: str, api_key: str, model: str = "deepseek-chat", max_
                 error_msg = f"请求超时（已尝试 {attempt + 1}/{max_retries} 次），{wait_time}秒后重试..."
                 if 'st' in globals():
                     st.warning(error_msg)
-                time.sleep(wait_time)
+                time.sleep(max(0, min(wait_time, remaining())))
                 continue
             else:
-                return f"请求超时（已重试 {max_retries} 次）。可能的原因：\n1. 网络连接不稳定\n2. 请求内容过长\n3. DeepSeek服务器响应慢\n\n建议：\n- 检查网络连接\n- 尝试减少文档内容\n- 稍后重试"
+                return finish(f"请求超时（已重试 {max_retries} 次）。可能的原因：\n1. 网络连接不稳定\n2. 请求内容过长\n3. DeepSeek服务器响应慢\n\n建议：\n- 检查网络连接\n- 尝试减少文档内容\n- 稍后重试", retries=attempt)
         
         except requests.exceptions.ConnectionError:
             if attempt < max_retries - 1:
@@ -2149,144 +4957,822 @@ def query_deepseek(prompt: str, api_key: str, model: str = "deepseek-chat", max_
                 error_msg = f"连接错误（已尝试 {attempt + 1}/{max_retries} 次），{wait_time}秒后重试..."
                 if 'st' in globals():
                     st.warning(error_msg)
-                time.sleep(wait_time)
+                time.sleep(max(0, min(wait_time, remaining())))
                 continue
             else:
-                return "无法连接到DeepSeek API服务器。请检查：\n1. 网络连接是否正常\n2. 是否可以使用代理访问\n3. DeepSeek服务是否正常"
+                return finish("无法连接到DeepSeek API服务器。请检查：\n1. 网络连接是否正常\n2. 是否可以使用代理访问\n3. DeepSeek服务是否正常", retries=attempt)
         
         except requests.exceptions.RequestException as e:
             if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)
+                time.sleep(max(0, min(2 ** attempt, remaining())))
                 continue
-            return f"网络请求异常: {str(e)}"
+            return finish(f"网络请求异常: {str(e)}", retries=attempt)
+        
+        except RateLimitQueueTimeout as e:
+            return finish(f"API请求排队超时：{str(e)}。当前请求较多（多个会话或批量任务正在调用API），请稍后再试", retries=attempt)
         
         except Exception as e:
-            return f"调用API时出错: {str(e)}"
+            return finish(f"调用API时出错: {str(e)}", retries=attempt)
     
-    return "API调用失败，已重试多次仍无法成功"
+    return finish("API调用失败，已重试多次仍无法成功", retries=max(0, max_retries - 1))
+
+def search_similar_documents(vectorstore, query: str, k: int = 4, query_embedding: List[float] = None):
+    """检索相似文档片段
 
-def search_similar_documents(vectorstore, query: str, k: int = 4):
-    """检索相似文档片段"""
+    Args:
+        vectorstore: 向量数据库
+        query: 查询文本
+        k: 返回的文本块数量
+        query_embedding: 已计算好的查询向量（批量计算查询向量时传入，不再重复调用嵌入模型）
+    """
     if vectorstore is None:
         return []
     
     try:
-        docs = vectorstore.similarity_search(query, k=k)
-        return [(doc.page_content, doc.metadata["source"]) for doc in docs]
+        # 有紧凑向量时直接扫描量化向量，不加载 Chroma 的 HNSW 索引
+        compact_index = get_compact_vector_index(getattr(vectorstore, "_persist_directory", None))
+        if compact_index is not None:
+            try:
+                if query_embedding is None:
+                    query_embedding = vectorstore.embeddings.embed_query(query)
+                return [(content, _format_doc_sources(metadata))
+                        for content, metadata in compact_similarity_search(vectorstore, compact_index, [query_embedding], k=k)[0]]
+            except Exception as e:
+                print(f"[WARN] 紧凑向量检索失败，改用完整向量检索: {str(e)}")
+        if query_embedding is not None:
+            docs = vectorstore.similarity_search_by_vector(query_embedding, k=k)
+        else:
+            docs = vectorstore.similarity_search(query, k=k)
+        return [(doc.page_content, _format_doc_sources(doc.metadata)) for doc in docs]
     except:
         return []
 
-def check_web_search_available() -> Tuple[bool, str]:
-    """检查联网搜索库是否可用
-    
-    Returns:
-        (是否可用, 错误信息或成功信息)
+class QueryEmbeddingBatcher:
+    """查询向量批处理器
+
+    并发到达的查询先在队列中等待很短的时间（max_wait_ms），再合并为一次 embed_documents 调用，
+    多个请求共用一次模型前向计算，高并发时吞吐量明显提高。
+    """
+    def __init__(self, embeddings, max_batch_size: int = 32, max_wait_ms: float = 10):
+        import queue
+        
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.stats = {"queries": 0, "batches": 0, "max_batch_size": 0}
+        threading.Thread(target=self._run, name="query-embedding-batcher", daemon=True).start()
+
+    def embed_query(self, text: str, timeout: float = None) -> List[float]:
+        """提交一个查询并等待它所在批次的计算结果"""
+        from concurrent.futures import Future
+        
+        future = Future()
+        self._queue.put((text, future))
+        return future.result(timeout)
+
+    def _run(self):
+        import queue
+        import time
+        
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # 同一批次中相同的查询只计算一次
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for text, future in batch:
+                future.set_result(vectors[text])
+            
+            with self._stats_lock:
+                self.stats["queries"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+
+def _format_doc_sources(metadata: Dict[str, Any]) -> str:
+    """格式化文本块来源（去重合并过的文本块会列出所有来源文件）"""
+    sources = metadata.get("sources")
+    if sources:
+        try:
+            return "、".join(json.loads(sources))
+        except (TypeError, ValueError):
+            pass
+    return metadata["source"]
+
+# 联网搜索模块（进程内只检测一次搜索库，按规范化的查询缓存结果，并对结果去重）
+WEB_SEARCH_CACHE_TTL = 600  # 搜索结果缓存时间（秒）
+WEB_SEARCH_CACHE_SIZE = 256  # 最多缓存的查询数
+
+def load_web_search_backend_config() -> Dict[str, Any]:
+    """从本地配置文件加载搜索后端配置（配置项 "web_search_backend"）
+
+    默认使用 ddgs / duckduckgo-search；{"type": "static", "file": "results.json"} 使用本地 JSON 文件中的结果
+    （离线调试和测试用，文件格式为 {"查询": [{"title", "url", "snippet"}], "*": [...默认结果]}）。
     """
+    try:
+        return read_config_file().get("web_search_backend") or {}
+    except Exception:
+        pass
+    return {}
+
+def normalize_search_query(query: str) -> str:
+    """规范化查询（全角转半角、小写、合并空白、去掉首尾标点），用作缓存键"""
+    import re
+    import unicodedata
+    
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.strip("?？!！。.,，;；:： ")
+
+def _normalize_result_url(url: str) -> str:
+    from urllib.parse import urlsplit, urlunsplit
+    
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return urlunsplit(("", netloc, parts.path.rstrip("/"), parts.query, ""))
+
+def dedup_search_results(results: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """按 URL 和摘要内容去重（同一页面的不同链接形式、转载的相同摘要只保留第一条）"""
+    seen_urls = set()
+    seen_snippets = set()
+    unique = []
+    for result in results:
+        url_key = _normalize_result_url(result.get("url", ""))
+        snippet_key = hashlib.md5(" ".join(result.get("snippet", "").split()).lower().encode("utf-8")).hexdigest() \
+            if result.get("snippet") else None
+        if (url_key and url_key in seen_urls) or (snippet_key and snippet_key in seen_snippets):
+            continue
+        if url_key:
+            seen_urls.add(url_key)
+        if snippet_key:
+            seen_snippets.add(snippet_key)
+        unique.append(result)
+    return unique
+
+def format_search_results(results: List[Dict[str, str]]) -> str:
+    """把结构化搜索结果转换为提供给 AI 的文本"""
+    return "\n\n".join(f"[{i}] {result['title']}\n来源: {result['url']}\n摘要: {result['snippet']}"
+                       for i, result in enumerate(results, 1))
+
+class DDGSSearchBackend:
+    """DuckDuckGo 搜索后端（ddgs，或旧版 duckduckgo_search），每个线程复用一个客户端"""
+    def __init__(self, ddgs_cls, name: str):
+        self.ddgs_cls = ddgs_cls
+        self.name = name
+        self._local = threading.local()
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.ddgs_cls()
+        return client
+
+    def search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        import warnings
+        
+        try:
+            with warnings.catch_warnings():
+                # 旧版库会提示已重命名为 ddgs
+                warnings.filterwarnings("ignore", category=RuntimeWarning)
+                results = list(self._client().text(query, max_results=max_results) or [])
+        except Exception:
+            # 客户端出错后丢弃，下次重新创建
+            self._local.client = None
+            raise
+        return [{"title": r.get("title", ""), "url": r.get("href", ""), "snippet": r.get("body", "")} for r in results]
+
+class StaticSearchBackend:
+    """本地 JSON 文件作为搜索后端（离线调试和测试用）"""
+    name = "static"
+
+    def __init__(self, results: Dict[str, List[Dict[str, str]]]):
+        self.results = {normalize_search_query(query): items for query, items in results.items()}
+        self.calls = 0
+
+    @classmethod
+    def from_file(cls, file_path: str) -> "StaticSearchBackend":
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def search(self, query: str, max_results: int) -> List[Dict[str, str]]:
+        self.calls += 1
+        items = self.results.get(normalize_search_query(query), self.results.get("*", []))
+        return [{"title": item.get("title", ""), "url": item.get("url", ""), "snippet": item.get("snippet", "")}
+                for item in items[:max_results]]
+
+def detect_web_search_backend() -> Tuple[Any, str]:
+    """检测可用的搜索后端，返回 (后端或 None, 说明)"""
+    config = load_web_search_backend_config()
+    if config.get("type") == "static":
+        try:
+            return StaticSearchBackend.from_file(config.get("file", "")), f"使用本地搜索结果文件: {config.get('file')}"
+        except Exception as e:
+            return None, f"本地搜索结果文件不可用: {str(e)}"
+    
     try:
         # 优先尝试使用新的 ddgs 库
         try:
             from ddgs import DDGS
-            # 尝试创建一个实例来验证库是否正常工作
-            with DDGS() as ddgs:
-                pass
-            return True, "ddgs 库已安装并可用"
+            backend = DDGSSearchBackend(DDGS, "ddgs")
+            backend._client()  # 创建一个实例来验证库是否正常工作
+            return backend, "ddgs 库已安装并可用"
         except ImportError:
             # 如果新库不存在，尝试使用旧的 duckduckgo_search 库
             try:
                 from duckduckgo_search import DDGS
+                backend = DDGSSearchBackend(DDGS, "duckduckgo_search")
                 import warnings
-                # 忽略重命名警告
                 with warnings.catch_warnings():
                     warnings.filterwarnings("ignore", category=RuntimeWarning)
-                    with DDGS() as ddgs:
-                        pass
-                return True, "duckduckgo-search 库已安装（建议升级到 ddgs: pip install ddgs）"
+                    backend._client()
+                return backend, "duckduckgo-search 库已安装（建议升级到 ddgs: pip install ddgs）"
             except ImportError:
-                return False, "未安装搜索库，请运行: pip install ddgs（或 pip install duckduckgo-search）"
+                return None, "未安装搜索库，请运行: pip install ddgs（或 pip install duckduckgo-search）"
     except Exception as e:
-        return False, f"搜索库存在问题: {str(e)}"
+        return None, f"搜索库存在问题: {str(e)}"
 
-def web_search(query: str, max_results: int = 3) -> tuple[str, List[Dict[str, str]]]:
-    """执行联网搜索
-    
-    Args:
-        query: 搜索查询
-        max_results: 最大结果数量
-    
-    Returns:
-        (搜索结果文本, 结构化搜索结果列表)
-        搜索结果文本：用于AI回答的文本格式
-        结构化结果列表：包含title, url, snippet的字典列表，用于显示参考来源
+class WebSearchClient:
+    """联网搜索客户端
+
+    - 搜索后端只在第一次使用时检测一次（之前每次点击问答都会新建一个 DDGS 实例来检测）；
+    - 结果按规范化的查询缓存 ttl 秒，相同或只差标点、大小写的问题不再重复请求；
+    - 结果按 URL 和摘要内容去重；出错的结果不缓存。
     """
-    try:
-        # 优先尝试使用新的 ddgs 库
-        try:
-            from ddgs import DDGS
-            
-            with DDGS() as ddgs:
-                results = list(ddgs.text(query, max_results=max_results))
-                
-                if results:
-                    search_results_text = []
-                    structured_results = []
-                    for i, result in enumerate(results, 1):
-                        title = result.get('title', '')
-                        snippet = result.get('body', '')
-                        url = result.get('href', '')
-                        search_results_text.append(f"[{i}] {title}\n来源: {url}\n摘要: {snippet}")
-                        structured_results.append({
-                            'title': title,
-                            'url': url,
-                            'snippet': snippet
-                        })
-                    
-                    return "\n\n".join(search_results_text), structured_results
-                else:
-                    return "", []  # 没有搜索结果
-        except ImportError:
-            # 如果新库不存在，尝试使用旧的 duckduckgo_search 库
-            try:
-                from duckduckgo_search import DDGS
-                import warnings
-                
-                # 忽略重命名警告
-                with warnings.catch_warnings():
-                    warnings.filterwarnings("ignore", category=RuntimeWarning)
-                    with DDGS() as ddgs:
-                        results = list(ddgs.text(query, max_results=max_results))
-                        
-                        if results:
-                            search_results_text = []
-                            structured_results = []
-                            for i, result in enumerate(results, 1):
-                                title = result.get('title', '')
-                                snippet = result.get('body', '')
-                                url = result.get('href', '')
-                                search_results_text.append(f"[{i}] {title}\n来源: {url}\n摘要: {snippet}")
-                                structured_results.append({
-                                    'title': title,
-                                    'url': url,
-                                    'snippet': snippet
-                                })
-                            
-                            return "\n\n".join(search_results_text), structured_results
-                        else:
-                            return "", []  # 没有搜索结果
-            except ImportError:
-                # 如果两个库都不存在，返回空（错误提示已在调用前显示）
-                return "", []
-            except Exception as e:
-                # 旧库调用出错
-                error_msg = str(e)
-                return f"联网搜索时出错: {error_msg}", []
+    def __init__(self, backend=None, ttl: float = WEB_SEARCH_CACHE_TTL, max_entries: int = WEB_SEARCH_CACHE_SIZE):
+        from collections import OrderedDict
+        
+        self._backend = backend
+        self._message = "已指定搜索后端" if backend is not None else None
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"searches": 0, "cache_hits": 0, "errors": 0, "duplicates_removed": 0}
+
+    def available(self) -> Tuple[bool, str]:
+        with self._lock:
+            if self._message is None:
+                self._backend, self._message = detect_web_search_backend()
+            return self._backend is not None, self._message
+
+    def search_results(self, query: str, max_results: int = 3) -> List[Dict[str, str]]:
+        """返回去重后的结构化结果（带缓存）
+
+        Raises:
+            RuntimeError: 没有可用的搜索后端
+        """
+        import time
+        
+        available, message = self.available()
+        if not available:
+            raise RuntimeError(message)
+        
+        key = (normalize_search_query(query), max_results)
+        with self._lock:
+            self.stats["searches"] += 1
+            cached = self._cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                return list(cached[1])
+        
+        try:
+            raw_results = self._backend.search(query, max_results)
+        except Exception:
+            with self._lock:
+                self.stats["errors"] += 1
+            raise
+        results = dedup_search_results(raw_results)
+        
+        with self._lock:
+            self.stats["duplicates_removed"] += len(raw_results) - len(results)
+            self._cache[key] = (time.monotonic() + self.ttl, results)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return list(results)
+
+    def search(self, query: str, max_results: int = 3) -> Tuple[str, List[Dict[str, str]]]:
+        """返回 (提供给 AI 的结果文本, 结构化结果)；出错时结果文本为错误信息"""
+        try:
+            results = self.search_results(query, max_results)
         except Exception as e:
-            # 新库调用出错
-            error_msg = str(e)
-            return f"联网搜索时出错: {error_msg}", []
+            return f"联网搜索时出错: {str(e)}", []
+        return format_search_results(results), results
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_web_search_client() -> WebSearchClient:
+    """进程级共享的联网搜索客户端"""
+    return WebSearchClient()
+
+def check_web_search_available() -> Tuple[bool, str]:
+    """检查联网搜索库是否可用（每个进程只检测一次）
+    
+    Returns:
+        (是否可用, 错误信息或成功信息)
+    """
+    return get_web_search_client().available()
+
+def web_search(query: str, max_results: int = 3) -> tuple[str, List[Dict[str, str]]]:
+    """执行联网搜索（带缓存和去重）
+    
+    Args:
+        query: 搜索查询
+        max_results: 最大结果数量
+    
+    启用重排序时（配置项 "web_search_rerank"）先获取 fetch_results 条结果，再按与问题的相似度保留
+    token 预算内最相关的结果（条数不再受 max_results 限制）。
+    
+    Returns:
+        (搜索结果文本, 结构化搜索结果列表)
+        搜索结果文本：用于AI回答的文本格式
+        结构化结果列表：包含title, url, snippet的字典列表，用于显示参考来源
+    """
+    client = get_web_search_client()
+    rerank = load_web_rerank_config()
+    if not rerank["enabled"]:
+        return client.search(query, max_results)
+    
+    try:
+        results = client.search_results(query, max(int(rerank["fetch_results"]), max_results))
     except Exception as e:
-        return f"联网搜索功能出错: {str(e)}", []
+        return f"联网搜索时出错: {str(e)}", []
+    results = rerank_web_results(query, results, int(rerank["token_budget"]))
+    return format_search_results(results), results
+
+# 联网搜索结果重排序（多取一些结果，用本地嵌入模型按与问题的相似度筛选，控制在 token 预算内）
+WEB_RERANK_DEFAULTS = {
+    "enabled": False,
+    "fetch_results": 10,  # 重排序前获取的搜索结果数
+    "token_budget": 600,  # 保留的搜索结果的 token 上限
+}
+
+def load_web_rerank_config() -> Dict[str, Any]:
+    """从本地配置文件加载联网搜索重排序配置（配置项 "web_search_rerank"，未设置的字段使用默认值）"""
+    config = dict(WEB_RERANK_DEFAULTS)
+    try:
+        custom = read_config_file().get("web_search_rerank") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+def save_web_rerank_config(enable: bool) -> bool:
+    """保存是否启用联网搜索重排序（保留其他重排序参数）"""
+    try:
+        config = {}
+        if os.path.exists(CONFIG_FILE):
+            try:
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            except:
+                pass
+        
+        config.setdefault("web_search_rerank", {})["enabled"] = enable
+        os.makedirs(os.path.dirname(CONFIG_FILE) if os.path.dirname(CONFIG_FILE) else ".", exist_ok=True)
+        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        return True
+    except Exception as e:
+        if 'st' in globals():
+            st.error(f"保存联网搜索重排序配置失败: {str(e)}")
+        return False
+
+def rerank_web_results(question: str, results: List[Dict[str, str]], token_budget: int,
+                       embeddings=None) -> List[Dict[str, str]]:
+    """按与问题的相似度对搜索结果重排序，保留 token 预算内最相关的结果
+
+    问题和所有结果的标题+摘要在一次 embed_documents 调用中计算（嵌入模型已归一化，内积即余弦相似度）。
+    嵌入模型不可用时保持原顺序，只按预算截取。每条结果会加上 score 字段。
+    """
+    if not results:
+        return []
+    
+    ranked = list(results)
+    try:
+        import numpy as np
+        
+        if embeddings is None:
+            embeddings = get_shared_embeddings(load_embedding_model_config())
+        vectors = np.asarray(embeddings.embed_documents(
+            [question] + [f"{result['title']}\n{result['snippet']}" for result in results]
+        ), dtype=np.float32)
+        scores = vectors[1:] @ vectors[0]
+        ranked = [dict(result, score=round(float(score), 4)) for result, score in zip(results, scores)]
+        ranked.sort(key=lambda result: result["score"], reverse=True)
+    except Exception as e:
+        print(f"[WARN] 联网搜索结果重排序失败，保持原顺序: {str(e)}")
+    
+    selected = []
+    used_tokens = 0
+    for result in ranked:
+        tokens = estimate_tokens(f"{result['title']}\n{result['url']}\n{result['snippet']}")
+        # 最相关的一条即使超出预算也保留
+        if selected and used_tokens + tokens > token_budget:
+            continue
+        selected.append(result)
+        used_tokens += tokens
+    return selected
+
+# 相似问题回答缓存模块（同一数据库版本上语义相近的问题直接返回缓存的回答）
+SEMANTIC_CACHE_DEFAULTS = {
+    "enabled": True,
+    "threshold": 0.92,  # 问题向量的余弦相似度阈值（BGE 模型的相似度普遍偏高，不宜设得太低）
+    "max_entries": 500,
+}
+
+def load_semantic_cache_config() -> Dict[str, Any]:
+    """从本地配置文件加载相似问题缓存配置（配置项 "semantic_answer_cache"，未设置的字段使用默认值）"""
+    config = dict(SEMANTIC_CACHE_DEFAULTS)
+    try:
+        custom = read_config_file().get("semantic_answer_cache") or {}
+        config.update({key: custom[key] for key in config if key in custom})
+    except Exception:
+        pass
+    return config
+
+def semantic_cache_scope(vectorstore) -> Optional[str]:
+    """回答缓存的作用域：数据库路径 + 构建时间戳，重建数据库后作用域随之变化；没有持久化路径时不缓存"""
+    db_path = getattr(vectorstore, "_persist_directory", None) if vectorstore is not None else None
+    if not db_path:
+        return None
+    return f"{os.path.normcase(os.path.abspath(db_path))}|{_read_vector_db_generation(db_path)}"
+
+class SemanticAnswerCache:
+    """按问题向量缓存回答
+
+    查找时在同一作用域的缓存中计算余弦相似度（嵌入模型已归一化，内积即余弦相似度），
+    超过阈值时返回最相似的一条。缓存总数超过上限时淘汰最久未命中的条目；
+    同一数据库出现新的构建时间戳后，旧版本的缓存全部丢弃。
+    """
+    def __init__(self, threshold: float = 0.92, max_entries: int = 500):
+        from collections import OrderedDict
+        
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 条目ID -> {"scope", "question", "vector", "answer", "similar_docs", ...}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def _drop_stale(self, scope: str):
+        path = scope.rsplit("|", 1)[0]
+        stale = [entry_id for entry_id, entry in self._entries.items()
+                 if entry["scope"] != scope and entry["scope"].rsplit("|", 1)[0] == path]
+        for entry_id in stale:
+            del self._entries[entry_id]
+        self.invalidated += len(stale)
+
+    def lookup(self, scope: str, vector: List[float], threshold: float = None) -> Optional[Dict[str, Any]]:
+        """查找相似问题的缓存回答，返回 {"question", "answer", "similar_docs", "similarity", "created_at"} 或 None"""
+        import numpy as np
+        
+        threshold = self.threshold if threshold is None else threshold
+        with self._lock:
+            self._drop_stale(scope)
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items() if entry["scope"] == scope]
+            if candidates:
+                scores = np.stack([entry["vector"] for _, entry in candidates]) @ np.asarray(vector, dtype=np.float32)
+                best = int(np.argmax(scores))
+                if scores[best] >= threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return {
+                        "question": entry["question"],
+                        "answer": entry["answer"],
+                        "similar_docs": list(entry["similar_docs"]),
+                        "similarity": float(scores[best]),
+                        "created_at": entry["created_at"]
+                    }
+            self.misses += 1
+            return None
+
+    def store(self, scope: str, question: str, vector: List[float], answer: str,
+              similar_docs: List[Tuple[str, str]] = None):
+        import numpy as np
+        
+        with self._lock:
+            self._drop_stale(scope)
+            self._entries[self._next_id] = {
+                "scope": scope,
+                "question": question,
+                "vector": np.asarray(vector, dtype=np.float32),
+                "answer": str(answer),
+                "similar_docs": list(similar_docs or []),
+                "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, db_path: str = None):
+        """丢弃某个数据库（不传时为全部）的缓存"""
+        with self._lock:
+            if db_path is None:
+                removed = list(self._entries)
+            else:
+                path = os.path.normcase(os.path.abspath(db_path))
+                removed = [entry_id for entry_id, entry in self._entries.items()
+                           if entry["scope"].rsplit("|", 1)[0] == path]
+            for entry_id in removed:
+                del self._entries[entry_id]
+            self.invalidated += len(removed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidated": self.invalidated
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_answer_cache() -> SemanticAnswerCache:
+    """获取进程级的相似问题回答缓存（所有会话共用）"""
+    config = load_semantic_cache_config()
+    return SemanticAnswerCache(float(config["threshold"]), int(config["max_entries"]))
+
+# 对话上下文检索模块（追问时结合最近几轮对话构造检索查询，不额外调用 LLM）
+HISTORY_TOKEN_BUDGET = 600  # 提示词中对话历史的 token 上限
+HISTORY_MAX_TURNS = 3  # 提示词中最多包含的对话轮数
+HISTORY_EMBEDDING_CACHE_SIZE = 64
+HISTORY_TURN_WEIGHTS = (0.5, 0.25)  # 追问时最近两轮对话的向量权重（当前问题为 1）
+_CHINESE_NUMERALS = {"一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10}
+_ORDINAL_PATTERN = r"第\s*([一二两三四五六七八九十]|\d+)\s*(?:点|条|个|项|部分|步|类|种)"
+_FOLLOW_UP_PATTERNS = [
+    r"^(那|那么|还有|另外|然后|所以|而且|此外|再|具体|详细)",
+    r"(它|它们|他们|她们|这个|那个|这些|那些|这点|那点|上面|上述|前面|刚才|之前|其中)",
+    _ORDINAL_PATTERN,
+    r"^(what about|how about|and |why\b|it |that |those |they )",
+]
+
+def _parse_ordinal(text: str) -> Optional[int]:
+    return int(text) if text.isdigit() else _CHINESE_NUMERALS.get(text)
+
+def is_follow_up_question(question: str) -> bool:
+    """判断问题是否是依赖上文的追问（很短，或以"那/还有"开头，或包含指代词、"第二点"等序数）"""
+    import re
+    
+    question = question.strip()
+    if len(question) <= 6:
+        return True
+    lowered = question.lower()
+    return any(re.search(pattern, lowered) for pattern in _FOLLOW_UP_PATTERNS)
+
+def extract_numbered_item(answer: str, number: int) -> str:
+    """从回答中取出第 number 条编号内容（支持 "2." "2、" "(2)" "二、" "**2.**" 等编号格式）"""
+    import re
+    
+    item_pattern = re.compile(r"^\s*(?:#+\s*)?(?:\*\*)?\s*[（(]?\s*([一二三四五六七八九十]|\d+)\s*[\.、)）:：]")
+    for line in answer.splitlines():
+        match = item_pattern.match(line)
+        if match and _parse_ordinal(match.group(1)) == number:
+            return re.sub(r"[*#]", "", line[match.end():]).strip()
+    return ""
+
+def rewrite_follow_up_query(question: str, chat_history: List[Tuple[str, str]]) -> str:
+    """把追问改写为可以独立检索的查询：加上上一轮的问题，"第N点"替换为上一轮回答中对应的条目"""
+    import re
+    
+    if not chat_history or not is_follow_up_question(question):
+        return question
+    last_question, last_answer = chat_history[-1]
+    parts = [last_question]
+    match = re.search(_ORDINAL_PATTERN, question)
+    if match:
+        number = _parse_ordinal(match.group(1))
+        item = extract_numbered_item(str(last_answer), number) if number else ""
+        if item:
+            parts.append(item[:200])
+    parts.append(question)
+    return " ".join(parts)
+
+def build_conversational_query(question: str, chat_history: List[Tuple[str, str]], embeddings=None,
+                               cache: Dict[str, List[float]] = None) -> Tuple[str, Optional[List[float]], bool]:
+    """构造结合对话上下文的检索查询
+
+    追问时检索向量为 改写后的查询 与最近两轮对话的向量加权和（归一化），历史对话的向量缓存在 cache 中
+    （每轮只计算一次），本次需要计算的文本合并为一次 embed_documents 调用。
+
+    Returns:
+        (检索查询文本, 检索向量（不是追问或没有嵌入模型时为 None）, 是否为追问)
+    """
+    if not chat_history or not is_follow_up_question(question):
+        return question, None, False
+    
+    retrieval_query = rewrite_follow_up_query(question, chat_history)
+    if embeddings is None:
+        return retrieval_query, None, True
+    
+    import numpy as np
+    
+    cache = cache if cache is not None else {}
+    turns = [f"{q}\n{str(a)[:300]}" for q, a in reversed(chat_history[-len(HISTORY_TURN_WEIGHTS):])]
+    turn_keys = [hashlib.md5(turn.encode("utf-8")).hexdigest() for turn in turns]
+    missing = [(key, turn) for key, turn in zip(turn_keys, turns) if key not in cache]
+    vectors = embeddings.embed_documents([retrieval_query] + [turn for _, turn in missing])
+    for (key, _), vector in zip(missing, vectors[1:]):
+        cache[key] = vector
+    while len(cache) > HISTORY_EMBEDDING_CACHE_SIZE:
+        cache.pop(next(iter(cache)))
+    
+    combined = np.asarray(vectors[0], dtype=np.float32)
+    for key, weight in zip(turn_keys, HISTORY_TURN_WEIGHTS):
+        combined = combined + weight * np.asarray(cache[key], dtype=np.float32)
+    norm = np.linalg.norm(combined)
+    return retrieval_query, (combined / norm if norm else combined).tolist(), True
+
+def format_chat_history_for_prompt(chat_history: List[Tuple[str, str]], token_budget: int = HISTORY_TOKEN_BUDGET,
+                                   max_turns: int = HISTORY_MAX_TURNS) -> str:
+    """取最近几轮对话（回答截断），从最近一轮往前加入，直到达到 token 预算"""
+    turns = []
+    used_tokens = 0
+    for question, answer in reversed(chat_history[-max_turns:]):
+        answer_text = str(answer)
+        turn = f"问：{question}\n答：{answer_text[:400]}{'...' if len(answer_text) > 400 else ''}"
+        tokens = estimate_tokens(turn)
+        if used_tokens + tokens > token_budget:
+            break
+        turns.append(turn)
+        used_tokens += tokens
+    return "\n\n".join(reversed(turns))
+
+# 问答上下文并发获取模块（联网搜索与本地检索同时进行，各自有超时）
+WEB_SEARCH_TIMEOUT = 8  # 联网搜索的等待上限（秒），超时后只使用本地文档回答
+LOCAL_RETRIEVAL_TIMEOUT = 60  # 本地检索的等待上限（秒，首次检索包含嵌入模型加载）
+
+def gather_answer_context(question: str, vectorstore, enable_web_search: bool, k: int = 4, retrieve: bool = True,
+                          web_timeout: float = WEB_SEARCH_TIMEOUT,
+                          retrieval_timeout: float = LOCAL_RETRIEVAL_TIMEOUT,
+                          retrieval_query: str = None, query_embedding: List[float] = None) -> Dict[str, Any]:
+    """并发执行联网搜索和本地向量检索
+
+    两个来源互不依赖，同时开始；联网搜索超过 web_timeout 时放弃（不等待其结束），只使用本地检索结果。
+    retrieval_query / query_embedding 为结合对话上下文改写后的检索查询和检索向量（不传时使用 question）。
+
+    Returns:
+        {"similar_docs": [(内容, 来源)], "web_results": 搜索结果文本, "web_refs": 结构化搜索结果,
+         "web_status": disabled|ok|empty|error|timeout, "web_error": 错误信息,
+         "local_status": skipped|ok|timeout|error, "timings": {来源: 耗时秒数}}
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+    
+    started = time.monotonic()
+    context = {"similar_docs": [], "web_results": "", "web_refs": [], "web_status": "disabled", "web_error": "",
+               "local_status": "skipped", "timings": {}}
+    
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="answer-context",
+                                  initializer=_script_run_ctx_initializer())
+    
+    def submit(name: str, func, *args):
+        def run():
+            source_started = time.monotonic()
+            try:
+                return func(*args)
+            finally:
+                context["timings"][name] = round(time.monotonic() - source_started, 3)
+        return executor.submit(run)
+    
+    try:
+        search_query = retrieval_query or question
+        web_future = submit("web", web_search, search_query, 3) if enable_web_search else None
+        local_future = submit("local", search_similar_documents, vectorstore, search_query, k, query_embedding) \
+            if retrieve and vectorstore is not None else None
+        
+        if local_future is not None:
+            try:
+                context["similar_docs"] = local_future.result(timeout=retrieval_timeout)
+                context["local_status"] = "ok"
+            except FutureTimeoutError:
+                context["local_status"] = "timeout"
+                print(f"[WARN] 本地检索超过 {retrieval_timeout} 秒，使用全部文档内容回答")
+            except Exception as e:
+                context["local_status"] = "error"
+                print(f"[WARN] 本地检索失败: {str(e)}")
+        
+        if web_future is not None:
+            # 联网搜索的超时从开始时计算，与本地检索重叠的时间不重复等待
+            try:
+                web_results, web_refs = web_future.result(timeout=max(0.0, web_timeout - (time.monotonic() - started)))
+                if web_results.startswith("联网搜索时出错") or web_results.startswith("联网搜索功能出错"):
+                    context["web_status"] = "error"
+                    context["web_error"] = web_results
+                elif web_results:
+                    context.update(web_status="ok", web_results=web_results, web_refs=web_refs)
+                else:
+                    context["web_status"] = "empty"
+            except FutureTimeoutError:
+                context["web_status"] = "timeout"
+                print(f"[WARN] 联网搜索超过 {web_timeout} 秒，只使用本地文档回答")
+            except Exception as e:
+                context["web_status"] = "error"
+                context["web_error"] = f"联网搜索出错: {str(e)}"
+    finally:
+        # 不等待超时的来源结束，它们的结果被丢弃
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    context["timings"]["total"] = round(time.monotonic() - started, 3)
+    return context
+
+# 提示词组装模块（稳定内容在前，便于命中 DeepSeek 的上下文缓存）
+# DeepSeek 会缓存请求的公共前缀，命中部分计费更低、首字延迟更短。因此提示词按
+# 系统提示 → 文档内容（固定顺序）→ 联网搜索结果 → 回答要求和问题 的顺序组装，
+# 同一批文档上的连续提问、同一份文档的不同模版总结可以共用前缀。
+DEEPSEEK_SYSTEM_PROMPT = "你是一个有帮助的助手，请基于提供的文档内容回答问题。"
+
+def format_context_blocks(blocks: List[Tuple[str, str]], max_chars: int = None) -> str:
+    """把 [(内容, 来源)] 按来源和内容排序后拼接（与检索得分无关的固定顺序），超出 max_chars 的部分截断"""
+    context = "\n\n".join(f"来自文档 '{source}' 的内容:\n{content}"
+                          for content, source in sorted(blocks, key=lambda block: (block[1], block[0])))
+    return context[:max_chars] if max_chars else context
+
+def assemble_prompt(sections: List[Tuple[str, str]], instruction: str) -> str:
+    """按给定顺序拼接 [(标题, 内容)]（空内容跳过），最后附上随问题变化的要求
+
+    sections 应按稳定程度从高到低排列：文档内容在前，联网搜索结果等每次都不同的内容在后。
+    """
+    parts = [f"{title}：\n{content}" for title, content in sections if content]
+    parts.append(instruction)
+    return "\n\n".join(parts)
+
+def render_template_content_first(template_str: str, placeholder: str, value: str, title: str) -> str:
+    """把模版中的占位符内容移到提示词开头，模版本身（各不相同）放在后面
+
+    模版中的占位符替换为"（标题见上文）"，不包含该占位符的模版按原样填充。
+    """
+    if "{" + placeholder + "}" not in template_str:
+        return template_str.format(**{placeholder: value})
+    return assemble_prompt([(title, value)], template_str.format(**{placeholder: f"（{title}见上文）"}))
 
-def answer_with_deepseek(question: str, vectorstore, docs_dict: Dict[str, Any], api_key: str, enable_web_search: bool = False, web_search_results: str = "", web_search_refs: List[Dict[str, str]] = None):
+class PromptCacheStats:
+    """累计 DeepSeek 返回的上下文缓存命中情况（usage 中的 prompt_cache_hit_tokens / prompt_cache_miss_tokens）"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+
+    def record(self, usage: Dict[str, Any]):
+        hit = usage.get("prompt_cache_hit_tokens")
+        miss = usage.get("prompt_cache_miss_tokens")
+        if hit is None and miss is None:
+            return
+        with self._lock:
+            self.calls += 1
+            self.hit_tokens += hit or 0
+            self.miss_tokens += miss or 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hit_tokens + self.miss_tokens
+            return {
+                "calls": self.calls,
+                "hit_tokens": self.hit_tokens,
+                "miss_tokens": self.miss_tokens,
+                "hit_rate": round(self.hit_tokens / total, 3) if total else 0.0
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache_stats() -> PromptCacheStats:
+    """进程级共享的上下文缓存命中统计"""
+    return PromptCacheStats()
+
+def answer_with_deepseek(question: str, vectorstore, docs_dict: Dict[str, Any], api_key: str, enable_web_search: bool = False, web_search_results: Optional[str] = None, web_search_refs: List[Dict[str, str]] = None,
+                        similar_docs: List[Tuple[str, str]] = None, purpose: str = "answer",
+                        chat_history: List[Tuple[str, str]] = None, request_cap: TokenBucket = None):
     """使用DeepSeek回答问题
     
     Args:
@@ -2295,113 +5781,701 @@ def answer_with_deepseek(question: str, vectorstore, docs_dict: Dict[str, Any],
         docs_dict: 文档字典
         api_key: API密钥
         enable_web_search: 是否启用联网搜索
-        web_search_results: 联网搜索结果文本（如果已在外部执行搜索，可以传入）
+        web_search_results: 联网搜索结果文本（如果已在外部执行搜索，可以传入；空字符串表示已搜索但没有可用结果）
         web_search_refs: 联网搜索结果的结构化数据（用于显示参考来源）
+        similar_docs: 已检索到的文档片段 [(内容, 来源)]（如果已在外部检索，可以传入，避免重复检索）
+        purpose: 调用用途（用于调用统计分组）
+        chat_history: 最近的对话 [(问题, 回答)]，传入时在提示词中附上按 token 预算截取的对话历史
+        request_cap: 调用方额外的每分钟请求数上限（传给 query_deepseek）
     """
-    # 检索相关文档片段
-    similar_docs = search_similar_documents(vectorstore, question)
+    # 没有传入的检索结果和联网搜索结果并发获取（联网搜索超时后只使用本地文档）
+    need_web_search = enable_web_search and web_search_results is None
+    if similar_docs is None or need_web_search:
+        retrieval_query = rewrite_follow_up_query(question, chat_history) if chat_history else None
+        context = gather_answer_context(question, vectorstore, need_web_search, retrieve=similar_docs is None,
+                                        retrieval_query=retrieval_query)
+        if similar_docs is None:
+            similar_docs = context["similar_docs"]
+        if need_web_search:
+            web_search_results = context["web_results"]
+    web_search_results = web_search_results or ""
     
+    # 文档内容按固定顺序排列（全部文档按文件名，检索片段按来源和内容），同一批文档上的提问共用提示词前缀
+    context_limit = 6000 if enable_web_search and web_search_results else 8000
     if not similar_docs:
         # 如果没有向量数据库，使用所有文档内容
-        context = "\n\n".join([f"文件: {name}\n内容: {data['content'][:2000]}..." 
-                             for name, data in docs_dict.items()])
+        context = "\n\n".join([f"文件: {name}\n内容: {docs_dict[name]['content'][:2000]}..." 
+                             for name in sorted(docs_dict)])[:context_limit]
     else:
         # 使用检索到的文档片段
-        context_parts = []
-        for content, source in similar_docs:
-            context_parts.append(f"来自文档 '{source}' 的内容:\n{content}")
-        context = "\n\n".join(context_parts)
+        context = format_context_blocks(similar_docs, max_chars=context_limit)
+    
+    # 对话历史随每轮变化，放在文档内容之后、问题之前
+    history_text = format_chat_history_for_prompt(chat_history) if chat_history else ""
+    history_sections = [("对话历史（供理解当前问题中的指代）", history_text)] if history_text else []
+    
+    # 构建提示（文档内容在前，随问题变化的联网搜索结果、对话历史和问题在后）
+    if enable_web_search and web_search_results:
+        # 有联网搜索结果
+        prompt = assemble_prompt(
+            [("相关文档内容", context), ("联网搜索结果", web_search_results[:2000])] + history_sections,
+            f"""请优先基于文档内容回答，如果文档中没有相关信息，可以参考联网搜索结果。请在回答中明确说明是否使用了联网搜索结果。
+
+问题：{question}"""
+        )
+    elif enable_web_search and not web_search_results:
+        # 启用了联网搜索但没有结果
+        prompt = assemble_prompt(
+            [("相关文档内容", context)] + history_sections,
+            f"""注意：已启用联网搜索功能，但未能获取到相关的联网搜索结果。请基于文档内容回答，如果文档中没有相关信息，请明确说明。
+
+问题：{question}"""
+        )
+    else:
+        # 未启用联网搜索
+        prompt = assemble_prompt(
+            [("相关文档内容", context)] + history_sections,
+            f"""请基于上述文档内容回答，如果文档中没有相关信息，请明确说明。
+
+问题：{question}"""
+        )
+
+    return query_deepseek(prompt, api_key, purpose=purpose, request_cap=request_cap)
+
+def generate_summary_deepseek(docs_dict: Dict[str, Any], api_key: str, specific_files: List[str] = None, template_id: str = "default"):
+    """使用DeepSeek生成总结报告
+    
+    Args:
+        docs_dict: 文档字典
+        api_key: API密钥
+        specific_files: 特定文件列表（None表示所有文件）
+        template_id: 使用的模版ID（默认为"default"）
+    """
+    # 提取内容（按文件名排序，同一组文档的内容顺序固定，便于命中上下文缓存）
+    contents = []
+    if specific_files:
+        for filename in sorted(specific_files):
+            if filename in docs_dict:
+                content = docs_dict[filename]['content']
+                if isinstance(content, dict):
+                    # 移除字段长度限制，让API自行处理
+                    content = "\n".join([f"{k}: {v}" for k, v in content.items()])
+                contents.append(f"文件: {filename}\n{content}")
+    else:
+        for filename in sorted(docs_dict):
+            content = docs_dict[filename]['content']
+            if isinstance(content, dict):
+                # 移除字段长度限制，让API自行处理
+                content = "\n".join([f"{k}: {v}" for k, v in content.items()])
+            contents.append(f"文件: {filename}\n{content}")
+    
+    combined_content = "\n\n".join(contents)
+    
+    # 加载模版
+    template_data = get_template("summary", template_id)
+    if template_data:
+        template_str = template_data.get("template", "")
+        # 替换模版中的占位符（移除字符限制，让API自行处理）；文档内容放在模版前面，不同模版共用前缀
+        prompt = render_template_content_first(template_str, "content", combined_content, "文档内容")
+    else:
+        # 如果模版不存在，使用默认模版
+        prompt = f"""文档内容：
+{combined_content}
+
+请根据以上文档内容，生成一份详细的总结报告，包括以下部分：
+1. 整体内容概述
+2. 核心要点总结
+3. 关键数据/信息提取
+4. 主要发现和洞察
+5. 建议和下一步行动
+
+报告："""
+
+    return query_deepseek(prompt, api_key, max_tokens=3000, purpose="summary")
+
+# 对话历史存储模块（问答记录按用户和文件夹追加写入本地 SQLite，支持分页加载、全文搜索和流式导出）
+CHAT_HISTORY_DB = os.path.join(".", ".chat_history.sqlite3")
+CHAT_SESSION_TURNS = 5  # 会话中保留的最近对话轮数（用于结合对话上下文检索），完整历史只保存在数据库中
+
+_chat_history_lock = threading.Lock()
+
+def _connect_chat_history():
+    """打开对话历史数据库，返回 (连接, 全文索引类型)
+
+    全文索引优先使用 trigram 分词（SQLite 3.34+，可按任意三个字以上的片段匹配中文），
+    不支持时退回 unicode61，SQLite 未编译 FTS5 时为 None（搜索使用 LIKE）。
+    """
+    import sqlite3
+    
+    conn = sqlite3.connect(CHAT_HISTORY_DB, timeout=5)
+    conn.execute("""CREATE TABLE IF NOT EXISTS chat_turns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at REAL NOT NULL,
+        user_id TEXT NOT NULL, folder TEXT NOT NULL, conversation_id TEXT,
+        question TEXT NOT NULL, answer TEXT NOT NULL, sources TEXT, cached INTEGER DEFAULT 0)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_turns_owner ON chat_turns (user_id, folder, id)")
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'chat_turns_fts'").fetchone()
+    if row is None:
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                conn.execute(f"CREATE VIRTUAL TABLE chat_turns_fts USING fts5("
+                             f"question, answer, content='chat_turns', content_rowid='id', tokenize='{tokenizer}')")
+                conn.execute("""CREATE TRIGGER IF NOT EXISTS chat_turns_fts_insert AFTER INSERT ON chat_turns BEGIN
+                    INSERT INTO chat_turns_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+                    END""")
+                conn.execute("INSERT INTO chat_turns_fts (chat_turns_fts) VALUES ('rebuild')")
+                conn.commit()
+                return conn, tokenizer
+            except sqlite3.OperationalError:
+                continue
+        return conn, None
+    return conn, "trigram" if "trigram" in row[0] else "unicode61"
+
+def current_chat_user() -> str:
+    """当前用户标识：启用了 Streamlit 登录时为登录邮箱，否则为 "local"（本机单用户）"""
+    try:
+        user = getattr(st, "user", None) or getattr(st, "experimental_user", None)
+        email = user.get("email") if user is not None else None
+        if email:
+            return str(email)
+    except Exception:
+        pass
+    return "local"
+
+def chat_history_folder_key(folder_path: Optional[str]) -> str:
+    """对话历史按文件夹区分（规范化后的绝对路径，上传文件和未加载文件夹时为空字符串）"""
+    return os.path.normcase(os.path.abspath(folder_path)) if folder_path else ""
+
+def append_chat_turn(user_id: str, folder: str, conversation_id: str, question: str, answer: str,
+                     sources: List[str] = None, cached: bool = False) -> Optional[int]:
+    """追加一轮问答（只追加不修改），返回记录ID；写入失败只打印警告，返回 None"""
+    import time
+    
+    try:
+        with _chat_history_lock:
+            conn, _ = _connect_chat_history()
+            try:
+                cursor = conn.execute(
+                    "INSERT INTO chat_turns (created_at, user_id, folder, conversation_id, question, answer, sources, cached) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (time.time(), user_id, folder, conversation_id, question, str(answer),
+                     json.dumps(sources or [], ensure_ascii=False), int(bool(cached)))
+                )
+                conn.commit()
+                return cursor.lastrowid
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"[WARN] 保存对话历史失败: {str(e)}")
+        return None
+
+def _chat_turn_row_to_dict(row) -> Dict[str, Any]:
+    turn_id, created_at, conversation_id, question, answer, sources, cached = row[:7]
+    return {
+        "id": turn_id,
+        "created_at": datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M:%S"),
+        "conversation_id": conversation_id,
+        "question": question,
+        "answer": answer,
+        "sources": json.loads(sources) if sources else [],
+        "cached": bool(cached)
+    }
+
+def count_chat_turns(user_id: str, folder: str) -> int:
+    if not os.path.exists(CHAT_HISTORY_DB):
+        return 0
+    with _chat_history_lock:
+        conn, _ = _connect_chat_history()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM chat_turns WHERE user_id = ? AND folder = ?",
+                                (user_id, folder)).fetchone()[0]
+        finally:
+            conn.close()
+
+def load_chat_history_page(user_id: str, folder: str, before_id: int = None, limit: int = 10,
+                           conversation_id: str = None) -> List[Dict[str, Any]]:
+    """按时间倒序加载一页问答记录
+
+    Args:
+        before_id: 只返回ID小于该值的记录（传入上一页最后一条的ID即可加载下一页）
+        conversation_id: 只加载某次对话
+    """
+    if not os.path.exists(CHAT_HISTORY_DB):
+        return []
+    sql = ("SELECT id, created_at, conversation_id, question, answer, sources, cached FROM chat_turns "
+           "WHERE user_id = ? AND folder = ?")
+    params = [user_id, folder]
+    if before_id is not None:
+        sql += " AND id < ?"
+        params.append(before_id)
+    if conversation_id:
+        sql += " AND conversation_id = ?"
+        params.append(conversation_id)
+    sql += " ORDER BY id DESC LIMIT ?"
+    params.append(limit)
+    with _chat_history_lock:
+        conn, _ = _connect_chat_history()
+        try:
+            return [_chat_turn_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+def search_chat_history(user_id: str, folder: str, query: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """在历史问答中全文搜索（多个关键词以空格分隔，需同时出现），结果附带 snippet 摘要
+
+    全文索引可用且每个关键词都能被分词器匹配时使用 FTS5（按相关度排序），
+    否则（如 trigram 分词下少于三个字的中文关键词）使用 LIKE 按时间倒序查找。
+    """
+    terms = [term for term in query.split() if term]
+    if not terms or not os.path.exists(CHAT_HISTORY_DB):
+        return []
+    
+    with _chat_history_lock:
+        conn, tokenizer = _connect_chat_history()
+        try:
+            use_fts = tokenizer == "trigram" and all(len(term) >= 3 for term in terms) or \
+                tokenizer == "unicode61" and all(term.isascii() for term in terms)
+            if use_fts:
+                match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+                rows = conn.execute(
+                    "SELECT t.id, t.created_at, t.conversation_id, t.question, t.answer, t.sources, t.cached, "
+                    "snippet(chat_turns_fts, -1, '**', '**', '...', 16) FROM chat_turns_fts "
+                    "JOIN chat_turns t ON t.id = chat_turns_fts.rowid "
+                    "WHERE chat_turns_fts MATCH ? AND t.user_id = ? AND t.folder = ? ORDER BY rank LIMIT ?",
+                    (match, user_id, folder, limit)
+                ).fetchall()
+            else:
+                conditions = " AND ".join("(question LIKE ? ESCAPE '\\' OR answer LIKE ? ESCAPE '\\')" for _ in terms)
+                params = [user_id, folder]
+                for term in terms:
+                    pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                    params += [pattern, pattern]
+                rows = conn.execute(
+                    "SELECT id, created_at, conversation_id, question, answer, sources, cached FROM chat_turns "
+                    f"WHERE user_id = ? AND folder = ? AND {conditions} ORDER BY id DESC LIMIT ?",
+                    params + [limit]
+                ).fetchall()
+        finally:
+            conn.close()
+    
+    results = []
+    for row in rows:
+        turn = _chat_turn_row_to_dict(row)
+        if len(row) > 7:
+            turn["snippet"] = row[7]
+        else:
+            text = f"{turn['question']} {turn['answer']}"
+            pos = max(0, text.find(terms[0]))
+            turn["snippet"] = ("..." if pos > 30 else "") + text[max(0, pos - 30):pos + 60].replace("\n", " ") + "..."
+        results.append(turn)
+    return results
+
+def iter_chat_history_export(user_id: str, folder: str, conversation_id: str = None, batch_size: int = 200):
+    """逐条生成 Markdown 格式的对话历史（按时间正序），用于写入文件，不在内存中拼接完整文本"""
+    yield f"# 对话历史记录\n\n导出时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+    if folder:
+        yield f"文件夹: {folder}\n"
+    yield "\n---\n\n"
+    if not os.path.exists(CHAT_HISTORY_DB):
+        return
+    
+    sql = ("SELECT id, created_at, conversation_id, question, answer, sources, cached FROM chat_turns "
+           "WHERE user_id = ? AND folder = ? AND id > ?")
+    params = [user_id, folder]
+    if conversation_id:
+        sql += " AND conversation_id = ?"
+        params.append(conversation_id)
+    sql += " ORDER BY id LIMIT ?"
+    
+    # 按ID分批读取，每批单独加锁，导出期间不阻塞新的问答写入
+    last_id = 0
+    number = 0
+    while True:
+        with _chat_history_lock:
+            conn, _ = _connect_chat_history()
+            try:
+                rows = conn.execute(sql, params[:2] + [last_id] + params[2:] + [batch_size]).fetchall()
+            finally:
+                conn.close()
+        if not rows:
+            return
+        for row in rows:
+            turn = _chat_turn_row_to_dict(row)
+            number += 1
+            sources = f"\n\n**参考来源:** {', '.join(turn['sources'])}" if turn["sources"] else ""
+            yield (f"## 对话 {number}（{turn['created_at']}{'，缓存回答' if turn['cached'] else ''}）\n\n"
+                   f"**问题:** {turn['question']}\n\n**回答:**\n{turn['answer']}{sources}\n\n---\n\n")
+        last_id = rows[-1][0]
+
+def export_chat_history(path: str, user_id: str, folder: str, conversation_id: str = None) -> int:
+    """把对话历史流式写入 Markdown 文件，返回导出的问答条数"""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for chunk in iter_chat_history_export(user_id, folder, conversation_id):
+            f.write(chunk)
+            count += chunk.startswith("## 对话 ")
+    return count
+
+# 批量问答模块（从问题文件批量提问：一次计算全部查询向量、一次向量检索、并发调用 API）
+BATCH_QA_DIR = os.path.join(".", "saved_qa")
+BATCH_QUESTION_COLUMNS = ("问题", "question", "questions", "题目")
+BATCH_RESULT_COLUMNS = [
+    ("index", "序号"),
+    ("question", "问题"),
+    ("answer", "回答"),
+    ("sources", "参考来源"),
+    ("latency_seconds", "耗时(秒)"),
+    ("status", "状态"),
+]
+
+def _pick_question_column(rows: List[List[Any]]) -> List[str]:
+    """从表格行中取出问题列：表头中有"问题"/"question"列时使用该列（跳过表头），否则使用第一列"""
+    if not rows:
+        return []
+    column = 0
+    header = [str(cell).strip().lower() if cell is not None else "" for cell in rows[0]]
+    for name in BATCH_QUESTION_COLUMNS:
+        if name in header:
+            column = header.index(name)
+            rows = rows[1:]
+            break
+    questions = []
+    for row in rows:
+        if column < len(row) and row[column] is not None:
+            text = str(row[column]).strip()
+            if text and text.lower() != "nan":
+                questions.append(text)
+    return questions
+
+def read_question_file(file_name: str, data: bytes) -> List[str]:
+    """读取问题文件
+
+    支持 CSV / XLSX / XLS（问题列名为"问题"或"question"，没有表头时使用第一列）和 TXT（每行一个问题，
+    空行和以 # 开头的行被忽略）。
+
+    Raises:
+        ValueError: 文件格式不支持或无法解码
+    """
+    import io
+    
+    ext = os.path.splitext(file_name)[1].lower()
+    if ext in (".txt", ".csv"):
+        text = None
+        for encoding in ("utf-8-sig", "gbk"):
+            try:
+                text = data.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        if text is None:
+            raise ValueError(f"无法解码问题文件（请使用 UTF-8 或 GBK 编码）: {file_name}")
+        if ext == ".txt":
+            return [line.strip() for line in text.splitlines()
+                    if line.strip() and not line.strip().startswith("#")]
+        import csv
+        return _pick_question_column(list(csv.reader(io.StringIO(text))))
+    if ext in (".xlsx", ".xls"):
+        import pandas as pd
+        df = pd.read_excel(io.BytesIO(data), header=None)
+        return _pick_question_column(df.values.tolist())
+    raise ValueError(f"不支持的问题文件格式: {ext}（支持 CSV、XLSX、XLS、TXT）")
+
+def _script_run_ctx_initializer():
+    """返回线程池初始化函数：把当前 Streamlit 会话的上下文附加到工作线程上
+
+    工作线程中的 query_deepseek 需要读取会话的超时和重试设置；不在 Streamlit 中运行时返回 None。
+    """
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except Exception:
+        return None
+    if ctx is None:
+        return None
+    return lambda: add_script_run_ctx(threading.current_thread(), ctx)
+
+def retrieve_for_questions(vectorstore, questions: List[str], k: int = 4) -> List[List[Tuple[str, str]]]:
+    """批量检索：一次 embed_documents 计算所有问题的查询向量，再用一次向量查询检索所有问题
+
+    Returns:
+        与 questions 一一对应的 [(内容, 来源)] 列表
+    """
+    if vectorstore is None or not questions:
+        return [[] for _ in questions]
+    
+    embeddings = get_shared_embeddings(load_embedding_model_config())
+    vectors = embeddings.embed_documents(questions)
+    try:
+        compact_index = get_compact_vector_index(getattr(vectorstore, "_persist_directory", None))
+        if compact_index is not None:
+            return [
+                [(content, _format_doc_sources(metadata)) for content, metadata in results]
+                for results in compact_similarity_search(vectorstore, compact_index, vectors, k=k)
+            ]
+        result = vectorstore._collection.query(
+            query_embeddings=vectors,
+            n_results=k,
+            include=["documents", "metadatas"]
+        )
+        return [
+            [(content, _format_doc_sources(metadata or {})) for content, metadata in zip(contents, metadatas)]
+            for contents, metadatas in zip(result["documents"], result["metadatas"])
+        ]
+    except Exception as e:
+        # 底层集合接口不可用时逐个检索（查询向量仍然只计算一次）
+        print(f"[WARN] 批量向量查询失败，改为逐个检索: {str(e)}")
+        return [search_similar_documents(vectorstore, question, k=k, query_embedding=vector)
+                for question, vector in zip(questions, vectors)]
+
+def batch_answer_questions(questions: List[str], vectorstore, docs_dict: Dict[str, Any], api_key: str,
+                           k: int = 4, max_workers: int = 4, requests_per_minute: float = 60,
+                           enable_web_search: bool = False, output_path: str = None,
+                           progress_callback=None) -> List[Dict[str, Any]]:
+    """批量回答问题
+
+    先批量检索所有问题，再在线程池中并发调用 DeepSeek（经过共享限流器，另外受本批的每分钟请求数限制）。每完成一个问题就追加写入
+    output_path（CSV），中途中断时已完成的结果不会丢失。
+
+    Args:
+        questions: 问题列表
+        vectorstore: 向量数据库（为 None 时使用全部文档内容回答）
+        docs_dict: 文档字典
+        api_key: API密钥
+        k: 每个问题检索的文本块数量
+        max_workers: 并发调用 API 的线程数
+        requests_per_minute: 每分钟最多发出的 API 请求数（0 表示不限制）
+        enable_web_search: 是否启用联网搜索
+        output_path: 逐条写入结果的 CSV 文件路径（None 表示不写文件）
+        progress_callback: 进度回调 progress_callback(已完成数, 总数, 本条结果)
+
+    Returns:
+        按问题顺序排列的结果列表，每条包含 index、question、answer、sources、latency_seconds、status
+    """
+    import csv
+    import time
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    
+    if not questions:
+        return []
+    
+    retrieve_started = time.perf_counter()
+    retrievals = retrieve_for_questions(vectorstore, questions, k=k)
+    print(f"[INFO] 批量检索 {len(questions)} 个问题，耗时 {time.perf_counter() - retrieve_started:.2f} 秒")
     
-    # 如果启用联网搜索且未传入搜索结果，先尝试搜索（兼容旧代码）
-    if enable_web_search and not web_search_results:
+    # 每分钟请求数作为共享限流器上的额外上限：与其他会话的调用一起受全局 RPM/TPM 和自适应并发控制
+    request_cap = TokenBucket(requests_per_minute) if requests_per_minute and requests_per_minute > 0 else None
+    
+    def answer_one(index: int) -> Dict[str, Any]:
+        started = time.perf_counter()
+        similar_docs = retrievals[index]
         try:
-            web_search_results, _ = web_search(question, max_results=3)
+            answer = answer_with_deepseek(questions[index], vectorstore, docs_dict, api_key,
+                                          enable_web_search=enable_web_search, similar_docs=similar_docs,
+                                          purpose="batch", request_cap=request_cap)
+            status = "ok" if getattr(answer, "ok", True) else "error"
         except Exception as e:
-            web_search_results = f"联网搜索时出错: {str(e)}"
+            answer = f"回答失败: {str(e)}"
+            status = "error"
+        return {
+            "index": index + 1,
+            "question": questions[index],
+            "answer": answer,
+            "sources": "、".join(dict.fromkeys(source for _, source in similar_docs)),
+            "latency_seconds": round(time.perf_counter() - started, 2),
+            "status": status
+        }
     
-    # 构建提示
-    if enable_web_search and web_search_results:
-        # 有联网搜索结果
-        prompt = f"""基于以下文档内容和联网搜索结果，请回答这个问题：{question}
-
-相关文档内容：
-{context[:6000]}
-
-联网搜索结果：
-{web_search_results[:2000]}
+    output_file = None
+    writer = None
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        output_file = open(output_path, 'w', encoding='utf-8-sig', newline='')
+        writer = csv.writer(output_file)
+        writer.writerow([title for _, title in BATCH_RESULT_COLUMNS])
+    
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="batch-qa",
+                                initializer=_script_run_ctx_initializer()) as executor:
+            futures = [executor.submit(answer_one, index) for index in range(len(questions))]
+            for completed, future in enumerate(as_completed(futures), 1):
+                row = future.result()
+                results.append(row)
+                if writer is not None:
+                    writer.writerow([row[key] for key, _ in BATCH_RESULT_COLUMNS])
+                    output_file.flush()
+                if progress_callback:
+                    progress_callback(completed, len(questions), row)
+    finally:
+        if output_file is not None:
+            output_file.close()
+    
+    results.sort(key=lambda row: row["index"])
+    return results
 
-请优先基于文档内容回答，如果文档中没有相关信息，可以参考联网搜索结果。请在回答中明确说明是否使用了联网搜索结果。"""
-    elif enable_web_search and not web_search_results:
-        # 启用了联网搜索但没有结果
-        prompt = f"""基于以下文档内容，请回答这个问题：{question}
+def batch_results_to_csv(results: List[Dict[str, Any]]) -> bytes:
+    """把批量问答结果导出为 CSV（带 BOM，Excel 可直接打开）"""
+    import csv
+    import io
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([title for _, title in BATCH_RESULT_COLUMNS])
+    for row in results:
+        writer.writerow([row[key] for key, _ in BATCH_RESULT_COLUMNS])
+    return buffer.getvalue().encode('utf-8-sig')
 
-相关文档内容：
-{context[:8000]}
+def batch_results_to_markdown(results: List[Dict[str, Any]]) -> str:
+    """把批量问答结果导出为 Markdown"""
+    total_latency = sum(row["latency_seconds"] for row in results)
+    failed = sum(1 for row in results if row["status"] != "ok")
+    text = (f"# 批量问答记录\n\n生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"问题数量: {len(results)}（失败 {failed}）\n"
+            f"平均耗时: {total_latency / len(results) if results else 0:.2f} 秒\n\n---\n\n")
+    for row in results:
+        text += f"## 问题 {row['index']}\n\n**问题:** {row['question']}\n\n**回答:**\n{row['answer']}\n\n"
+        if row["sources"]:
+            text += f"**参考来源:** {row['sources']}\n\n"
+        text += f"*耗时: {row['latency_seconds']} 秒*\n\n---\n\n"
+    return text
 
-注意：已启用联网搜索功能，但未能获取到相关的联网搜索结果。请基于文档内容回答，如果文档中没有相关信息，请明确说明。"""
+# 显示后台构建任务状态
+def show_index_job_status():
+    """在侧边栏显示后台构建任务的进度（定时轮询任务状态文件，不阻塞脚本运行）"""
+    job_id = st.session_state.get('index_job_id')
+    job = get_index_job_status(job_id) if job_id else None
+    if not job:
+        st.session_state.index_job_id = None
+        return
+    
+    status = job.get("status")
+    if status in ("queued", "running"):
+        st.progress(min(max(job.get("progress", 0), 0), 100) / 100.0)
+        st.caption(job.get("message", ""))
+        st.caption(f"🆔 后台任务: {job_id}（关闭页面不会中断构建）")
+        if st.button("⏹️ 取消构建", use_container_width=True, key=f"cancel_index_job_{job_id}"):
+            cancel_index_build_job(job_id)
+            st.info("⏳ 已请求取消，构建进程会在当前批次完成后停止")
+        if not hasattr(st, "fragment"):
+            # 旧版本 Streamlit 不支持定时刷新的 fragment，提供手动刷新按钮
+            if st.button("🔄 刷新构建进度", use_container_width=True, key=f"refresh_index_job_{job_id}"):
+                st.rerun()
+        return
+    
+    # 任务已结束，更新会话状态后整体刷新一次页面
+    st.session_state.index_job_id = None
+    st.session_state.is_creating_vectorstore = False
+    if status == "completed":
+        vectorstore, error_detail = load_existing_vector_store(folder_path=job.get("folder_path"))
+        st.session_state.vectorstore = vectorstore
+        if vectorstore:
+            st.session_state.index_job_notice = ("success", "✅ 向量数据库创建完成！")
+        else:
+            message = error_detail.get('message', '未知错误') if error_detail else '未知错误'
+            st.session_state.index_job_notice = ("error", f"⚠️ 向量数据库已创建，但加载失败: {message}")
+    elif status == "cancelled":
+        st.session_state.index_job_notice = ("info", job.get("message", "⏹️ 构建已取消"))
     else:
-        # 未启用联网搜索
-        prompt = f"""基于以下文档内容，请回答这个问题：{question}
+        st.session_state.index_job_notice = ("error", job.get("error") or "⚠️ 向量数据库创建失败")
+    get_directory_size.clear()
+    st.rerun()
 
-相关文档内容：
-{context[:8000]}
+if hasattr(st, "fragment"):
+    # 每 2 秒只重新运行这个片段来刷新进度，而不是整个脚本
+    show_index_job_status = st.fragment(run_every=2)(show_index_job_status)
 
-请基于上述文档内容回答，如果文档中没有相关信息，请明确说明。"""
+# 界面分区模块（侧边栏、文档浏览器、智能问答、高级功能各自作为片段重跑，并记录每次运行的耗时）
+RENDER_TIMINGS_SIZE = 50  # 调试面板保留的最近运行记录数
 
-    return query_deepseek(prompt, api_key)
+def _in_fragment_rerun() -> bool:
+    """当前是否只在重跑某个片段（而不是整个脚本）"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        return bool(ctx is not None and getattr(ctx, "fragment_ids_this_run", None))
+    except Exception:
+        return False
 
-def generate_summary_deepseek(docs_dict: Dict[str, Any], api_key: str, specific_files: List[str] = None, template_id: str = "default"):
-    """使用DeepSeek生成总结报告
+def record_render_timing(scope: str, elapsed_ms: float):
+    """记录一次运行（整页或某个分区）的耗时，供调试面板显示"""
+    from collections import deque
     
-    Args:
-        docs_dict: 文档字典
-        api_key: API密钥
-        specific_files: 特定文件列表（None表示所有文件）
-        template_id: 使用的模版ID（默认为"default"）
+    timings = st.session_state.get('render_timings')
+    if timings is None:
+        timings = st.session_state.render_timings = deque(maxlen=RENDER_TIMINGS_SIZE)
+    timings.append({
+        "时间": datetime.now().strftime("%H:%M:%S"),
+        "分区": scope,
+        "运行方式": "片段重跑" if _in_fragment_rerun() else "整页运行",
+        "耗时(ms)": round(elapsed_ms, 1)
+    })
+
+def ui_section(name: str):
+    """把界面的一个分区包装为片段：分区内的交互只重跑该分区，每次运行的耗时记录到调试面板
+
+    分区之间通过 session state 传递数据；修改了其他分区依赖的数据（如加载文档）时需要调用 st.rerun() 整页重跑。
+    旧版本 Streamlit 没有 st.fragment 时按普通函数运行。
     """
-    # 提取内容
-    contents = []
-    if specific_files:
-        for filename in specific_files:
-            if filename in docs_dict:
-                content = docs_dict[filename]['content']
-                if isinstance(content, dict):
-                    # 移除字段长度限制，让API自行处理
-                    content = "\n".join([f"{k}: {v}" for k, v in content.items()])
-                contents.append(f"文件: {filename}\n{content}")
-    else:
-        for filename, data in docs_dict.items():
-            content = data['content']
-            if isinstance(content, dict):
-                # 移除字段长度限制，让API自行处理
-                content = "\n".join([f"{k}: {v}" for k, v in content.items()])
-            contents.append(f"文件: {filename}\n{content}")
-    
-    combined_content = "\n\n".join(contents)
-    
-    # 加载模版
-    template_data = get_template("summary", template_id)
-    if template_data:
-        template_str = template_data.get("template", "")
-        # 替换模版中的占位符（移除字符限制，让API自行处理）
-        prompt = template_str.format(content=combined_content)
-    else:
-        # 如果模版不存在，使用默认模版
-        prompt = f"""请根据以下文档内容，生成一份详细的总结报告：
+    def decorator(func):
+        import functools
+        import time
+        
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record_render_timing(name, (time.perf_counter() - started) * 1000)
+        return st.fragment(timed) if hasattr(st, "fragment") else timed
+    return decorator
 
-文档内容：
-{combined_content}
+@st.cache_data(ttl=300, show_spinner=False)
+def get_directory_size(path: str) -> int:
+    """目录下所有文件的总大小（字节）
 
-请生成包括以下部分的报告：
-1. 整体内容概述
-2. 核心要点总结
-3. 关键数据/信息提取
-4. 主要发现和洞察
-5. 建议和下一步行动
+    遍历大目录（如 HuggingFace 缓存）很慢，结果缓存 5 分钟；删除或构建数据库后调用 get_directory_size.clear()。
+    """
+    try:
+        return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+    except OSError:
+        return 0
 
-报告："""
+def debug_panel_enabled() -> bool:
+    """是否显示调试面板（页面地址带 ?debug=1，或配置项 "debug_panel" 为 true）"""
+    try:
+        if st.query_params.get("debug") in ("1", "true"):
+            return True
+    except Exception:
+        pass
+    try:
+        return bool(read_config_file().get("debug_panel", False))
+    except Exception:
+        return False
+
+def show_debug_panel():
+    """在侧边栏显示最近各次运行的耗时，按分区和运行方式汇总"""
+    with st.expander("🐞 调试信息（运行耗时）", expanded=False):
+        timings = list(st.session_state.get('render_timings') or [])
+        if not timings:
+            st.caption("暂无记录")
+            return
+        
+        groups = {}
+        for timing in timings:
+            groups.setdefault((timing["分区"], timing["运行方式"]), []).append(timing["耗时(ms)"])
+        st.dataframe([
+            {"分区": scope, "运行方式": run, "次数": len(values), "最近(ms)": values[-1],
+             "中位数(ms)": sorted(values)[len(values) // 2], "最长(ms)": max(values)}
+            for (scope, run), values in groups.items()
+        ], hide_index=True, use_container_width=True)
+        st.caption("最近 10 次运行（片段重跑时只有对应分区会运行，整页运行包含各分区）")
+        st.dataframe(timings[::-1][:10], hide_index=True, use_container_width=True)
+        st.button("🔄 刷新", key="refresh_debug_panel")
 
-    return query_deepseek(prompt, api_key, max_tokens=3000)
+if hasattr(st, "fragment"):
+    # 点击刷新时只重跑调试面板
+    show_debug_panel = st.fragment(show_debug_panel)
 
 # 显示版权信息
 def show_footer():
@@ -2422,6 +6496,9 @@ def show_footer():
 
 # Streamlit界面
 def main():
+    import time
+    render_started = time.perf_counter()
+    
     # 添加自定义CSS样式，将进度条和primary按钮改为草绿色
     st.markdown("""
     <style>
@@ -2757,11 +6834,16 @@ def main():
     if 'selected_file' not in st.session_state:
         st.session_state.selected_file = None
     if 'chat_history' not in st.session_state:
-        st.session_state.chat_history = []
+        st.session_state.chat_history = []  # 只保留最近几轮，完整历史在对话历史数据库中
+    if 'chat_conversation_id' not in st.session_state:
+        import uuid
+        st.session_state.chat_conversation_id = uuid.uuid4().hex
     if 'api_key_loaded' not in st.session_state:
         st.session_state.api_key_loaded = False
     if 'is_creating_vectorstore' not in st.session_state:
         st.session_state.is_creating_vectorstore = False
+    if 'index_job_id' not in st.session_state:
+        st.session_state.index_job_id = None
     if 'embedding_model' not in st.session_state:
         st.session_state.embedding_model = load_embedding_model_config()
     # 初始化联网搜索配置
@@ -2769,7 +6851,8 @@ def main():
         st.session_state.enable_web_search = load_web_search_config()
     
     # 侧边栏
-    with st.sidebar:
+    @ui_section("侧边栏")
+    def render_sidebar():
         st.header("⚙️ 配置")
         
         # DeepSeek API配置
@@ -2823,16 +6906,15 @@ def main():
                     st.session_state.api_key_loaded = True
                     # 静默保存，不显示提示（避免频繁刷新）
         
-        # 使用输入的 key（优先使用新输入的）
+        # 使用输入的 key（优先使用新输入的），其他分区从 session state 读取
         api_key = api_key_input if api_key_input else (st.session_state.get('saved_api_key', '') if st.session_state.api_key_loaded else '')
+        st.session_state.api_key = api_key
         
         # 显示保存状态
         if os.path.exists(CONFIG_FILE):
             saved_time = ""
             try:
-                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    saved_time = config.get("saved_at", "")
+                saved_time = read_config_file().get("saved_at", "")
             except:
                 pass
             if saved_time:
@@ -2854,6 +6936,10 @@ def main():
             st.session_state.api_timeout = 60
         if 'api_max_retries' not in st.session_state:
             st.session_state.api_max_retries = 3
+        if 'api_deadline' not in st.session_state:
+            st.session_state.api_deadline = DEEPSEEK_CALL_DEADLINE
+        if 'api_hedging' not in st.session_state:
+            st.session_state.api_hedging = load_hedging_config()["enabled"]
         
         # API 超时和重试配置（高级设置）
         with st.expander("⚙️ 高级设置（网络问题时可调整）", expanded=False):
@@ -2874,9 +6960,73 @@ def main():
                 help="网络不稳定时可以增加重试次数"
             )
             
+            deadline_seconds = st.slider(
+                "总超时时间（秒）",
+                min_value=30,
+                max_value=600,
+                value=st.session_state.api_deadline,
+                step=10,
+                help="一次提问（含所有重试和等待）的最长时间，超过后直接返回超时提示"
+            )
+            hedging = st.checkbox(
+                "对冲请求（降低偶发的慢响应）",
+                value=st.session_state.api_hedging,
+                help="请求耗时超过最近 95% 请求的耗时时，再发出一个相同的请求并使用先返回的结果。"
+                     "被放弃的请求同样计费，会略微增加 token 消耗"
+            )
+            
             # 保存到 session state
             st.session_state.api_timeout = timeout_seconds
             st.session_state.api_max_retries = max_retries
+            st.session_state.api_deadline = deadline_seconds
+            st.session_state.api_hedging = hedging
+            
+            limiter_stats = get_deepseek_rate_limiter().stats()
+            st.caption(f"🚦 API 限流：并发上限 {limiter_stats['concurrency_limit']}，进行中 {limiter_stats['in_flight']}，"
+                       f"排队 {limiter_stats['waiting']}，平均等待 {limiter_stats['avg_wait_seconds']} 秒"
+                       f"（最长 {limiter_stats['max_wait_seconds']} 秒），已限流 {limiter_stats['throttled']} 次")
+            cache_stats = get_prompt_cache_stats().stats()
+            if cache_stats["calls"]:
+                st.caption(f"💾 上下文缓存：命中 {cache_stats['hit_tokens']} / 未命中 {cache_stats['miss_tokens']} tokens"
+                           f"（命中率 {cache_stats['hit_rate']:.0%}，{cache_stats['calls']} 次调用）")
+            answer_cache_stats = get_semantic_answer_cache().stats()
+            if answer_cache_stats["entries"] or answer_cache_stats["hits"]:
+                st.caption(f"⚡ 相似问题缓存：{answer_cache_stats['entries']} 条，命中 {answer_cache_stats['hits']} 次"
+                           f"（命中率 {answer_cache_stats['hit_rate']:.0%}，阈值 {answer_cache_stats['threshold']}）")
+            latency_stats = get_deepseek_latency_tracker().stats()
+            if latency_stats["samples"]:
+                st.caption(f"⏱️ 最近 {latency_stats['samples']} 次请求耗时：p50 {latency_stats['p50_seconds']} 秒，"
+                           f"p95 {latency_stats['p95_seconds']} 秒；对冲 {latency_stats['hedges']} 次"
+                           f"（其中 {latency_stats['hedge_wins']} 次更快）")
+        
+        # API 用量统计
+        with st.expander("📈 API 用量统计", expanded=False):
+            metrics_range = st.selectbox("统计范围", ["最近 24 小时", "最近 7 天", "全部"], key="llm_metrics_range")
+            metrics_summary = summarize_llm_metrics({"最近 24 小时": 24, "最近 7 天": 24 * 7, "全部": None}[metrics_range])
+            if not metrics_summary["calls"]:
+                st.caption("暂无调用记录")
+            else:
+                col_metric1, col_metric2 = st.columns(2)
+                col_metric1.metric("调用次数", metrics_summary["calls"])
+                col_metric2.metric("失败次数", metrics_summary["errors"])
+                col_metric1.metric("输入 tokens", metrics_summary["prompt_tokens"])
+                col_metric2.metric("输出 tokens", metrics_summary["completion_tokens"])
+                col_metric1.metric("缓存命中率", f"{metrics_summary['cache_hit_rate']:.0%}")
+                col_metric2.metric("平均请求耗时", f"{metrics_summary['avg_latency_seconds'] or 0} 秒")
+                st.caption(f"p95 请求耗时 {metrics_summary['p95_latency_seconds']} 秒 · 平均总耗时（含排队和重试）"
+                           f"{metrics_summary['avg_total_seconds']} 秒 · 重试 {metrics_summary['retries']} 次 · "
+                           f"对冲 {metrics_summary['hedged']} 次")
+                purpose_names = {"answer": "问答", "batch": "批量问答", "summary": "总结", "analysis": "数据分析", "chat": "其他"}
+                import pandas as pd
+                st.dataframe(
+                    pd.DataFrame([
+                        {"用途": purpose_names.get(purpose, purpose), "调用": group["calls"], "失败": group["errors"],
+                         "tokens": group["tokens"], "平均耗时(秒)": group["avg_latency_seconds"]}
+                        for purpose, group in metrics_summary["by_purpose"].items()
+                    ]),
+                    use_container_width=True,
+                    hide_index=True
+                )
         
         st.markdown("---")
         
@@ -3015,8 +7165,10 @@ def main():
         
         col1, col2 = st.columns(2)
         with col1:
-            # 检查是否正在创建向量数据库
-            is_creating_vectorstore = st.session_state.get('is_creating_vectorstore', False)
+            # 检查是否正在创建向量数据库（后台构建任务运行中）
+            index_job = get_index_job_status(st.session_state.index_job_id) if st.session_state.get('index_job_id') else None
+            is_creating_vectorstore = _is_index_job_active(index_job)
+            st.session_state.is_creating_vectorstore = is_creating_vectorstore
             
             if st.button("📂 加载文件夹", use_container_width=True, disabled=is_creating_vectorstore):
                 if folder_path and os.path.exists(folder_path) and os.path.isdir(folder_path):
@@ -3031,36 +7183,32 @@ def main():
                     
                     # 检查并加载/创建向量数据库
                     if st.session_state.docs:
-                        st.session_state.is_creating_vectorstore = True
-                        # 进度条和状态文本（在列布局外，确保与输入框等宽）
-                        progress_bar = progress_placeholder.progress(0)
-                        status_text = status_placeholder.empty()
+                        # 检查文档是否变化
+                        docs_changed = check_docs_changed(st.session_state.docs, folder_path)
                         
-                        try:
-                            # 首先尝试加载已有向量数据库
-                            status_text.text("🔄 正在检查已有向量数据库...")
-                            progress_bar.progress(0.05)
-                            
-                            existing_vectorstore, error_detail = load_existing_vector_store(
-                                folder_path=folder_path,
-                                progress_callback=lambda p, msg: (
-                                    progress_bar.progress(p / 100.0),
-                                    status_text.text(msg)
+                        # 根据文档变化和数据库加载情况决定操作
+                        if not docs_changed:
+                            # 文档未变化，加载已有向量数据库
+                            progress_bar = progress_placeholder.progress(0)
+                            status_text = status_placeholder.empty()
+                            try:
+                                status_text.text("🔄 正在检查已有向量数据库...")
+                                progress_bar.progress(0.05)
+                                
+                                existing_vectorstore, error_detail = load_existing_vector_store(
+                                    folder_path=folder_path,
+                                    progress_callback=lambda p, msg: (
+                                        progress_bar.progress(p / 100.0),
+                                        status_text.text(msg)
+                                    )
                                 )
-                            )
-                            
-                            # 检查文档是否变化
-                            docs_changed = check_docs_changed(st.session_state.docs, folder_path)
-                            
-                            # 根据文档变化和数据库加载情况决定操作
-                            if not docs_changed:
-                                # 文档未变化
+                                
                                 if existing_vectorstore:
                                     # 数据库可用，使用已有向量数据库
                                     st.session_state.vectorstore = existing_vectorstore
                                     progress_bar.progress(1.0)
                                     status_text.text("✅ 已加载已有向量数据库！")
-                                    success_placeholder.success("✅ 已加载已有向量数据库（文档未变化）")
+                                    st.session_state.index_job_notice = ("success", "✅ 已加载已有向量数据库（文档未变化）")
                                 else:
                                     # 文档未变化但数据库无法加载（可能损坏）
                                     # 不自动重新创建，提示用户并显示详细错误信息
@@ -3108,51 +7256,27 @@ def main():
                                             f"- 或手动删除数据库目录 `{db_path}` 后重新创建"
                                         )
                                     
-                                    error_placeholder.warning(warning_msg)
-                                    st.session_state.vectorstore = None
-                            else:
-                                # 文档已变化，需要重新创建
-                                if existing_vectorstore:
-                                    status_text.text("📝 检测到文档变化，正在重新创建向量数据库...")
-                                    progress_bar.progress(0.01)
-                                
-                                # 直接调用 create_local_vector_store，让它自己管理所有进度更新
-                                try:
-                                    st.session_state.vectorstore = create_local_vector_store(
-                                        st.session_state.docs,
-                                        folder_path=folder_path,
-                                        progress_callback=lambda p, msg: (
-                                            progress_bar.progress(p / 100.0),
-                                            status_text.text(msg)
-                                        )
-                                    )
-                                    
-                                    if st.session_state.vectorstore:
-                                        progress_bar.progress(1.0)
-                                        status_text.text("✅ 向量数据库创建完成！")
-                                        success_placeholder.success("✅ 向量数据库创建完成！")
-                                        error_placeholder.empty()  # 清空错误提示
-                                    else:
-                                        progress_placeholder.empty()
-                                        status_placeholder.empty()
-                                        # 如果创建失败，已经在 create_local_vector_store 中显示了警告
-                                except Exception as create_error:
-                                    # 捕获异常，使用占位符显示错误（确保等宽）
-                                    progress_placeholder.empty()
-                                    status_placeholder.empty()
-                                    error_type = type(create_error).__name__
-                                    error_msg = str(create_error)
-                                    error_placeholder.error(f"⚠️ **向量数据库创建失败**\n\n"
-                                                          f"**错误类型**: `{error_type}`\n\n"
-                                                          f"**错误信息**: {error_msg}")
+                                    st.session_state.index_job_notice = ("warning", warning_msg)
                                     st.session_state.vectorstore = None
-                        finally:
-                            st.session_state.is_creating_vectorstore = False
-                            # 清理进度条
-                            import time
-                            time.sleep(0.5)
-                            progress_placeholder.empty()
-                            status_placeholder.empty()
+                            finally:
+                                # 清理进度条
+                                import time
+                                time.sleep(0.5)
+                                progress_placeholder.empty()
+                                status_placeholder.empty()
+                        else:
+                            # 文档已变化，在后台构建向量数据库，不阻塞界面
+                            try:
+                                st.session_state.index_job_id = start_index_build_job(folder_path)
+                                st.session_state.vectorstore = None
+                                st.rerun()
+                            except Exception as job_error:
+                                st.session_state.index_job_notice = ("error", f"⚠️ **无法启动向量数据库构建任务**\n\n"
+                                                                     f"**错误类型**: `{type(job_error).__name__}`\n\n"
+                                                                     f"**错误信息**: {str(job_error)}")
+                    
+                    # 文档已更新，整页重跑，让文档浏览器和智能问答使用新加载的文档
+                    st.rerun()
                 else:
                     st.error("请输入有效的文件夹路径")
         
@@ -3163,72 +7287,27 @@ def main():
                 
                 if current_folder_path and os.path.exists(current_folder_path) and os.path.isdir(current_folder_path):
                     # 如果有当前文件夹路径，重新加载并强制重新创建向量数据库
-                    st.session_state.is_creating_vectorstore = True
-                    progress_bar = progress_placeholder.progress(0)
-                    status_text = status_placeholder.empty()
+                    # 重新读取文件
+                    with st.spinner("正在重新读取文件..."):
+                        st.session_state.docs = process_folder(current_folder_path)
                     
-                    try:
-                        # 重新读取文件
-                        with st.spinner("正在重新读取文件..."):
-                            st.session_state.docs = process_folder(current_folder_path)
+                    if st.session_state.docs:
+                        info_placeholder.info(f"📄 已加载 {len(st.session_state.docs)} 个文件")
                         
-                        if st.session_state.docs:
-                            info_placeholder.info(f"📄 已加载 {len(st.session_state.docs)} 个文件")
-                            
-                            # 强制重新创建向量数据库（即使文档未变化）
-                            status_text.text("🔄 正在强制重新创建向量数据库...")
-                            progress_bar.progress(0.01)
-                            
-                            # 删除旧的数据库目录（如果存在）
-                            db_path = get_vector_db_path(current_folder_path)
-                            if os.path.exists(db_path):
-                                try:
-                                    import shutil
-                                    shutil.rmtree(db_path)
-                                    print(f"[INFO] 已删除旧数据库目录: {db_path}")
-                                except Exception as e:
-                                    print(f"[WARN] 删除旧数据库目录失败: {str(e)}")
-                            
-                            # 创建新的向量数据库
-                            try:
-                                st.session_state.vectorstore = create_local_vector_store(
-                                    st.session_state.docs,
-                                    folder_path=current_folder_path,
-                                    progress_callback=lambda p, msg: (
-                                        progress_bar.progress(p / 100.0),
-                                        status_text.text(msg)
-                                    )
-                                )
-                                
-                                if st.session_state.vectorstore:
-                                    progress_bar.progress(1.0)
-                                    status_text.text("✅ 向量数据库重新创建完成！")
-                                    success_placeholder.success("✅ 向量数据库重新创建完成！")
-                                    error_placeholder.empty()
-                                else:
-                                    progress_placeholder.empty()
-                                    status_placeholder.empty()
-                                    error_placeholder.error("❌ 向量数据库创建失败")
-                            except Exception as create_error:
-                                progress_placeholder.empty()
-                                status_placeholder.empty()
-                                error_type = type(create_error).__name__
-                                error_msg = str(create_error)
-                                error_placeholder.error(f"⚠️ **向量数据库创建失败**\n\n"
-                                                      f"**错误类型**: `{error_type}`\n\n"
-                                                      f"**错误信息**: {error_msg}")
-                                st.session_state.vectorstore = None
-                    finally:
-                        st.session_state.is_creating_vectorstore = False
-                        import time
-                        time.sleep(0.5)
-                        progress_placeholder.empty()
-                        status_placeholder.empty()
+                        # 强制重新创建向量数据库（即使文档未变化），在后台执行
+                        try:
+                            st.session_state.index_job_id = start_index_build_job(current_folder_path, force=True)
+                            st.session_state.vectorstore = None
+                        except Exception as job_error:
+                            st.session_state.index_job_notice = ("error", f"⚠️ **无法启动向量数据库构建任务**\n\n"
+                                                                 f"**错误类型**: `{type(job_error).__name__}`\n\n"
+                                                                 f"**错误信息**: {str(job_error)}")
+                    st.rerun()
                 else:
                     # 如果没有当前文件夹路径，只清空状态
                     st.session_state.docs = {}
                     st.session_state.vectorstore = None
-                    st.session_state.is_creating_vectorstore = False
+                    st.session_state.index_job_id = None
                     info_placeholder.empty()
                     progress_placeholder.empty()
                     status_placeholder.empty()
@@ -3236,6 +7315,23 @@ def main():
                     error_placeholder.empty()
                     st.rerun()
         
+        # 显示后台构建任务状态（定时轮询，不阻塞界面）
+        if st.session_state.get('index_job_id'):
+            show_index_job_status()
+        
+        # 显示已结束的构建任务和侧边栏操作的结果（只显示一次，整页重跑后仍能看到）
+        index_job_notice = st.session_state.pop('index_job_notice', None)
+        if index_job_notice:
+            notice_type, notice_message = index_job_notice
+            if notice_type == "success":
+                success_placeholder.success(notice_message)
+            elif notice_type == "info":
+                success_placeholder.info(notice_message)
+            elif notice_type == "warning":
+                error_placeholder.warning(notice_message)
+            else:
+                error_placeholder.error(notice_message)
+        
         # 如果不在创建过程中，显示已加载文件信息
         if st.session_state.get('docs') and not is_creating_vectorstore:
             info_placeholder.info(f"📄 已加载 {len(st.session_state.docs)} 个文件")
@@ -3253,11 +7349,10 @@ def main():
         upload_info_placeholder = st.empty()
         upload_progress_placeholder = st.empty()
         upload_status_placeholder = st.empty()
-        upload_success_placeholder = st.empty()  # 用于显示成功消息，确保等宽
-        upload_error_placeholder = st.empty()  # 用于显示错误消息，确保等宽
         
         if uploaded_files and st.button("上传文件"):
             temp_dir = tempfile.mkdtemp()
+            upload_errors = []
             for uploaded_file in uploaded_files:
                 file_path = os.path.join(temp_dir, uploaded_file.name)
                 with open(file_path, "wb") as f:
@@ -3292,7 +7387,7 @@ def main():
                         'size': uploaded_file.size
                     }
                 except Exception as e:
-                    st.error(f"读取文件 {filename} 失败: {str(e)}")
+                    upload_errors.append(f"{filename}: {str(e)}")
             
             # 显示已上传文件信息（在占位符中，确保与上传组件等宽）
             if uploaded_files:
@@ -3300,74 +7395,49 @@ def main():
             
             # 检查并加载/创建向量数据库（上传文件时 folder_path 为 None）
             if st.session_state.docs:
-                st.session_state.is_creating_vectorstore = True
-                # 进度条和状态文本（在占位符中，确保与上传组件等宽）
-                progress_bar = upload_progress_placeholder.progress(0)
-                status_text = upload_status_placeholder.empty()
+                # 检查文档是否变化
+                docs_changed = check_docs_changed(st.session_state.docs, None)
                 
-                try:
-                    # 首先尝试加载已有向量数据库
-                    status_text.text("🔄 正在检查已有向量数据库...")
-                    progress_bar.progress(0.05)
-                    
-                    existing_vectorstore, error_detail = load_existing_vector_store(
-                        folder_path=None,  # 上传文件时没有文件夹路径
-                        progress_callback=lambda p, msg: (
-                            progress_bar.progress(p / 100.0),
-                            status_text.text(msg)
-                        )
-                    )
-                    
-                    # 检查文档是否变化
-                    docs_changed = check_docs_changed(st.session_state.docs, None)
-                    
-                    # 如果 load_existing_vector_store 返回了 vectorstore，说明数据库可用
-                    # 不需要再次验证，避免重复验证导致的问题
-                    if existing_vectorstore and not docs_changed:
-                        # 文档未变化，使用已有向量数据库
-                        st.session_state.vectorstore = existing_vectorstore
-                        progress_bar.progress(1.0)
-                        status_text.text("✅ 已加载已有向量数据库！")
-                        upload_success_placeholder.success("✅ 已加载已有向量数据库（文档未变化）")
-                    else:
-                        # 文档变化或不存在，需要重新创建
-                        # 移除所有硬编码的进度更新，让 create_local_vector_store 完全控制进度
-                        if existing_vectorstore and docs_changed:
-                            status_text.text("📝 检测到文档变化，正在重新创建向量数据库...")
-                            progress_bar.progress(0.01)
+                if not docs_changed:
+                    # 文档未变化，加载已有向量数据库
+                    progress_bar = upload_progress_placeholder.progress(0)
+                    status_text = upload_status_placeholder.empty()
+                    try:
+                        status_text.text("🔄 正在检查已有向量数据库...")
+                        progress_bar.progress(0.05)
                         
-                        # 直接调用 create_local_vector_store，让它自己管理所有进度更新
-                        try:
-                            st.session_state.vectorstore = create_local_vector_store(
-                                st.session_state.docs,
-                                folder_path=None,  # 上传文件时没有文件夹路径
-                                progress_callback=lambda p, msg: (
-                                    progress_bar.progress(p / 100.0),
-                                    status_text.text(msg)
-                                )
+                        existing_vectorstore, error_detail = load_existing_vector_store(
+                            folder_path=None,  # 上传文件时没有文件夹路径
+                            progress_callback=lambda p, msg: (
+                                progress_bar.progress(p / 100.0),
+                                status_text.text(msg)
                             )
-                            
-                            if st.session_state.vectorstore:
-                                progress_bar.progress(1.0)
-                                status_text.text("✅ 向量数据库更新完成！")
-                                upload_success_placeholder.success("✅ 向量数据库更新完成！")
-                                upload_error_placeholder.empty()  # 清空错误提示
-                            else:
-                                upload_progress_placeholder.empty()
-                                upload_status_placeholder.empty()
-                        except Exception as create_error:
-                            # 捕获异常，使用占位符显示错误（确保等宽）
-                            upload_progress_placeholder.empty()
-                            upload_status_placeholder.empty()
-                            error_msg = str(create_error)
-                            upload_error_placeholder.error(error_msg)
-                            st.session_state.vectorstore = None
-                finally:
-                    st.session_state.is_creating_vectorstore = False
-                    import time
-                    time.sleep(0.5)
-                    upload_progress_placeholder.empty()
-                    upload_status_placeholder.empty()
+                        )
+                        if existing_vectorstore:
+                            st.session_state.vectorstore = existing_vectorstore
+                            progress_bar.progress(1.0)
+                            status_text.text("✅ 已加载已有向量数据库！")
+                            st.session_state.index_job_notice = ("success", "✅ 已加载已有向量数据库（文档未变化）")
+                        else:
+                            docs_changed = True  # 无法加载，需要重新创建
+                    finally:
+                        import time
+                        time.sleep(0.5)
+                        upload_progress_placeholder.empty()
+                        upload_status_placeholder.empty()
+                
+                if docs_changed:
+                    # 文档变化或不存在，在后台构建向量数据库（上传文件没有文件夹可以重新读取，直接传入文档内容）
+                    try:
+                        st.session_state.index_job_id = start_index_build_job(None, docs_dict=st.session_state.docs)
+                        st.session_state.vectorstore = None
+                    except Exception as job_error:
+                        upload_errors.append(f"无法启动向量数据库构建任务（{type(job_error).__name__}）: {str(job_error)}")
+            
+            if upload_errors:
+                st.session_state.index_job_notice = ("error", "⚠️ " + "\n\n".join(upload_errors))
+            # 文档已更新，整页重跑，让文档浏览器和智能问答使用上传的文档
+            st.rerun()
         
         # 如果不在创建过程中，显示已上传文件信息
         if st.session_state.get('docs') and not st.session_state.get('is_creating_vectorstore', False) and uploaded_files:
@@ -3404,60 +7474,91 @@ def main():
                     if current_folder_path:
                         current_db_path = get_vector_db_path(current_folder_path)
                         if st.button("🗑️ 删除当前向量数据库", use_container_width=True):
-                            import shutil
                             if os.path.exists(current_db_path):
-                                try:
-                                    shutil.rmtree(current_db_path)
-                                    st.session_state.vectorstore = None
-                                    st.success("✅ 当前向量数据库已删除")
-                                    st.info("💡 下次加载相同文件夹时会自动重新创建")
-                                except Exception as e:
-                                    st.error(f"删除失败: {str(e)}")
+                                st.session_state.vectorstore = None
+                                if cleanup_corrupted_db(current_db_path, force=False):
+                                    st.session_state.index_job_notice = (
+                                        "success", "✅ 当前向量数据库已删除，下次加载相同文件夹时会自动重新创建")
+                                else:
+                                    st.session_state.index_job_notice = (
+                                        "error", "删除失败：向量数据库正在构建或被其他程序占用，请稍后重试")
+                                get_directory_size.clear()
+                                st.rerun()
                             else:
                                 st.info("当前向量数据库不存在")
                     else:
                         if st.button("🗑️ 删除所有向量数据库", use_container_width=True):
-                            import shutil
                             if os.path.exists("./chroma_db"):
-                                try:
-                                    shutil.rmtree("./chroma_db")
-                                    st.session_state.vectorstore = None
-                                    st.success("✅ 所有向量数据库已删除")
-                                    st.info("💡 下次加载文档时会自动重新创建")
-                                except Exception as e:
-                                    st.error(f"删除失败: {str(e)}")
+                                st.session_state.vectorstore = None
+                                # 逐个数据库加锁删除，正在构建的数据库会被跳过
+                                failed = [d for d in os.listdir("./chroma_db")
+                                          if os.path.isdir(os.path.join("./chroma_db", d))
+                                          and not cleanup_corrupted_db(os.path.join("./chroma_db", d), force=False)]
+                                if failed:
+                                    st.session_state.index_job_notice = (
+                                        "warning", f"⚠️ 以下向量数据库正在构建或被占用，未删除: {', '.join(failed)}")
+                                else:
+                                    st.session_state.index_job_notice = (
+                                        "success", "✅ 所有向量数据库已删除，下次加载文档时会自动重新创建")
+                                get_directory_size.clear()
+                                st.rerun()
                             else:
                                 st.info("向量数据库不存在")
                 
                 with col_vdb2:
-                    # 显示所有向量数据库信息
-                    if os.path.exists("./chroma_db"):
-                        try:
-                            import shutil
-                            total_size = 0
-                            db_count = 0
-                            for item in os.listdir("./chroma_db"):
-                                item_path = os.path.join("./chroma_db", item)
-                                if os.path.isdir(item_path):
-                                    db_count += 1
-                                    total_size += sum(f.stat().st_size for f in Path(item_path).rglob('*') if f.is_file())
-                            
-                            size_mb = total_size / (1024 * 1024)
-                            if db_count > 0:
-                                st.caption(f"💾 共 {db_count} 个向量数据库")
-                                st.caption(f"💾 总大小: {size_mb:.2f} MB")
-                            else:
-                                st.caption("💾 向量数据库存在")
-                        except:
-                            st.caption("💾 向量数据库存在")
+                    # 显示所有向量数据库信息（来自数据库清单，磁盘占用在后台线程中计算）
+                    inventory = load_vector_db_inventory()
+                    refresh_vector_db_sizes()
+                    inventory_summary = summarize_vector_db_inventory(inventory)
+                    if inventory_summary["count"] > 0:
+                        st.caption(f"💾 共 {inventory_summary['count']} 个向量数据库")
+                        size_caption = f"💾 总大小: {inventory_summary['size_bytes'] / (1024 * 1024):.2f} MB"
+                        if inventory_summary["pending"]:
+                            size_caption += f"（{inventory_summary['pending']} 个目录正在统计）"
+                        st.caption(size_caption)
                     else:
                         st.caption("💾 未创建向量数据库")
+                    if inventory_summary["leftover_count"] > 0:
+                        st.caption(f"🧹 {inventory_summary['leftover_count']} 个未完成或待清理的目录"
+                                   f"（{inventory_summary['leftover_size_bytes'] / (1024 * 1024):.2f} MB）")
+                    gc_config = load_vector_db_gc_config()
+                    if gc_config["enabled"] and gc_config["quota_mb"] > 0:
+                        used_mb = (inventory_summary["size_bytes"] + inventory_summary["leftover_size_bytes"]) / (1024 * 1024)
+                        st.caption(f"📦 磁盘配额: {used_mb:.0f} / {gc_config['quota_mb']} MB（超出时自动删除最久未使用的数据库）")
+                    gc_result = last_vector_db_gc_result()
+                    if gc_result and gc_result.get("removed"):
+                        freed_mb = sum(item["size_mb"] for item in gc_result["removed"])
+                        st.caption(f"🧹 上次自动清理删除了 {len(gc_result['removed'])} 个目录（释放 {freed_mb:.1f} MB）")
+                    
+                    compact_meta = read_compact_vectors_meta(get_vector_db_path(st.session_state.get('current_folder_path')))
+                    if compact_meta and load_compact_vectors_config()["enabled"]:
+                        recall = compact_meta.get("recall") or {}
+                        st.caption(f"🗜️ 紧凑向量（{compact_meta['dtype']}）: {compact_meta['compact_bytes'] / (1024 * 1024):.1f} MB"
+                                   f"（float32 为 {compact_meta['float32_bytes'] / (1024 * 1024):.1f} MB），"
+                                   f"recall@{recall.get('k')} = {recall.get('rescored_recall')}")
+                    
+                    registry_stats = get_vector_store_registry().stats()
+                    if registry_stats["count"] > 0:
+                        st.caption(f"🧠 已加载 {registry_stats['count']} 个共享向量数据库"
+                                   f"（{registry_stats['in_use']} 个使用中，约 {registry_stats['memory_mb']:.1f} MB / "
+                                   f"预算 {registry_stats['budget_mb']:.0f} MB）")
+                
+                databases = [entry for entry in inventory if entry.get("kind") == "database"]
+                if databases:
+                    st.dataframe([{
+                        "文件夹": entry.get("folder_path") or entry["name"],
+                        "模型": entry.get("embedding_model") or "-",
+                        "维度": entry.get("embedding_dimension"),
+                        "文本块": entry.get("chunk_count"),
+                        "大小(MB)": round(entry["size_bytes"] / (1024 * 1024), 2) if entry.get("size_bytes") is not None else None,
+                        "最近使用": datetime.fromtimestamp(entry["last_used_at"]).strftime("%Y-%m-%d %H:%M") if entry.get("last_used_at") else "-",
+                    } for entry in databases], use_container_width=True, hide_index=True)
                 
                 # 显示 HuggingFace 缓存信息
                 hf_cache_path = os.path.join(os.path.expanduser("~"), ".cache", "huggingface")
                 if os.path.exists(hf_cache_path):
                     try:
-                        hf_size = sum(f.stat().st_size for f in Path(hf_cache_path).rglob('*') if f.is_file())
+                        hf_size = get_directory_size(hf_cache_path)
                         hf_size_gb = hf_size / (1024 * 1024 * 1024)
                         st.caption(f"🤖 HuggingFace 模型缓存: {hf_size_gb:.2f} GB")
                         st.caption(f"   位置: {hf_cache_path}")
@@ -3468,9 +7569,9 @@ def main():
         st.caption("💡 提示：使用本地向量数据库进行语义搜索，无需API密钥")
     
     # 主界面
-    col1, col2 = st.columns([1, 1])
-    
-    with col1:
+    @ui_section("文档浏览器")
+    def render_document_browser():
+        api_key = st.session_state.get('api_key', '')
         st.header("📄 文档浏览器")
         
         if st.session_state.docs:
@@ -3770,35 +7871,65 @@ def main():
                     except Exception as e:
                         st.error(f"保存失败: {str(e)}")
     
-    with col2:
+    @ui_section("智能问答")
+    def render_qa_panel():
+        api_key = st.session_state.get('api_key', '')
         st.header("🤖 智能问答")
         
-        # 聊天历史
-        if st.session_state.chat_history:
-            with st.expander("🗣️ 对话历史", expanded=False):
-                # 保存对话历史按钮
+        # 聊天历史（保存在本地数据库中，按用户和文件夹区分，按页加载）
+        history_user = current_chat_user()
+        history_folder = chat_history_folder_key(st.session_state.get('current_folder_path'))
+        history_total = count_chat_turns(history_user, history_folder)
+        if history_total:
+            with st.expander(f"🗣️ 对话历史（共 {history_total} 条）", expanded=False):
                 col_history1, col_history2 = st.columns([3, 1])
-                with col_history2:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    
-                    # 生成对话历史文本
-                    history_text = f"# 对话历史记录\n\n生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n文档数量: {len(st.session_state.docs)}\n\n---\n\n"
-                    for i, (q, a) in enumerate(st.session_state.chat_history, 1):
-                        history_text += f"## 对话 {i}\n\n**问题:** {q}\n\n**回答:**\n{a}\n\n---\n\n"
-                    
-                    st.download_button(
-                        label="💾 保存对话",
-                        data=history_text,
-                        file_name=f"对话历史_{timestamp}.md",
-                        mime="text/markdown",
-                        use_container_width=True
+                with col_history1:
+                    history_query = st.text_input(
+                        "搜索历史问答",
+                        placeholder="输入关键词，多个关键词用空格分隔",
+                        key="history_search_query",
+                        label_visibility="collapsed"
                     )
+                with col_history2:
+                    # 点击时才把对话历史逐条写入文件，不在每次刷新页面时生成
+                    if st.button("📦 导出对话", use_container_width=True, key="export_chat_history"):
+                        os.makedirs(BATCH_QA_DIR, exist_ok=True)
+                        export_path = os.path.join(BATCH_QA_DIR, f"对话历史_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md")
+                        try:
+                            exported = export_chat_history(export_path, history_user, history_folder)
+                            st.success(f"✅ 已导出 {exported} 条对话到: {export_path}")
+                            with open(export_path, 'rb') as f:
+                                st.download_button(
+                                    label="💾 下载",
+                                    data=f,
+                                    file_name=os.path.basename(export_path),
+                                    mime="text/markdown",
+                                    use_container_width=True
+                                )
+                        except Exception as e:
+                            st.error(f"导出失败: {str(e)}")
                 
-                # 显示最近5条对话
-                for i, (q, a) in enumerate(st.session_state.chat_history[-5:], start=len(st.session_state.chat_history)-4):  # 显示最近5条
-                    st.markdown(f"**Q{i}:** {q}")
-                    st.markdown(f"**A{i}:** {a}")
-                    st.markdown("---")
+                if history_query.strip():
+                    matches = search_chat_history(history_user, history_folder, history_query)
+                    st.caption(f"找到 {len(matches)} 条相关问答" + ("（最多显示 20 条）" if len(matches) >= 20 else ""))
+                    for turn in matches:
+                        st.markdown(f"**{turn['created_at']} · Q:** {turn['question']}")
+                        st.caption(turn["snippet"])
+                        with st.popover("查看回答") if hasattr(st, "popover") else st.container():
+                            st.markdown(turn["answer"])
+                        st.markdown("---")
+                else:
+                    # 默认显示最近 5 条，每次"加载更早的对话"多加载 10 条
+                    history_limit = st.session_state.get('history_page_limit', 5)
+                    for turn in load_chat_history_page(history_user, history_folder, limit=history_limit):
+                        st.markdown(f"**Q（{turn['created_at']}{'，缓存回答' if turn['cached'] else ''}）:** {turn['question']}")
+                        st.markdown(f"**A:** {turn['answer']}")
+                        st.markdown("---")
+                    if history_total > history_limit:
+                        if st.button(f"⬇️ 加载更早的对话（还有 {history_total - history_limit} 条）",
+                                     use_container_width=True, key="load_more_chat_history"):
+                            st.session_state.history_page_limit = history_limit + 10
+                            st.rerun()
         
         # 问题输入
         question = st.text_area(
@@ -3815,11 +7946,27 @@ def main():
         
         with col_b:
             if st.button("🧹 清空对话", use_container_width=True):
-                # 清空前询问是否保存
-                if st.session_state.chat_history:
-                    st.warning("⚠️ 清空对话前建议先保存对话历史！")
+                # 开始新的对话（之前的问答仍保存在对话历史中，可以搜索和导出）
+                import uuid
                 st.session_state.chat_history = []
+                st.session_state.chat_conversation_id = uuid.uuid4().hex
+                st.session_state.history_page_limit = 5
                 st.rerun()
+            
+            # 结合对话上下文检索（"那第二点呢？"这类追问会结合上一轮问答改写检索查询）
+            st.checkbox(
+                "💬 结合对话上下文",
+                value=True,
+                help="追问时结合最近几轮对话构造检索查询，并在提示词中附上最近的对话历史",
+                key="conversational_retrieval"
+            )
+            st.checkbox(
+                "⚡ 相似问题使用缓存",
+                value=load_semantic_cache_config()["enabled"],
+                help="与之前的问题意思相近时（同一数据库版本、未启用联网搜索）直接返回缓存的回答，"
+                     "不再调用 DeepSeek。取消勾选可重新生成回答",
+                key="semantic_answer_cache"
+            )
         
         with col_c:
             # 联网搜索配置（仅用于智能问答）
@@ -3850,6 +7997,19 @@ def main():
                 st.caption("💡 或安装旧版: `pip install duckduckgo-search`（会显示警告）")
                 st.caption("💡 安装后请刷新页面（按 F5 或点击浏览器刷新按钮）")
             
+            # 联网搜索结果重排序（多取结果，用本地嵌入模型筛选最相关的部分）
+            if enable_web_search:
+                rerank_enabled = load_web_rerank_config()["enabled"]
+                rerank_checked = st.checkbox(
+                    "🎯 搜索结果重排序",
+                    value=rerank_enabled,
+                    help="获取更多搜索结果，用本地嵌入模型计算与问题的相似度，只保留最相关的部分"
+                         "（控制在 token 预算内，不会增加提示词长度）",
+                    key="web_rerank_checkbox_qa"
+                )
+                if rerank_checked != rerank_enabled:
+                    save_web_rerank_config(rerank_checked)
+            
             # 保存到 session state 和配置文件
             if enable_web_search != st.session_state.enable_web_search:
                 st.session_state.enable_web_search = enable_web_search
@@ -3876,7 +8036,8 @@ def main():
                 # 显示超时提示（全宽）
                 timeout_info = st.session_state.get('api_timeout', 60)
                 retry_info = st.session_state.get('api_max_retries', 3)
-                st.info(f"⏱️ 超时设置: {timeout_info}秒 | 重试次数: {retry_info}次 | 如遇超时可在侧边栏调整")
+                deadline_info = st.session_state.get('api_deadline', DEEPSEEK_CALL_DEADLINE)
+                st.info(f"⏱️ 超时设置: {timeout_info}秒 | 重试次数: {retry_info}次 | 总超时: {deadline_info}秒 | 如遇超时可在侧边栏调整")
                 
                 # 获取联网搜索配置
                 enable_web_search = st.session_state.get('enable_web_search', False)
@@ -3899,33 +8060,74 @@ def main():
                 
                 with qa_result_container:
                     with st.spinner(f"正在思考...（超时时间: {timeout_info}秒）"):
-                        # 执行搜索并获取结果
-                        web_search_results = ""
-                        web_search_refs = []
-                        web_search_status = ""
-                        if enable_web_search and web_search_available:
+                        # 追问时结合最近的对话构造检索查询（历史对话的向量在本会话内缓存）
+                        recent_history = st.session_state.chat_history[-HISTORY_MAX_TURNS:] \
+                            if st.session_state.get('conversational_retrieval', True) else []
+                        retrieval_query, query_embedding, is_follow_up = question, None, False
+                        if recent_history:
                             try:
-                                web_search_results, web_search_refs = web_search(question, max_results=3)
-                                # 检查搜索结果：如果有内容且不是错误信息，才算成功
-                                if web_search_results and not web_search_results.startswith("联网搜索时出错") and not web_search_results.startswith("联网搜索功能出错"):
-                                    web_search_status = "✅ 已获取联网搜索结果"
-                                elif web_search_results.startswith("联网搜索时出错") or web_search_results.startswith("联网搜索功能出错"):
-                                    web_search_status = f"⚠️ {web_search_results}"
-                                else:
-                                    # 空字符串表示搜索执行了但没有找到结果
-                                    web_search_status = "ℹ️ 联网搜索未找到相关结果"
+                                retrieval_query, query_embedding, is_follow_up = build_conversational_query(
+                                    question,
+                                    recent_history,
+                                    get_shared_embeddings(load_embedding_model_config())
+                                    if st.session_state.vectorstore is not None else None,
+                                    st.session_state.setdefault('history_embedding_cache', {})
+                                )
                             except Exception as e:
-                                web_search_status = f"⚠️ 联网搜索出错: {str(e)}"
+                                print(f"[WARN] 结合对话上下文构造检索查询失败，使用原问题检索: {e}")
+                                retrieval_query = rewrite_follow_up_query(question, recent_history)
                         
-                        answer = answer_with_deepseek(
-                            question, 
-                            st.session_state.vectorstore, 
-                            st.session_state.docs, 
-                            api_key,
-                            enable_web_search=enable_web_search,
-                            web_search_results=web_search_results,
-                            web_search_refs=web_search_refs if web_search_refs else None
-                        )
+                        # 相似问题缓存（追问依赖上下文、联网搜索结果随时间变化，这两种情况不使用缓存）
+                        semantic_cache = get_semantic_answer_cache()
+                        cache_scope = semantic_cache_scope(st.session_state.vectorstore) \
+                            if st.session_state.get('semantic_answer_cache', True) and not is_follow_up \
+                            and not (enable_web_search and web_search_available) else None
+                        cached_answer = None
+                        if cache_scope:
+                            try:
+                                query_embedding = get_shared_embeddings(load_embedding_model_config()).embed_query(question)
+                                cached_answer = semantic_cache.lookup(cache_scope, query_embedding)
+                            except Exception as e:
+                                print(f"[WARN] 查找相似问题缓存失败: {e}")
+                                cache_scope = None
+                        
+                        if cached_answer:
+                            answer = cached_answer["answer"]
+                            similar_docs = cached_answer["similar_docs"]
+                            web_search_refs = []
+                            web_search_status = ""
+                        else:
+                            # 联网搜索和本地检索同时进行，联网搜索超时后只使用本地文档回答
+                            answer_context = gather_answer_context(
+                                question,
+                                st.session_state.vectorstore,
+                                enable_web_search and web_search_available,
+                                retrieval_query=retrieval_query,
+                                query_embedding=query_embedding
+                            )
+                            similar_docs = answer_context["similar_docs"]
+                            web_search_results = answer_context["web_results"]
+                            web_search_refs = answer_context["web_refs"]
+                            web_search_status = {
+                                "ok": "✅ 已获取联网搜索结果",
+                                "empty": "ℹ️ 联网搜索未找到相关结果",
+                                "timeout": f"⚠️ 联网搜索超过 {WEB_SEARCH_TIMEOUT} 秒未返回，已只使用本地文档回答",
+                                "error": f"⚠️ {answer_context['web_error']}",
+                            }.get(answer_context["web_status"], "")
+                            
+                            answer = answer_with_deepseek(
+                                question, 
+                                st.session_state.vectorstore, 
+                                st.session_state.docs, 
+                                api_key,
+                                enable_web_search=enable_web_search and web_search_available,
+                                web_search_results=web_search_results,
+                                web_search_refs=web_search_refs if web_search_refs else None,
+                                similar_docs=similar_docs,
+                                chat_history=recent_history or None
+                            )
+                            if cache_scope and isinstance(answer, LLMResult) and answer.ok:
+                                semantic_cache.store(cache_scope, question, query_embedding, answer, similar_docs)
                     
                     # 搜索完成后清除搜索状态提示，并显示搜索结果状态
                     if search_status_placeholder is not None:
@@ -3938,12 +8140,28 @@ def main():
                             else:
                                 search_status_placeholder.info(web_search_status)
                     
-                    # 保存到历史
+                    # 保存到历史（会话中只保留最近几轮）
+                    append_chat_turn(
+                        history_user, history_folder, st.session_state.chat_conversation_id, question, answer,
+                        sources=list(dict.fromkeys(source for _, source in similar_docs or [])),
+                        cached=bool(cached_answer)
+                    )
                     st.session_state.chat_history.append((question, answer))
+                    st.session_state.chat_history = st.session_state.chat_history[-CHAT_SESSION_TURNS:]
                     
                     # 显示答案（全宽）
                     st.markdown("### 💡 答案")
+                    if is_follow_up and retrieval_query != question:
+                        st.caption(f"🔁 已结合对话上下文检索：{retrieval_query[:200]}")
+                    if cached_answer:
+                        st.info(f"⚡ 缓存回答：与 {cached_answer['created_at']} 的问题「{cached_answer['question'][:80]}」"
+                                f"相似（相似度 {cached_answer['similarity']:.2f}），未调用 DeepSeek。"
+                                f"如需重新生成，请取消勾选\"相似问题使用缓存\"后再次提问")
                     st.write(answer)
+                    if isinstance(answer, LLMResult) and answer.ok:
+                        st.caption(f"📊 输入 {answer.prompt_tokens} tokens（缓存命中 {answer.cached_tokens or 0}）· "
+                                   f"输出 {answer.completion_tokens} tokens · 请求耗时 {answer.latency_seconds} 秒 · "
+                                   f"总耗时 {answer.total_seconds} 秒" + (f" · 重试 {answer.retries} 次" if answer.retries else ""))
                     
                     # 保存单个问答
                     col_save_qa1, col_save_qa2 = st.columns(2)
@@ -3997,10 +8215,6 @@ def main():
                         
                         # 显示本地文档来源
                         if st.session_state.vectorstore:
-                            similar_docs = search_similar_documents(
-                                st.session_state.vectorstore, 
-                                question
-                            )
                             if similar_docs:
                                 for i, (content, source) in enumerate(similar_docs[:3], 1):
                                     source_count += 1
@@ -4042,6 +8256,102 @@ def main():
                                 if i < len(web_search_refs):
                                     st.markdown("---")
         
+        # 批量问答
+        with st.expander("📋 批量问答", expanded=False):
+            st.caption("上传问题文件（CSV/XLSX：\"问题\"列或第一列；TXT：每行一个问题），"
+                       "批量检索后并发调用 API，结果逐条写入 saved_qa 目录")
+            question_file = st.file_uploader(
+                "问题文件",
+                type=["csv", "xlsx", "xls", "txt"],
+                key="batch_qa_file"
+            )
+            col_batch1, col_batch2, col_batch3 = st.columns(3)
+            with col_batch1:
+                batch_workers = st.number_input("并发数", min_value=1, max_value=16, value=4, step=1,
+                                                key="batch_qa_workers")
+            with col_batch2:
+                batch_rpm = st.number_input("每分钟请求数", min_value=0, max_value=600, value=60, step=10,
+                                            key="batch_qa_rpm", help="0 表示不限制")
+            with col_batch3:
+                batch_k = st.number_input("检索块数", min_value=1, max_value=20, value=4, step=1,
+                                          key="batch_qa_k")
+            
+            if st.button("▶️ 开始批量问答", use_container_width=True, disabled=question_file is None):
+                questions = []
+                try:
+                    questions = read_question_file(question_file.name, question_file.getvalue())
+                except Exception as e:
+                    st.error(f"读取问题文件失败: {str(e)}")
+                
+                if question_file is not None and not questions:
+                    st.warning("问题文件中没有问题")
+                elif not api_key:
+                    st.error("请输入DeepSeek API密钥")
+                elif not st.session_state.docs:
+                    st.error("请先加载文档")
+                else:
+                    timestamp_batch = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    output_path = os.path.join(BATCH_QA_DIR, f"批量问答_{timestamp_batch}.csv")
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
+                    status_text.info(f"正在批量检索 {len(questions)} 个问题...")
+                    
+                    def update_batch_progress(completed, total, row):
+                        progress_bar.progress(completed / total)
+                        status_text.info(f"已完成 {completed}/{total}（问题 {row['index']} 耗时 {row['latency_seconds']} 秒）")
+                    
+                    try:
+                        results = batch_answer_questions(
+                            questions,
+                            st.session_state.vectorstore,
+                            st.session_state.docs,
+                            api_key,
+                            k=int(batch_k),
+                            max_workers=int(batch_workers),
+                            requests_per_minute=batch_rpm,
+                            enable_web_search=st.session_state.get('enable_web_search', False),
+                            output_path=output_path,
+                            progress_callback=update_batch_progress
+                        )
+                        st.session_state.batch_qa_results = results
+                        st.session_state.batch_qa_timestamp = timestamp_batch
+                        failed = sum(1 for row in results if row["status"] != "ok")
+                        status_text.success(f"✅ 已完成 {len(results)} 个问题（失败 {failed}），结果已保存到: {output_path}")
+                    except Exception as e:
+                        status_text.error(f"批量问答失败: {str(e)}（已完成的结果保存在: {output_path}）")
+            
+            batch_results = st.session_state.get('batch_qa_results')
+            if batch_results:
+                import pandas as pd
+                st.dataframe(
+                    pd.DataFrame(batch_results)[[key for key, _ in BATCH_RESULT_COLUMNS]]
+                    .rename(columns=dict(BATCH_RESULT_COLUMNS)),
+                    use_container_width=True,
+                    hide_index=True
+                )
+                timestamp_batch = st.session_state.get('batch_qa_timestamp', '')
+                col_batch_dl1, col_batch_dl2 = st.columns(2)
+                with col_batch_dl1:
+                    st.download_button(
+                        label="📥 下载 CSV",
+                        data=batch_results_to_csv(batch_results),
+                        file_name=f"批量问答_{timestamp_batch}.csv",
+                        mime="text/csv",
+                        use_container_width=True
+                    )
+                with col_batch_dl2:
+                    st.download_button(
+                        label="📥 下载 Markdown",
+                        data=batch_results_to_markdown(batch_results),
+                        file_name=f"批量问答_{timestamp_batch}.md",
+                        mime="text/markdown",
+                        use_container_width=True
+                    )
+        
+    @ui_section("高级功能")
+    def render_advanced_tools():
+        api_key = st.session_state.get('api_key', '')
+        
         # 高级功能（使用容器隔离，避免被智能问答结果覆盖）
         st.markdown("---")
         advanced_features_container = st.container()
@@ -4159,25 +8469,23 @@ def main():
                             template_data = get_template("analysis", st.session_state.selected_analysis_template)
                             
                             # 准备文档信息
-                            doc_info = chr(10).join([f'{name}: {len(str(data["content"]))} 字符' for name, data in st.session_state.docs.items()])
+                            doc_info = chr(10).join([f'{name}: {len(str(st.session_state.docs[name]["content"]))} 字符' for name in sorted(st.session_state.docs)])
                             
                             if template_data:
                                 template_str = template_data.get("template", "")
-                                # 替换模版中的占位符
-                                prompt = template_str.format(doc_info=doc_info)
+                                # 替换模版中的占位符（文档信息放在模版前面）
+                                prompt = render_template_content_first(template_str, "doc_info", doc_info, "文档信息")
                             else:
                                 # 如果模版不存在，使用默认模版
-                                prompt = f"""请分析以下文档集合，提供数据分析:
-
-文档信息：
+                                prompt = f"""文档信息：
 {doc_info}
 
-请提供：
+请分析以上文档集合，提供数据分析：
 1. 文档内容分布分析
 2. 潜在的数据模式和趋势
 3. 建议的数据可视化方式"""
                             
-                            analysis = query_deepseek(prompt, api_key)
+                            analysis = query_deepseek(prompt, api_key, purpose="analysis")
                             st.session_state.analysis_result = analysis
                             st.session_state.analysis_template_name = template_data.get('name', '默认模版') if template_data else '默认模版'
                 
@@ -4361,8 +8669,30 @@ def main():
                             with st.expander("错误详情", expanded=False):
                                 st.code(traceback.format_exc(), language='python')
         
+    # 页面布局：每个分区是一个片段，分区内的交互只重跑该分区，不再重跑整个脚本
+    with st.sidebar:
+        render_sidebar()
+    
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        render_document_browser()
+    with col2:
+        render_qa_panel()
+        render_advanced_tools()
+        
         # 显示版权信息
         show_footer()
+    
+    render_ms = (time.perf_counter() - render_started) * 1000
+    record_render_timing("整页", render_ms)
+    if debug_panel_enabled():
+        with st.sidebar:
+            show_debug_panel()
+    
+    # 页面渲染完成后在后台预热重量级依赖（每个进程只启动一次）
+    start_background_prewarm(_first_render_ms=render_ms)
+    # 按间隔在后台检查向量数据库的磁盘配额（不阻塞页面）
+    start_vector_db_gc()
 
 # 简易版（无向量数据库）
 def simple_main():
@@ -4461,13 +8791,12 @@ def simple_main():
                 all_content += f"\n\n文件: {filename}\n{content}"
             
             # 调用DeepSeek
-            prompt = f"""基于以下文档内容回答问题：
-
+            prompt = f"""文档内容：
 {all_content[:8000]}
 
-问题：{question}
+请基于以上文档内容回答问题，如果文档中没有相关信息，请明确说明。
 
-请基于文档内容回答，如果文档中没有相关信息，请明确说明。"""
+问题：{question}"""
             
             with st.spinner("正在思考..."):
                 answer = query_deepseek(prompt, api_key)
@@ -4479,7 +8808,15 @@ def simple_main():
 if __name__ == "__main__":
     # 默认使用完整版，可以通过环境变量或命令行参数切换
     import sys
-    if len(sys.argv) > 1 and sys.argv[1] == "simple":
+    if len(sys.argv) > 2 and sys.argv[1] == "build-index-job":
+        # 后台构建任务的工作进程（由 start_index_build_job 启动）
+        sys.exit(run_index_build_job(sys.argv[2]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "profile-imports":
+        # 测量冷启动导入时间并写入 .startup_profile.json，超出预算时返回非零退出码
+        report = profile_imports()
+        print_import_profile(report)
+        sys.exit(1 if report["over_budget"] else 0)
+    elif len(sys.argv) > 1 and sys.argv[1] == "simple":
         simple_main()
     else:
         main()
\ No newline at end of file
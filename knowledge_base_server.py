@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+智能知识库 HTTP 服务
+在本地提供检索、问答和总结接口，供其他服务调用（不依赖 Streamlit 界面）
+
+Copyright (c) 2026 吕滢
+
+Licensed under the MIT License (Non-Commercial) or Apache License 2.0 (Non-Commercial)
+See LICENSE-MIT-NC or LICENSE-APACHE-NC for details.
+
+This software is for NON-COMMERCIAL USE ONLY.
+For commercial use, please contact the copyright holder.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict
+
+MAX_REQUEST_BYTES = 1024 * 1024  # 请求体上限
+MAX_SEARCH_K = 50  # 每次检索返回的文本块数量上限
+
+
+class ServiceError(Exception):
+    """带 HTTP 状态码的接口错误"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class KnowledgeBaseService:
+    """检索、问答和总结接口的实现
+
+    所有请求在有界的工作线程池中执行：正在执行和排队的请求总数超过上限时立即返回 503（背压），
+    单个请求超过超时时间返回 504。并发请求的查询向量由 QueryEmbeddingBatcher 合并计算。
+    """
+
+    def __init__(self, kb, workers: int = 4, queue_size: int = 16, timeout: float = 60,
+                 max_batch_size: int = 32, batch_wait_ms: float = 10, api_key: str = None):
+        self.kb = kb
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.timeout = timeout
+        self.api_key = api_key
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kb-worker")
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._in_flight = 0
+        self._counter_lock = threading.Lock()
+        self._batcher = None
+        self._batcher_lock = threading.Lock()
+        self._batcher_options = {"max_batch_size": max_batch_size, "max_wait_ms": batch_wait_ms}
+        self.stats = {"requests": 0, "rejected": 0, "timeouts": 0, "errors": 0}
+
+    @property
+    def batcher(self):
+        # 嵌入模型在第一次检索时才加载，服务启动不需要等待
+        with self._batcher_lock:
+            if self._batcher is None:
+                embeddings = self.kb.get_shared_embeddings(self.kb.load_embedding_model_config())
+                self._batcher = self.kb.QueryEmbeddingBatcher(embeddings, **self._batcher_options)
+            return self._batcher
+
+    def submit(self, handler, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """在工作线程池中执行请求，负责背压和超时"""
+        if not self._slots.acquire(blocking=False):
+            with self._counter_lock:
+                self.stats["rejected"] += 1
+            raise ServiceError(503, "服务繁忙，请稍后重试")
+
+        with self._counter_lock:
+            self._in_flight += 1
+            self.stats["requests"] += 1
+
+        def release(_):
+            # 超时的请求仍在工作线程中执行，执行结束后才释放名额，避免超时请求堆积
+            with self._counter_lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+        future = self._executor.submit(handler, payload)
+        future.add_done_callback(release)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            with self._counter_lock:
+                self.stats["timeouts"] += 1
+            raise ServiceError(504, f"请求处理超时（{self.timeout} 秒）")
+        except ServiceError:
+            raise
+        except Exception as e:
+            with self._counter_lock:
+                self.stats["errors"] += 1
+            raise ServiceError(500, f"{type(e).__name__}: {str(e)}")
+
+    def health(self) -> Dict[str, Any]:
+        with self._counter_lock:
+            result = {
+                "status": "ok",
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "in_flight": self._in_flight,
+                **self.stats
+            }
+        if self._batcher is not None:
+            result["embedding_batches"] = dict(self._batcher.stats)
+        result["vector_stores"] = self.kb.get_vector_store_registry().stats()
+        result["deepseek_rate_limiter"] = self.kb.get_deepseek_rate_limiter().stats()
+        result["deepseek_latency"] = self.kb.get_deepseek_latency_tracker().stats()
+        result["prompt_cache"] = self.kb.get_prompt_cache_stats().stats()
+        result["web_search"] = dict(self.kb.get_web_search_client().stats)
+        result["answer_cache"] = self.kb.get_semantic_answer_cache().stats()
+        result["vector_db_gc"] = self.kb.last_vector_db_gc_result()
+        return result
+
+    def start_vector_db_gc(self):
+        """服务启动时调用一次：按配置的间隔在后台线程中检查向量数据库的磁盘配额"""
+        config = self.kb.load_vector_db_gc_config()
+        if not config["enabled"]:
+            return
+
+        def loop():
+            while True:
+                self.kb.start_vector_db_gc(force=True)
+                time.sleep(max(60, config["interval_seconds"]))
+
+        threading.Thread(target=loop, name="vector-db-gc-timer", daemon=True).start()
+
+    def _require(self, payload: Dict[str, Any], *fields: str):
+        missing = [name for name in fields if not payload.get(name)]
+        if missing:
+            raise ServiceError(400, f"缺少参数: {', '.join(missing)}")
+
+    def _top_k(self, payload: Dict[str, Any]) -> int:
+        """读取检索数量参数 k（默认 4，必须是 1 到 MAX_SEARCH_K 之间的整数）"""
+        value = payload.get("k", 4)
+        try:
+            if isinstance(value, bool):
+                raise ValueError(value)
+            k = int(value)
+        except (TypeError, ValueError):
+            raise ServiceError(400, f"参数 k 必须是整数: {value!r}")
+        if not 1 <= k <= MAX_SEARCH_K:
+            raise ServiceError(400, f"参数 k 必须在 1 到 {MAX_SEARCH_K} 之间: {k}")
+        return k
+
+    def _load_vectorstore(self, folder: str, holder: str):
+        if not os.path.isdir(folder):
+            raise ServiceError(404, f"文件夹不存在: {folder}")
+        vectorstore, error_detail = self.kb.load_existing_vector_store(folder_path=folder, holder=holder)
+        if vectorstore is None:
+            message = error_detail.get("message") if error_detail else "请先建立索引（knowledge_base_cli.py index）"
+            raise ServiceError(404, f"文件夹尚未建立可用的向量数据库: {message}")
+        return vectorstore
+
+    @contextmanager
+    def _holding_vectorstore(self):
+        """每个请求在共享注册表中单独登记持有者，请求结束前数据库不会因内存预算被关闭"""
+        holder = self.kb.new_vector_store_holder("server")
+        try:
+            yield holder
+        finally:
+            self.kb.get_vector_store_registry().release(holder)
+
+    def search(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        self._require(payload, "folder", "query")
+        k = self._top_k(payload)
+        with self._holding_vectorstore() as holder:
+            vectorstore = self._load_vectorstore(payload["folder"], holder)
+            embedding = self.batcher.embed_query(payload["query"], timeout=self.timeout)
+            similar_docs = self.kb.search_similar_documents(vectorstore, payload["query"], k=k,
+                                                            query_embedding=embedding)
+        return {"results": [{"source": source, "content": content} for content, source in similar_docs]}
+
+    def answer(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        self._require(payload, "folder", "question")
+        k = self._top_k(payload)
+        with self._holding_vectorstore() as holder:
+            return self._answer(payload, holder, k)
+
+    def _answer(self, payload: Dict[str, Any], holder: str, k: int) -> Dict[str, Any]:
+        api_key = self._api_key()
+        question = payload["question"]
+        enable_web_search = bool(payload.get("web", False))
+        vectorstore = self._load_vectorstore(payload["folder"], holder)
+        embedding = self.batcher.embed_query(question, timeout=self.timeout)
+        
+        # 相似问题缓存（联网搜索的回答不缓存，"cache": false 时强制重新生成）
+        answer_cache = self.kb.get_semantic_answer_cache()
+        cache_scope = self.kb.semantic_cache_scope(vectorstore) \
+            if payload.get("cache", True) and not enable_web_search and self.kb.load_semantic_cache_config()["enabled"] else None
+        cached = answer_cache.lookup(cache_scope, embedding) if cache_scope else None
+        if cached:
+            return {
+                "answer": cached["answer"],
+                "sources": [{"source": source, "content": content} for content, source in cached["similar_docs"]],
+                "cached": {key: cached[key] for key in ("question", "similarity", "created_at")}
+            }
+        
+        similar_docs = self.kb.search_similar_documents(vectorstore, question, k=k,
+                                                        query_embedding=embedding)
+        if not similar_docs:
+            # 没有可用的文档上下文时不调用 DeepSeek（服务不会像界面那样退回到全部文档内容）
+            raise ServiceError(409, f"文件夹的向量数据库没有检索到任何内容（数据库为空或暂时不可用），"
+                                    f"请重新建立索引后重试: {payload['folder']}")
+        answer = self.kb.answer_with_deepseek(question, vectorstore, {}, api_key,
+                                              enable_web_search=enable_web_search,
+                                              similar_docs=similar_docs)
+        self._check_llm_result(answer)
+        if cache_scope:
+            answer_cache.store(cache_scope, question, embedding, answer, similar_docs)
+        return {
+            "answer": answer,
+            "sources": [{"source": source, "content": content} for content, source in similar_docs],
+            "usage": answer.metrics(),
+            "cached": None
+        }
+
+    def summarize(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        self._require(payload, "folder")
+        api_key = self._api_key()
+        folder = payload["folder"]
+        if not os.path.isdir(folder):
+            raise ServiceError(404, f"文件夹不存在: {folder}")
+        docs = self.kb.process_folder(folder, max_workers=4)
+        if not docs:
+            raise ServiceError(404, f"文件夹中没有支持的文件: {folder}")
+        files = payload.get("files")
+        if files:
+            missing = [name for name in files if name not in docs]
+            if missing:
+                raise ServiceError(400, f"文件不存在或格式不支持: {', '.join(missing)}")
+        summary = self.kb.generate_summary_deepseek(docs, api_key, specific_files=files,
+                                                    template_id=payload.get("template", "default"))
+        self._check_llm_result(summary)
+        return {"summary": summary, "files": files or sorted(docs), "usage": summary.metrics()}
+
+    def _check_llm_result(self, result):
+        # DeepSeek 调用失败时返回的是错误提示，按上游错误返回 502
+        if not getattr(result, "ok", True):
+            raise ServiceError(502, str(result))
+
+    def _api_key(self) -> str:
+        api_key = self.api_key or os.environ.get("DEEPSEEK_API_KEY") or self.kb.load_api_key()
+        if not api_key:
+            raise ServiceError(503, "服务未配置 DeepSeek API 密钥")
+        return api_key
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    service: KnowledgeBaseService = None
+    timeout = 30  # 读取请求的套接字超时，防止慢客户端长期占用连接
+    routes = {"/search": "search", "/answer": "answer", "/summarize": "summarize"}
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._send(200, self.service.health())
+        else:
+            self._send(404, {"error": f"接口不存在: {self.path}"})
+
+    def do_POST(self):
+        started = time.time()
+        route = self.routes.get(self.path.rstrip("/"))
+        try:
+            if route is None:
+                raise ServiceError(404, f"接口不存在: {self.path}")
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                raise ServiceError(400, "请求头 Content-Length 不是有效的整数")
+            if length < 0:
+                raise ServiceError(400, "请求头 Content-Length 不能为负数")
+            if length > MAX_REQUEST_BYTES:
+                raise ServiceError(413, "请求体过大")
+            try:
+                payload = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                raise ServiceError(400, "请求体不是有效的 JSON")
+            if not isinstance(payload, dict):
+                raise ServiceError(400, "请求体必须是 JSON 对象")
+            if payload.get("folder"):
+                payload["folder"] = os.path.abspath(payload["folder"])
+            result = self.service.submit(getattr(self.service, route), payload)
+            result["elapsed_seconds"] = round(time.time() - started, 3)
+            self._send(200, result)
+        except ServiceError as e:
+            headers = {"Retry-After": "1"} if e.status == 503 else {}
+            self._send(e.status, {"error": str(e)}, headers)
+
+    def _send(self, status: int, body: Dict[str, Any], headers: Dict[str, str] = None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        print(f"[HTTP] {self.address_string()} {format % args}", file=sys.stderr)
+
+
+def main():
+    """命令行入口"""
+    parser = argparse.ArgumentParser(
+        description='智能知识库 HTTP 服务',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+接口（POST，JSON 请求体）:
+  /search     {"folder": "...", "query": "...", "k": 4}
+  /answer     {"folder": "...", "question": "...", "k": 4, "web": false}
+  /summarize  {"folder": "...", "files": [...], "template": "default"}
+  GET /health 服务状态
+
+示例:
+  python knowledge_base_server.py --port 8765 --workers 4
+  curl -X POST http://127.0.0.1:8765/search -d '{"folder": "./docs", "query": "项目风险"}'
+        """
+    )
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址（默认: 127.0.0.1）')
+    parser.add_argument('--port', type=int, default=8765, help='监听端口（默认: 8765）')
+    parser.add_argument('--workers', type=int, default=4, help='工作线程数（默认: 4）')
+    parser.add_argument('--queue-size', type=int, default=16, help='排队请求上限，超过后返回 503（默认: 16）')
+    parser.add_argument('--timeout', type=float, default=120, help='单个请求的超时时间，秒（默认: 120）')
+    parser.add_argument('--batch-size', type=int, default=32, help='查询向量批处理的最大批次（默认: 32）')
+    parser.add_argument('--batch-wait-ms', type=float, default=10, help='查询向量批处理的等待时间，毫秒（默认: 10）')
+    parser.add_argument('--api-key', type=str, help='DeepSeek API 密钥（默认从环境变量 DEEPSEEK_API_KEY 或本地配置读取）')
+    parser.add_argument('--workdir', type=str, default=os.path.dirname(os.path.abspath(__file__)),
+                        help='数据目录（chroma_db、配置文件所在目录，默认与界面相同）')
+    args = parser.parse_args()
+
+    os.chdir(args.workdir)
+    import knowledge_base_deepseek as kb
+
+    RequestHandler.service = KnowledgeBaseService(
+        kb,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        timeout=args.timeout,
+        max_batch_size=args.batch_size,
+        batch_wait_ms=args.batch_wait_ms,
+        api_key=args.api_key
+    )
+    RequestHandler.service.start_vector_db_gc()
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.daemon_threads = True
+    print(f"[INFO] 知识库服务已启动: http://{args.host}:{args.port}（工作线程 {args.workers}，"
+          f"排队上限 {args.queue_size}，超时 {args.timeout} 秒）", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[INFO] 服务已停止", file=sys.stderr)
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()